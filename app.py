@@ -1,14 +1,17 @@
 # 导入所需的Flask框架组件和其他Python库，用于构建Web应用程序和处理数据库操作
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for, Response
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, Response, send_file, stream_with_context
 from flask_login import login_required, login_user, logout_user, current_user
 from datetime import datetime, timedelta
 from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
 import re
-from openpyxl import Workbook
+import itertools
+import unicodedata
+from urllib.parse import quote
+from openpyxl import Workbook, load_workbook
 from extensions import db, login_manager
-from utils import generate_unique_id
+from utils import generate_unique_id, format_record_info, parse_units_per_box, site_for_location, DEFAULT_UNITS_PER_BOX, SITE_HK, SITE_SHENZHEN
 from constants import (
     DEFAULT_USERNAME,
     DEFAULT_PASSWORD,
@@ -17,7 +20,26 @@ from constants import (
     SUPPLEMENT_EXPIRY_DAYS_THRESHOLD,
 )
 from init_seeds import seed_defaults, ensure_admin_password_compat as ensure_admin_password_compat_seed
-from models import Merchant, Product, Stock, Record, User, Location, Permission, UserPermission, ShenzhenRecord
+from migrations import (
+    ensure_schema, run_data_migration, backfill_record_columns, record_columns_pending,
+    backfill_units_per_box, units_per_box_pending, backfill_stock_site, stock_site_pending,
+    compact_stock_rows, stock_compaction_pending
+)
+from jobs import JobExecutor, enqueue_job, register_job_handler, delete_merchant_jobs
+from idempotency import idempotent, commit_and_respond
+from permissions import user_permissions, bump_permissions_version, next_permissions_version
+from identity import IdentityCache, remember_merchant
+from node_lease import NodeLease
+from xlsx_stream import iter_xlsx_chunks
+from change_feed import record_changes, fetch_changes, stream_changes, purge_changes_if_due, CHANGE_DELETE
+from stock_ledger import (
+    record_movements, movement_row, record_stock_identity, stock_as_of, take_snapshot, delete_merchant_ledger,
+    ensure_stock_ledger, MOVEMENT_INBOUND, MOVEMENT_OUTBOUND, MOVEMENT_RELOCATE, MOVEMENT_RECORD_UPDATE,
+    MOVEMENT_RECORD_DELETE, MOVEMENT_PRODUCT_DELETE, MOVEMENT_PRODUCT_RENAME
+)
+from inventory_summary import refresh_product_summaries, delete_product_summaries, delete_merchant_summaries, ensure_inventory_summaries
+from models import Merchant, Product, Stock, Record, User, Location, Permission, UserPermission, ShenzhenRecord, BackgroundJob, ProductInventorySummary
+from performance_optimization import QueryOptimizer, BatchOperations, RequestMetrics, MerchantCache
 
 # 配置类定义
 class Config:
@@ -31,7 +53,9 @@ def permission_required(permission_name):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            # 取消权限检查的强制性，只返回原始函数
+            # 权限集合按会话缓存（见 permissions.py），检查本身不访问数据库
+            if not current_user.is_authenticated or not current_user.has_permission(permission_name):
+                return jsonify({'success': False, 'message': '没有权限执行此操作'}), 403
             return f(*args, **kwargs)
         return decorated_function
     return decorator
@@ -41,6 +65,21 @@ app = Flask(__name__)
 app.config.from_object(Config)
 db.init_app(app)
 
+# 请求级性能计量：Server-Timing 响应头 + /api/debug/metrics 汇总
+request_metrics = RequestMetrics(app)
+# 商户级响应缓存：写操作提交前调用 merchant_cache.bump_version(商户ID) 使缓存失效；
+# 涉及库存的写操作同时调用 refresh_product_summaries(商户ID, 产品ID列表) 刷新产品库存汇总；
+# bump_version 之后调用 record_changes(商户ID, 实体, ID列表) 写入变更流（见 change_feed.py）
+merchant_cache = MerchantCache(app)
+# 登录身份短时缓存：切换商户、修改权限、删除用户提交后调用 identity_cache.invalidate(用户ID)
+identity_cache = IdentityCache(merchant_cache.cache)
+# 记录主键的节点号从数据库租用（各进程互不相同），写请求开始前完成租用/续租
+node_lease = NodeLease(app)
+
+# 进程内后台任务执行器；设置 JOB_EXECUTOR=off 时仅由 scripts/run_jobs.py 执行任务
+job_executor = JobExecutor(app, max_workers=int(os.environ.get('JOB_WORKERS', '1'))) \
+    if os.environ.get('JOB_EXECUTOR', 'thread').lower() != 'off' else None
+
 # 添加请求处理前钩子，确保不会延长登录有效期
 @app.before_request
 def before_request():
@@ -72,6 +111,31 @@ def vite_client_stub():
     # 返回一个空的 JS 模块，防止控制台出现 404 错误
     return Response("// Vite client stub for Flask app\nexport const hot = undefined;", mimetype='application/javascript')
 
+# 逗号分隔的ID列表参数（如 product_ids=a,b,c），未提供时返回 None
+def split_id_list(value):
+    if not value:
+        return None
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+# 入库库存行字段（交给 BatchOperations.upsert_stock，按唯一键合并到已有行）
+def inbound_stock_row(merchant_id, product_id, box_spec, quantity, batch_number, expiry_date, location,
+                      unit_price=0.0, in_transit=None, daily_consumption=None):
+    return {
+        'product_id': product_id,
+        'box_spec': box_spec,
+        'units_per_box': parse_units_per_box(box_spec),
+        'quantity': quantity,
+        'batch_number': batch_number,
+        'expiry_date': expiry_date,
+        'location': location,
+        'site': site_for_location(location),
+        'merchant_id': merchant_id,
+        'unit_price': unit_price,
+        'in_transit': in_transit,
+        'daily_consumption': daily_consumption,
+        'shenzhen_stock': 0
+    }
+
 # 文件名安全处理，避免非法字符导致保存失败
 def sanitize_filename(text: str) -> str:
     if not isinstance(text, str):
@@ -87,16 +151,21 @@ login_manager.login_view = 'login'  # 设置登录视图的端点
 
 # 默认管理员账户信息从 constants 模块导入
 
-# 生成唯一ID的工具函数，使用时间戳和微秒确保ID的唯一性，用于各种记录的主键生成
-def generateUniqueId():
-    now = datetime.now()
-    return now.strftime('%Y%m%d%H%M%S%f')[:20]  # 使用微秒确保唯一性
-
-
-# 用户加载函数，用于Flask-Login从会话中恢复用户
+# 用户加载函数，用于Flask-Login从会话中恢复用户（返回短时缓存的轻量身份，命中时不查询数据库）
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return identity_cache.load(user_id)
+
+
+def set_current_merchant(merchant_id):
+    """更新当前用户的当前商户并提交（current_user 是只读身份，需按 ID 更新用户表）"""
+    User.query.filter_by(id=current_user.id).update(
+        {User.current_merchant_id: merchant_id}, synchronize_session=False
+    )
+    db.session.commit()
+    current_user.current_merchant_id = merchant_id
+    identity_cache.invalidate(current_user.id)
+    remember_merchant(merchant_id)
 
 # 模型从 models.py 导入，避免重复定义导致的表重复问题
 
@@ -128,6 +197,7 @@ def login():
         try:
             if user and user.check_password(password):
                 login_user(user)
+                remember_merchant(user.current_merchant_id)
                 
                 user.last_login = datetime.now()
                 # 记录登录时间，用于强制登出计算
@@ -135,9 +205,9 @@ def login():
                 session['last_activity'] = datetime.now().isoformat()
                 db.session.commit()
                 
-                # 检查当前商户今天是否已保存Excel文件
+                # 当前商户的当日归档与库存快照交由后台任务生成，不阻塞登录
                 if user.current_merchant_id:
-                    check_and_export_excel(user.current_merchant_id)
+                    enqueue_daily_jobs(user.current_merchant_id)
                 
                 return jsonify({'success': True, 'message': '登录成功'})
         except Exception as e:
@@ -149,12 +219,13 @@ def login():
                     db.session.refresh(user)
                     if user.check_password(password):
                         login_user(user)
+                        remember_merchant(user.current_merchant_id)
                         user.last_login = datetime.now()
                         session['login_time'] = datetime.now().isoformat()
                         session['last_activity'] = datetime.now().isoformat()
                         db.session.commit()
                         if user.current_merchant_id:
-                            check_and_export_excel(user.current_merchant_id)
+                            enqueue_daily_jobs(user.current_merchant_id)
                         return jsonify({'success': True, 'message': '登录成功'})
             except Exception as inner_e:
                 print(f"管理员密码兼容迁移失败: {inner_e}")
@@ -249,6 +320,20 @@ def debug_db_state():
     except Exception as e:
         return jsonify({'ok': False, 'error': str(e)}), 500
 
+# 性能计量接口（仅管理员）：按接口汇总的耗时、SQL 次数/耗时直方图、最慢语句与缓存命中率；DELETE 清空统计
+@app.route('/api/debug/metrics', methods=['GET', 'DELETE'])
+@login_required
+def debug_metrics():
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': '无权限'}), 403
+    if request.method == 'DELETE':
+        request_metrics.reset()
+        merchant_cache.reset_stats()
+        return jsonify({'success': True, 'message': '统计已清空'})
+    metrics = request_metrics.snapshot()
+    metrics['cache'] = merchant_cache.stats()
+    return jsonify(metrics)
+
 # 调试接口：查看指定用户是否存在及密码哈希前缀（公开读）
 @app.route('/api/debug/user/<username>', methods=['GET'])
 def debug_user(username):
@@ -313,35 +398,22 @@ def relocate_stock():
         # 扣减原位置库存
         stock_from.quantity -= quantity
 
-        # 目标位置库存（同产品/规格/批次/过期）
-        stock_to = Stock.query.filter(
-            Stock.product_id == product_id,
-            Stock.box_spec == box_spec,
-            Stock.merchant_id == current_user.current_merchant_id,
-            Stock.location == new_location,
-            Stock.batch_number == batch_number,
-            Stock.expiry_date == expiry_date
-        ).first()
-
-        if stock_to:
-            stock_to.quantity = (stock_to.quantity or 0) + quantity
-        else:
-            # 创建新库存行
-            stock_to = Stock(
-                product_id=product_id,
-                box_spec=box_spec,
-                quantity=quantity,
-                batch_number=batch_number,
-                expiry_date=expiry_date,
-                in_transit=stock_from.in_transit,
-                daily_consumption=stock_from.daily_consumption,
-                location=new_location,
-                merchant_id=current_user.current_merchant_id,
-                unit_price=stock_from.unit_price,
-                shenzhen_stock=0
-            )
-            db.session.add(stock_to)
+        # 目标位置库存（同产品/规格/批次/过期）：已有行则累加，否则新建
+        stock_to = inbound_stock_row(
+            current_user.current_merchant_id, product_id, box_spec, quantity, batch_number, expiry_date, new_location,
+            unit_price=stock_from.unit_price,
+            in_transit=stock_from.in_transit,
+            daily_consumption=stock_from.daily_consumption
+        )
+        BatchOperations.upsert_stock([stock_to])
 
+        record_movements(current_user.current_merchant_id, [
+            movement_row(stock_from, -quantity, MOVEMENT_RELOCATE),
+            movement_row(stock_to, quantity, MOVEMENT_RELOCATE)
+        ])
+        refresh_product_summaries(current_user.current_merchant_id, [product_id])
+        merchant_cache.bump_version(current_user.current_merchant_id)
+        record_changes(current_user.current_merchant_id, 'stock', [product_id])
         db.session.commit()
         return jsonify({'success': True, 'message': '移位成功'})
     except Exception as e:
@@ -385,7 +457,10 @@ def delete_merchant(merchant_id):
         # 删除该商户的所有相关数据
         Stock.query.filter_by(merchant_id=merchant_id).delete()
         Record.query.filter_by(merchant_id=merchant_id).delete()
+        delete_merchant_summaries(merchant_id)
         Product.query.filter_by(merchant_id=merchant_id).delete()
+        delete_merchant_ledger(merchant_id)
+        delete_merchant_jobs(merchant_id)
 
         # 删除商户
         db.session.delete(merchant)
@@ -409,11 +484,10 @@ def switch_merchant():
             return jsonify({'success': False, 'message': '商户不存在'}), 404
 
         # 更新用户当前商户
-        current_user.current_merchant_id = merchant_id
-        db.session.commit()
+        set_current_merchant(merchant.id)
 
-        # 检查切换到的商户今天是否已保存Excel文件
-        check_and_export_excel(merchant_id)
+        # 切换到的商户当日归档与库存快照交由后台任务生成
+        enqueue_daily_jobs(merchant_id)
 
         return jsonify({'success': True, 'message': f'已切换到商户: {merchant.name}'})
     except Exception as e:
@@ -423,6 +497,7 @@ def switch_merchant():
 # 获取当前用户的商户信息
 @app.route('/api/merchants/current', methods=['GET'])
 @login_required
+@merchant_cache.cached
 def get_current_merchant():
     if current_user.current_merchant_id:
         merchant = Merchant.query.get(current_user.current_merchant_id)
@@ -432,13 +507,9 @@ def get_current_merchant():
     # 如果用户没有当前商户，尝试设置默认商户
     default_merchant = Merchant.query.first()
     if default_merchant:
-        current_user.current_merchant_id = default_merchant.id
-        db.session.commit()
-        # 首次为用户设定默认商户后，触发当日归档（仅当日未生成时会生成）
-        try:
-            check_and_export_excel(default_merchant.id)
-        except Exception as e:
-            print(f"设置默认商户后触发归档失败: {e}")
+        set_current_merchant(default_merchant.id)
+        # 首次为用户设定默认商户后，将当日归档与库存快照加入后台任务（每商户每日仅一次）
+        enqueue_daily_jobs(default_merchant.id)
         return jsonify({'success': True, 'merchant': default_merchant.to_dict()})
 
     return jsonify({'success': False, 'message': '未找到商户信息'}), 404
@@ -446,78 +517,53 @@ def get_current_merchant():
 # 入库操作路由处理，接收入库请求并更新库存记录，同时创建操作日志
 @app.route('/api/incoming', methods=['POST'])
 @login_required
+@idempotent
 def handle_incoming():
     try:
         data = request.json
-        
-        # 详细的请求数据验证和日志记录
-        print(f"接收到入库请求: {data}")
-        
+
+        # 批量模式：{items: [...]} 整单在一个事务内处理
+        if isinstance(data, dict) and isinstance(data.get('items'), list):
+            return process_incoming_batch(data['items'])
+
         # 验证必填字段
         required_fields = ('product_id', 'box_spec', 'quantity', 'batch_number', 'incoming_reason', 'expiry_date', 'location')
         if not all(key in data for key in required_fields):
             missing_fields = [field for field in required_fields if field not in data]
             error_msg = f"缺少必要的字段: {', '.join(missing_fields)}"
-            print(error_msg)
             return jsonify({'message': error_msg}), 400
 
         # 确保商户ID有效
         if not current_user.current_merchant_id:
-            print("用户没有当前商户ID")
             return jsonify({'message': '请先选择商户'}), 400
 
         # 验证产品存在
         product = Product.query.filter_by(id=data['product_id'], merchant_id=current_user.current_merchant_id).first()
         if not product:
-            print(f"产品不存在: {data['product_id']}")
             return jsonify({'message': '产品不存在'}), 404
 
         # 验证并解析过期日期
         try:
             expiry_date = datetime.strptime(data['expiry_date'], '%Y-%m-%d').date()
         except ValueError as e:
-            print(f"日期格式错误: {data['expiry_date']}, 错误: {e}")
             return jsonify({'message': f'日期格式无效: {str(e)}'}), 400
 
         # 验证数量是否为有效的整数
         try:
             quantity = int(data['quantity'])
             if quantity <= 0:
-                print(f"无效的数量值: {quantity}")
                 return jsonify({'message': '数量必须大于0'}), 400
         except ValueError:
-            print(f"数量不是有效的整数: {data['quantity']}")
             return jsonify({'message': '数量必须为有效的整数'}), 400
-            
-        # 检查是否在过去一分钟内有相同的入库记录（防止重复提交）
-        one_minute_ago = datetime.now() - timedelta(minutes=1)
-        recent_record = Record.query.filter(
-            Record.product_id == data['product_id'],
-            Record.operation_type == '入库',
-            Record.quantity == quantity,
-            Record.date >= one_minute_ago,
-            Record.merchant_id == current_user.current_merchant_id
-        ).first()
-        
-        if recent_record:
-            print(f"检测到重复提交: 在过去一分钟内已有相同的入库记录 {recent_record.id}")
-            return jsonify({'message': '您刚刚已经提交过相同的入库记录，请勿重复操作'}), 400
 
         try:
-            operation_id = generate_unique_id()
-            print(f"生成操作ID: {operation_id}")
-            
-            # 创建库存记录 - 直接添加到库存中
-            new_stock = Stock(
-                product_id=data['product_id'],
-                box_spec=data['box_spec'],
-                quantity=quantity,
-                batch_number=data['batch_number'],
-                expiry_date=expiry_date,
-                location=data['location'],
-                merchant_id=current_user.current_merchant_id,
+            # 库存行：同产品/规格/批次/过期/库位已有行时累加数量，否则新建
+            stock_row = inbound_stock_row(
+                current_user.current_merchant_id, data['product_id'], data['box_spec'], quantity,
+                data['batch_number'], expiry_date, data['location'],
                 unit_price=data.get('unit_price', 0.0)  # 直接使用提供的单价
             )
+            BatchOperations.upsert_stock([stock_row])
             
             # 创建入库操作记录
             record_id = generate_unique_id()
@@ -527,17 +573,25 @@ def handle_incoming():
                 operation_type='入库',
                 quantity=quantity,
                 date=datetime.now(),
-                additional_info=f"入库原因: {data['incoming_reason']}, 箱规格: {data['box_spec']}, 批次号: {data['batch_number']}, 保质期: {expiry_date.strftime('%Y-%m-%d') if expiry_date else '无'}, 库位: {data['location']}",
+                additional_info=format_record_info('入库', data['incoming_reason'], data['box_spec'], data['batch_number'], expiry_date, data['location']),
                 merchant_id=current_user.current_merchant_id,
-                operator_id=current_user.id
+                operator_id=current_user.id,
+                box_spec=data['box_spec'],
+                batch_number=data['batch_number'],
+                expiry_date=expiry_date,
+                location=data['location'],
+                reason=data['incoming_reason']
             )
             
-            db.session.add(new_stock)
             db.session.add(new_record)
-            db.session.commit()
-            print(f"成功创建入库记录和库存: {record_id}")
-            
-            return jsonify({'message': '入库操作成功'}), 200
+            record_movements(current_user.current_merchant_id, [
+                movement_row(stock_row, quantity, MOVEMENT_INBOUND, record_id)
+            ])
+            refresh_product_summaries(current_user.current_merchant_id, [data['product_id']])
+            merchant_cache.bump_version(current_user.current_merchant_id)
+            record_changes(current_user.current_merchant_id, 'stock', [data['product_id']])
+            record_changes(current_user.current_merchant_id, 'record', [record_id])
+            return commit_and_respond({'message': '入库操作成功'})
         
         except Exception as e:
             db.session.rollback()
@@ -552,14 +606,123 @@ def handle_incoming():
         return jsonify({'message': error_msg}), 500
 
 
+# 批量入库：整张入库单一次校验、一次查重、批量写入并只提交一次
+@app.route('/api/incoming/batch', methods=['POST'])
+@login_required
+@idempotent
+def handle_incoming_batch():
+    data = request.json or {}
+    items = data.get('items') if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return jsonify({'success': False, 'message': '请提供入库明细列表 items'}), 400
+    return process_incoming_batch(items)
 
 
+def process_incoming_batch(items):
+    """校验并写入整张入库单；任一行校验失败则整单不写入，逐行返回结果"""
+    merchant_id = current_user.current_merchant_id
+    if not merchant_id:
+        return jsonify({'success': False, 'message': '请先选择商户'}), 400
+    if not items:
+        return jsonify({'success': False, 'message': '入库列表为空'}), 400
+
+    required_fields = ('product_id', 'box_spec', 'quantity', 'batch_number', 'incoming_reason', 'expiry_date', 'location')
+    product_ids = {str(item.get('product_id')) for item in items if isinstance(item, dict) and item.get('product_id')}
+
+    # 一次 IN 查询校验产品
+    existing_products = {
+        pid for (pid,) in db.session.query(Product.id).filter(
+            Product.merchant_id == merchant_id,
+            Product.id.in_(product_ids)
+        ).all()
+    } if product_ids else set()
+
+    results = []
+    lines = []
+    for index, item in enumerate(items):
+        error = None
+        if not isinstance(item, dict):
+            error = '明细格式不正确'
+        else:
+            missing_fields = [field for field in required_fields if field not in item]
+            if missing_fields:
+                error = f"缺少必要的字段: {', '.join(missing_fields)}"
+        if not error:
+            try:
+                expiry_date = datetime.strptime(item['expiry_date'], '%Y-%m-%d').date()
+                quantity = int(item['quantity'])
+            except (TypeError, ValueError) as e:
+                error = f'日期或数量格式无效: {str(e)}'
+        if not error and quantity <= 0:
+            error = '数量必须大于0'
+        if not error and str(item['product_id']) not in existing_products:
+            error = '产品不存在'
+        if error:
+            results.append({'index': index, 'success': False, 'message': error})
+        else:
+            lines.append((index, item, quantity, expiry_date))
+            results.append({'index': index, 'success': True, 'message': '待入库'})
 
+    if len(lines) != len(items):
+        return jsonify({
+            'success': False,
+            'message': '部分明细校验失败，整单未入库',
+            'results': results
+        }), 400
+
+    try:
+        now = datetime.now()
+        stock_rows = []
+        record_rows = []
+        for index, item, quantity, expiry_date in lines:
+            stock_rows.append(inbound_stock_row(
+                merchant_id, item['product_id'], item['box_spec'], quantity,
+                item['batch_number'], expiry_date, item['location'],
+                unit_price=item.get('unit_price', 0.0)
+            ))
+            record_id = generate_unique_id()
+            record_rows.append({
+                'id': record_id,
+                'product_id': item['product_id'],
+                'operation_type': '入库',
+                'quantity': quantity,
+                'date': now,
+                'additional_info': format_record_info('入库', item['incoming_reason'], item['box_spec'], item['batch_number'], expiry_date, item['location']),
+                'merchant_id': merchant_id,
+                'operator_id': current_user.id,
+                'box_spec': item['box_spec'],
+                'units_per_box': parse_units_per_box(item['box_spec']),
+                'batch_number': item['batch_number'],
+                'expiry_date': expiry_date,
+                'location': item['location'],
+                'reason': item['incoming_reason']
+            })
+            results[index] = {'index': index, 'success': True, 'message': '入库成功', 'record_id': record_id}
+
+        # 不需要回读主键：库存按唯一键批量合并写入，记录使用 executemany 批量插入
+        BatchOperations.upsert_stock(stock_rows)
+        db.session.execute(db.insert(Record), record_rows)
+        record_movements(merchant_id, [
+            movement_row(stock_row, stock_row['quantity'], MOVEMENT_INBOUND, record_row['id'])
+            for stock_row, record_row in zip(stock_rows, record_rows)
+        ])
+        refresh_product_summaries(merchant_id, {row['product_id'] for row in stock_rows})
+        merchant_cache.bump_version(merchant_id)
+        record_changes(merchant_id, 'stock', {row['product_id'] for row in stock_rows})
+        record_changes(merchant_id, 'record', [row['id'] for row in record_rows])
+        return commit_and_respond({'success': True, 'message': f'入库成功，共 {len(record_rows)} 条', 'results': results})
+    except Exception as e:
+        db.session.rollback()
+        error_msg = f"批量入库失败: {str(e)}"
+        print(error_msg)
+        return jsonify({'success': False, 'message': error_msg}), 500
 
 
 # 产品管理
 @app.route('/api/products', methods=['GET', 'POST'])
 @login_required
+@merchant_cache.conditional
+@merchant_cache.cached
 def handle_products():
     if request.method == 'POST':
         data = request.json
@@ -568,6 +731,8 @@ def handle_products():
             data['merchant_id'] = current_user.current_merchant_id
             new_product = Product(**data)
             db.session.add(new_product)
+            merchant_cache.bump_version(current_user.current_merchant_id)
+            record_changes(current_user.current_merchant_id, 'product', [new_product.id])
             db.session.commit()
             return jsonify({'message': '产品添加成功'}), 201
         except Exception as e:
@@ -601,23 +766,44 @@ def update_product(product_id):
         new_supplier = data.get('supplier', product.supplier)
 
         # 若修改了编号，检查是否冲突
+        old_id = product.id
         if new_id != product.id:
             existing = Product.query.get(new_id)
             if existing:
                 return jsonify({'success': False, 'message': '目标产品编号已存在'}), 400
 
-            old_id = product.id
             product.id = new_id
+            # 流水只追加：库存从旧编号转出、转入新编号
+            moved = Stock.query.filter(
+                Stock.product_id == old_id, Stock.merchant_id == product.merchant_id, Stock.quantity != 0
+            ).all()
+            record_movements(product.merchant_id, [
+                row
+                for stock in moved
+                for row in (
+                    movement_row(stock, -stock.quantity, MOVEMENT_PRODUCT_RENAME),
+                    dict(movement_row(stock, stock.quantity, MOVEMENT_PRODUCT_RENAME), product_id=new_id)
+                )
+            ])
             # 级联更新相关表（限当前商户）
             Stock.query.filter_by(product_id=old_id, merchant_id=product.merchant_id).update({'product_id': new_id})
             Record.query.filter_by(product_id=old_id, merchant_id=product.merchant_id).update({'product_id': new_id})
             ShenzhenRecord.query.filter_by(product_id=old_id, merchant_id=product.merchant_id).update({'product_id': new_id})
+            # 汇总行随库存迁移到新编号
+            delete_product_summaries(old_id)
+            refresh_product_summaries(product.merchant_id, [new_id])
 
         # 更新其它字段
         product.name = new_name
         product.category = new_category
         product.supplier = new_supplier
 
+        merchant_cache.bump_version(product.merchant_id)
+        if new_id != old_id:
+            # 改号后旧编号下的库存与记录整体迁移，客户端按删除旧产品处理
+            record_changes(product.merchant_id, 'product', [old_id], CHANGE_DELETE)
+            record_changes(product.merchant_id, 'stock', [old_id, new_id])
+        record_changes(product.merchant_id, 'product', [new_id])
         db.session.commit()
         return jsonify({'success': True, 'message': '产品更新成功', 'product': {
             'id': product.id,
@@ -632,26 +818,13 @@ def update_product(product_id):
 # 出库操作路由处理，验证库存并执行出库操作，更新库存记录和创建操作日志
 @app.route('/api/outgoing', methods=['POST'])
 @login_required
+@idempotent
 def handle_outgoing():
     data = request.json
+    # 批量模式：{items: [...]} 整张拣货单在一个事务内处理
+    if isinstance(data, dict) and isinstance(data.get('items'), list):
+        return process_outgoing_batch(data['items'])
     try:
-        # 检查是否在过去一分钟内有相同的出库记录（防止重复提交）
-        one_minute_ago = datetime.now() - timedelta(minutes=1)
-        recent_record = Record.query.filter(
-            Record.product_id == data['product_id'],
-            Record.operation_type == '出库',
-            Record.quantity == data['quantity'],
-            Record.date >= one_minute_ago,
-            Record.merchant_id == current_user.current_merchant_id
-        ).first()
-        
-        if recent_record:
-            print(f"检测到重复提交: 在过去一分钟内已有相同的出库记录 {recent_record.id}")
-            return jsonify({
-                'error': True,
-                'message': '您刚刚已经提交过相同的出库记录，请勿重复操作'
-            }), 400
-            
         # 查找对应的库存记录，添加商户过滤，并确保库存数量大于0
         stock = Stock.query.filter(
             Stock.product_id == data['product_id'],
@@ -662,7 +835,7 @@ def handle_outgoing():
             Stock.batch_number == (data['batch_number'] if 'batch_number' in data else None),
             Stock.location == (data['location'] if 'location' in data else None),
             Stock.expiry_date == (datetime.strptime(data['expiry_date'], '%Y-%m-%d').date() if 'expiry_date' in data and data['expiry_date'] else None)
-        ).first()
+        ).with_for_update().first()
 
         if not stock:
             return jsonify({
@@ -676,38 +849,28 @@ def handle_outgoing():
                 'message': '库存不足'
             }), 400
 
-        # 更新库存
-        stock.quantity -= data['quantity']
-        location = stock.location
-
-        # 创建出库记录，包含出库原因和库存信息
+        # 与批量出库相同的条件扣减（UPDATE ... WHERE quantity >= 出库数量），并发修改时不会扣成负数
         current_time = datetime.now()
-        operation_id = generate_unique_id()
-
-        # 不再处理或记录单价信息
-
-        new_record = Record(
-            id=operation_id,
-            product_id=data['product_id'],
-            operation_type='出库',
-            quantity=data['quantity'],
-            date=current_time,
-            additional_info=f"出库原因: {data['outgoing_reason']}, 箱规格: {data['box_spec']}, 批次号: {stock.batch_number}, 过期日期: {stock.expiry_date.strftime('%Y-%m-%d') if stock.expiry_date else '无'}, 库位: {location}",
-            merchant_id=current_user.current_merchant_id,
-            operator_id=current_user.id  # 添加操作人ID
+        record_ids = write_outgoing_picks(
+            current_user.current_merchant_id, [(stock, data['quantity'], data['outgoing_reason'])], now=current_time
         )
+        if record_ids is None:
+            db.session.rollback()
+            return jsonify({
+                'error': True,
+                'message': '库存已被其他操作修改，请刷新后重试'
+            }), 409
+        operation_id = record_ids[0]
+        location = stock.location
+        additional_info = format_record_info('出库', data['outgoing_reason'], stock.box_spec, stock.batch_number, stock.expiry_date, location)
 
-        db.session.add(new_record)
-
-
-        db.session.commit()
-
-        return jsonify({
+        return commit_and_respond({
             'error': False,
             'message': '出库成功',
             'stock': {
                 'product_id': data['product_id'],
-                'quantity': stock.quantity,
+                # 条件扣减不同步会话中的对象，这里的数量仍是扣减前的值
+                'quantity': stock.quantity - data['quantity'],
                 'batch_number': stock.batch_number,
                 'expiry_date': stock.expiry_date.strftime('%Y-%m-%d') if stock.expiry_date else '无',
                 'location': location
@@ -718,7 +881,7 @@ def handle_outgoing():
                 'operation_type': '出库',
                 'quantity': data['quantity'],
                 'date': current_time.isoformat(),
-                'additional_info': f"出库原因: {data['outgoing_reason']}, 箱规格: {data['box_spec']}, 批次号: {stock.batch_number}, 过期日期: {stock.expiry_date.strftime('%Y-%m-%d') if stock.expiry_date else '无'}, 库位: {location}"
+                'additional_info': additional_info
             }
         })
 
@@ -729,246 +892,550 @@ def handle_outgoing():
             'message': str(e)
         }), 500
 
+def write_outgoing_picks(merchant_id, picks, now=None):
+    """对已锁定的库存行执行条件扣减并批量写入出库记录（不提交）
+
+    picks 为 [(stock, quantity, reason)]，同一库存行可出现多次；now 为出库记录时间，默认当前时间。
+    用一条 UPDATE ... WHERE quantity >= 扣减量 扣减全部目标行；若有行未更新（库存被并发修改）返回 None，
+    否则返回与 picks 一一对应的记录ID列表。
+    """
+    allocations = {}
+    for stock, quantity, _ in picks:
+        allocations[stock.id] = allocations.get(stock.id, 0) + quantity
+    deduction = db.case(allocations, value=Stock.id)
+    updated = db.session.execute(
+        db.update(Stock).where(
+            Stock.id.in_(list(allocations)),
+            Stock.quantity >= deduction
+        ).values(quantity=Stock.quantity - deduction).execution_options(synchronize_session=False)
+    ).rowcount
+    if updated != len(allocations):
+        return None
+
+    now = now or datetime.now()
+    record_ids = []
+    record_rows = []
+    for stock, quantity, reason in picks:
+        record_id = generate_unique_id()
+        record_ids.append(record_id)
+        record_rows.append({
+            'id': record_id,
+            'product_id': stock.product_id,
+            'operation_type': '出库',
+            'quantity': quantity,
+            'date': now,
+            'additional_info': format_record_info('出库', reason, stock.box_spec, stock.batch_number, stock.expiry_date, stock.location),
+            'merchant_id': merchant_id,
+            'operator_id': current_user.id,
+            'box_spec': stock.box_spec,
+            'units_per_box': stock.units_per_box,
+            'batch_number': stock.batch_number,
+            'expiry_date': stock.expiry_date,
+            'location': stock.location,
+            'reason': reason
+        })
+    db.session.execute(db.insert(Record), record_rows)
+    record_movements(merchant_id, [
+        movement_row(stock, -quantity, MOVEMENT_OUTBOUND, record_id)
+        for (stock, quantity, _), record_id in zip(picks, record_ids)
+    ])
+    refresh_product_summaries(merchant_id, {stock.product_id for stock, _, _ in picks})
+    merchant_cache.bump_version(merchant_id)
+    record_changes(merchant_id, 'stock', {stock.product_id for stock, _, _ in picks})
+    record_changes(merchant_id, 'record', record_ids)
+    return record_ids
+
+
+# 批量出库（拣货单）：一次锁定目标库存行，条件扣减后批量写入出库记录，只提交一次
+@app.route('/api/outgoing/batch', methods=['POST'])
+@login_required
+@idempotent
+def handle_outgoing_batch():
+    data = request.json or {}
+    items = data.get('items') if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return jsonify({'error': True, 'success': False, 'message': '请提供出库明细列表 items'}), 400
+    return process_outgoing_batch(items)
+
+
+def process_outgoing_batch(items):
+    """校验并执行整张拣货单；任一行失败则整单回滚，逐行返回结果"""
+    merchant_id = current_user.current_merchant_id
+    if not merchant_id:
+        return jsonify({'error': True, 'success': False, 'message': '请先选择商户'}), 400
+    if not items:
+        return jsonify({'error': True, 'success': False, 'message': '待出库列表为空'}), 400
+
+    def batch_failed(message, results, status=400):
+        db.session.rollback()
+        return jsonify({'error': True, 'success': False, 'message': message, 'results': results}), status
+
+    results = []
+    lines = []
+    for index, item in enumerate(items):
+        error = None
+        if not isinstance(item, dict) or not all(item.get(k) for k in ('product_id', 'box_spec', 'quantity', 'outgoing_reason')):
+            error = '缺少必要的字段'
+        else:
+            try:
+                quantity = int(item['quantity'])
+                expiry_date = datetime.strptime(item['expiry_date'], '%Y-%m-%d').date() if item.get('expiry_date') else None
+            except (TypeError, ValueError) as e:
+                error = f'日期或数量格式无效: {str(e)}'
+            else:
+                if quantity <= 0:
+                    error = '数量必须大于0'
+        if error:
+            results.append({'index': index, 'success': False, 'message': error})
+        else:
+            key = (item['product_id'], item['box_spec'], item.get('batch_number'), item.get('location'), expiry_date)
+            lines.append((index, item, quantity, key))
+            results.append({'index': index, 'success': True, 'message': '待出库'})
+    if len(lines) != len(items):
+        return batch_failed('部分明细校验失败，整单未出库', results)
+
+    try:
+        product_ids = {key[0] for _, _, _, key in lines}
+
+        # 一次查询锁定候选库存行（PostgreSQL 下为 SELECT ... FOR UPDATE）
+        candidates = Stock.query.filter(
+            Stock.merchant_id == merchant_id,
+            Stock.product_id.in_(product_ids),
+            Stock.quantity > 0
+        ).order_by(Stock.id).with_for_update().all()
+        stock_by_key = {}
+        for stock in candidates:
+            key = (stock.product_id, stock.box_spec, stock.batch_number, stock.location, stock.expiry_date)
+            stock_by_key.setdefault(key, stock)
+
+        allocations = {}
+        for index, item, quantity, key in lines:
+            stock = stock_by_key.get(key)
+            if not stock:
+                results[index] = {'index': index, 'success': False, 'message': '产品不存在或规格不匹配'}
+            elif allocations.get(stock.id, 0) + quantity > stock.quantity:
+                results[index] = {'index': index, 'success': False, 'message': '库存不足'}
+            else:
+                allocations[stock.id] = allocations.get(stock.id, 0) + quantity
+        if any(not r['success'] for r in results):
+            return batch_failed('部分明细无法出库，整单未出库', results)
+
+        picks = [(stock_by_key[key], quantity, item['outgoing_reason']) for _, item, quantity, key in lines]
+        record_ids = write_outgoing_picks(merchant_id, picks)
+        if record_ids is None:
+            return batch_failed('库存已被其他操作修改，请刷新后重试', results, 409)
+
+        # 提交前生成结果，避免提交后访问过期对象触发重新加载
+        for (index, item, quantity, key), record_id in zip(lines, record_ids):
+            stock = stock_by_key[key]
+            results[index] = {
+                'index': index,
+                'success': True,
+                'message': '出库成功',
+                'record_id': record_id,
+                'stock': {
+                    'product_id': stock.product_id,
+                    'quantity': stock.quantity - allocations[stock.id],
+                    'batch_number': stock.batch_number,
+                    'expiry_date': stock.expiry_date.strftime('%Y-%m-%d') if stock.expiry_date else '无',
+                    'location': stock.location
+                }
+            }
+        return commit_and_respond({'error': False, 'success': True, 'message': f'出库成功，共 {len(record_ids)} 条', 'results': results})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': True, 'success': False, 'message': f'批量出库失败: {str(e)}'}), 500
+
+# 自动分配出库批次：客户端只提供产品、规格和数量，服务端按 FEFO（最早过期优先）或 FIFO（最早入库优先）
+# 选取香港库存行，必要时拆分到多个批次，每个被消耗的批次各写一条出库记录；preview=true 时只返回分配方案
+@app.route('/api/outgoing/allocate', methods=['POST'])
+@login_required
+@idempotent
+def allocate_outgoing():
+    data = request.json or {}
+    merchant_id = current_user.current_merchant_id
+    if not merchant_id:
+        return jsonify({'error': True, 'success': False, 'message': '请先选择商户'}), 400
+
+    strategy = (data.get('strategy') or 'fefo').lower()
+    if strategy not in ('fefo', 'fifo'):
+        return jsonify({'error': True, 'success': False, 'message': 'strategy 只支持 fefo 或 fifo'}), 400
+    preview = bool(data.get('preview'))
+    items = data['items'] if isinstance(data.get('items'), list) else [data]
+
+    required = ('product_id', 'box_spec', 'quantity') if preview else ('product_id', 'box_spec', 'quantity', 'outgoing_reason')
+    lines = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not all(item.get(k) for k in required):
+            return jsonify({'error': True, 'success': False, 'message': f'第{index + 1}行缺少必要的字段'}), 400
+        try:
+            quantity = int(item['quantity'])
+        except (TypeError, ValueError):
+            return jsonify({'error': True, 'success': False, 'message': f'第{index + 1}行数量必须为有效的整数'}), 400
+        if quantity <= 0:
+            return jsonify({'error': True, 'success': False, 'message': f'第{index + 1}行数量必须大于0'}), 400
+        lines.append((index, item, quantity))
+
+    try:
+        # 一次查询按分配顺序取回（并锁定）全部候选库存行，FEFO 走 idx_stock_expiry_quantity
+        if strategy == 'fefo':
+            order = [Stock.expiry_date.asc().nullslast(), Stock.id]
+        else:
+            order = [Stock.id]
+        candidates = Stock.query.filter(
+            Stock.merchant_id == merchant_id,
+            Stock.product_id.in_({item['product_id'] for _, item, _ in lines}),
+            Stock.quantity > 0,
+            Stock.site == SITE_HK
+        ).order_by(*order)
+        if not preview:
+            candidates = candidates.with_for_update()
+        stock_by_spec = {}
+        for stock in candidates.all():
+            stock_by_spec.setdefault((stock.product_id, stock.box_spec), []).append(stock)
+
+        used = {}
+        picks = []
+        results = []
+        for index, item, quantity in lines:
+            remaining = quantity
+            line_picks = []
+            for stock in stock_by_spec.get((item['product_id'], str(item['box_spec'])), []):
+                available = stock.quantity - used.get(stock.id, 0)
+                if available <= 0:
+                    continue
+                take = min(available, remaining)
+                used[stock.id] = used.get(stock.id, 0) + take
+                line_picks.append((stock, take))
+                remaining -= take
+                if remaining == 0:
+                    break
+            if remaining > 0:
+                db.session.rollback()
+                return jsonify({
+                    'error': True,
+                    'success': False,
+                    'message': f'第{index + 1}行库存不足，缺少 {remaining} 箱'
+                }), 400
+            picks.extend((stock, take, item.get('outgoing_reason')) for stock, take in line_picks)
+            results.append({'index': index, 'product_id': item['product_id'], 'allocations': [{
+                'stock_id': stock.id,
+                'box_spec': stock.box_spec,
+                'quantity': take,
+                'batch_number': stock.batch_number,
+                'expiry_date': stock.expiry_date.strftime('%Y-%m-%d') if stock.expiry_date else None,
+                'location': stock.location
+            } for stock, take in line_picks]})
+
+        if preview:
+            return jsonify({'error': False, 'success': True, 'strategy': strategy, 'results': results})
+
+        record_ids = write_outgoing_picks(merchant_id, picks)
+        if record_ids is None:
+            db.session.rollback()
+            return jsonify({'error': True, 'success': False, 'message': '库存已被其他操作修改，请重试'}), 409
+        ids = iter(record_ids)
+        for result in results:
+            for allocation in result['allocations']:
+                allocation['record_id'] = next(ids)
+        return commit_and_respond({
+            'error': False,
+            'success': True,
+            'message': f'出库成功，共消耗 {len(record_ids)} 个批次',
+            'strategy': strategy,
+            'results': results
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': True, 'success': False, 'message': f'自动分配出库失败: {str(e)}'}), 500
+
 # 库存查询路由处理，返回当前所有库存信息，包括产品详情和库存状态
 @app.route('/api/stock', methods=['GET'])
 @login_required
+@merchant_cache.conditional
+@merchant_cache.cached
 def get_stock():
     try:
         # 确保用户有当前商户
         if not current_user.current_merchant_id:
             return jsonify({'message': '请先选择商户'}), 400
             
-        # 添加商户过滤，并排除深圳库位；统一过滤零库存
-        stock = Stock.query.filter(
-            Stock.merchant_id == current_user.current_merchant_id,
-            Stock.quantity > 0,
-            Stock.location.is_(None) | Stock.location.notin_(['Shenzhen', 'shenzhen'])
-        ).all()
+        # 添加商户过滤，并排除深圳库位；统一过滤零库存（库存与产品一次联表取回）
+        rows = QueryOptimizer.optimize_stock_query(current_user.current_merchant_id, {
+            'site': 'hk',
+            'in_stock': True,
+            'product_id': request.args.get('product_id'),
+            'product_ids': split_id_list(request.args.get('product_ids'))
+        }).order_by(Stock.id).all()
         
         result = []
-        for s in stock:
-            product = Product.query.filter_by(id=s.product_id, merchant_id=current_user.current_merchant_id).first()
-            if product:
-                result.append({
-                    'id': s.id,
-                    'product_id': s.product_id,
-                    'name': product.name,
-                    'category': product.category,
-                    'supplier': product.supplier,
-                    # 移除产品单位字段
-                    'box_spec': s.box_spec,
-                    'quantity': s.quantity,
-                    'batch_number': s.batch_number,
-                    'expiry_date': s.expiry_date.strftime('%Y-%m-%d') if s.expiry_date else None,
-                    'in_transit': s.in_transit,
-                    'daily_consumption': s.daily_consumption,
-                    'location': s.location,
-                    # 移除单价字段
-                    'shenzhen_stock': s.shenzhen_stock or 0
-                })
+        for s in rows:
+            result.append({
+                'id': s.id,
+                'product_id': s.product_id,
+                'name': s.name,
+                'category': s.category,
+                'supplier': s.supplier,
+                # 移除产品单位字段
+                'box_spec': s.box_spec,
+                'quantity': s.quantity,
+                'batch_number': s.batch_number,
+                'expiry_date': s.expiry_date.strftime('%Y-%m-%d') if s.expiry_date else None,
+                'in_transit': s.in_transit,
+                'daily_consumption': s.daily_consumption,
+                'location': s.location,
+                # 移除单价字段
+                'shenzhen_stock': s.shenzhen_stock or 0
+            })
         return jsonify(result)
     except Exception as e:
         error_msg = f"获取库存信息失败: {str(e)}"
         print(error_msg)
         return jsonify({'message': error_msg}), 500
 
+# 产品库存概览：读取产品库存汇总表（每个产品一行），含香港/深圳箱数、件数与预计断货天数
+@app.route('/api/stock/summary', methods=['GET'])
+@login_required
+@merchant_cache.conditional
+@merchant_cache.cached
+def get_stock_summary():
+    merchant_id = current_user.current_merchant_id
+    if not merchant_id:
+        return jsonify({'message': '请先选择商户'}), 400
+    rows = db.session.query(ProductInventorySummary, Product.name, Product.category).outerjoin(
+        Product, db.and_(Product.id == ProductInventorySummary.product_id, Product.merchant_id == merchant_id)
+    ).filter(
+        ProductInventorySummary.merchant_id == merchant_id,
+        (ProductInventorySummary.hk_boxes > 0) | (ProductInventorySummary.shenzhen_boxes > 0)
+    ).order_by(ProductInventorySummary.product_id).all()
+    result = []
+    for summary, name, category in rows:
+        item = summary.to_dict()
+        item['name'] = name or ''
+        item['category'] = category or ''
+        result.append(item)
+    return jsonify(result)
+
+# 按时刻查询库存结存（最近快照 + 其后流水）：at 为 YYYY-MM-DD（当日结束时）或 YYYY-MM-DD HH:MM:SS，
+# 可按 product_ids（逗号分隔）与 location 过滤
+@app.route('/api/stock/as-of', methods=['GET'])
+@login_required
+@merchant_cache.cached
+def get_stock_as_of():
+    merchant_id = current_user.current_merchant_id
+    if not merchant_id:
+        return jsonify({'message': '请先选择商户'}), 400
+    at_value = (request.args.get('at') or '').strip()
+    try:
+        # 取所给日期（或秒）的最后时刻，包含当日（当秒）内的全部变动
+        if len(at_value) == 10:
+            at = datetime.strptime(at_value, '%Y-%m-%d') + timedelta(days=1)
+        else:
+            at = datetime.strptime(at_value, '%Y-%m-%d %H:%M:%S') + timedelta(seconds=1)
+        at -= timedelta(microseconds=1)
+    except ValueError:
+        return jsonify({'message': '查询参数无效: at（格式 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS）'}), 400
+
+    result = stock_as_of(merchant_id, at, split_id_list(request.args.get('product_ids')), request.args.get('location') or None)
+    fmt = lambda value: value.strftime('%Y-%m-%d %H:%M:%S') if value else None
+    snapshot = result['snapshot']
+    return jsonify({
+        'as_of': fmt(at),
+        'ledger_start': fmt(result['ledger_start']),
+        'snapshot': {'id': snapshot['id'], 'taken_at': fmt(snapshot['taken_at'])} if snapshot else None,
+        'items': [
+            dict(item, expiry_date=item['expiry_date'].strftime('%Y-%m-%d') if item['expiry_date'] else None)
+            for item in result['items']
+        ]
+    })
+
 # 仪表盘聚合数据接口
 @app.route('/api/dashboard', methods=['GET'])
 @login_required
+# 今日/本周/本月统计与距过期、滞留天数随日期变化，缓存键带日期
+@merchant_cache.cached(daily=True)
 def dashboard_data():
     try:
         merchant_id = current_user.current_merchant_id
         if not merchant_id:
             return jsonify({'message': '请先选择商户'}), 400
 
-        # 工具：解析规格中的每箱单位数（如 "24" 或 "24/箱"，默认1）
-        def parse_units_per_box(spec):
-            if not spec:
-                return 1
-            try:
-                m = re.search(r"(\d+(?:\.\d+)?)", str(spec))
-                return float(m.group(1)) if m else 1
-            except Exception:
-                return 1
-
-        # 1) 库存概览（香港库存，不含深圳；统一过滤零库存）
-        hk_stock_rows = Stock.query.filter(
+        now = datetime.now()
+        hk_filter = db.and_(
             Stock.merchant_id == merchant_id,
             Stock.quantity > 0,
-            Stock.location.is_(None) | Stock.location.notin_(['Shenzhen', 'shenzhen'])
+            Stock.site == SITE_HK
+        )
+        product_join = db.and_(Product.id == Stock.product_id, Product.merchant_id == merchant_id)
+
+        # 1) 库存概览（香港库存，不含深圳；统一过滤零库存）：直接读取产品库存汇总表，一次带出品名与类别
+        summary_rows = db.session.query(
+            ProductInventorySummary.product_id,
+            Product.name,
+            Product.category,
+            ProductInventorySummary.hk_items,
+            ProductInventorySummary.daily_consumption
+        ).outerjoin(Product, db.and_(
+            Product.id == ProductInventorySummary.product_id,
+            Product.merchant_id == merchant_id
+        )).filter(
+            ProductInventorySummary.merchant_id == merchant_id,
+            ProductInventorySummary.hk_boxes > 0
         ).all()
 
-        product_ids_in_stock = set()
         total_items = 0.0
         product_items_map = {}
         product_daily_map = {}
-        for s in hk_stock_rows:
-            product_ids_in_stock.add(s.product_id)
-            units = parse_units_per_box(s.box_spec)
-            items = units * (s.quantity or 0)
+        product_info = {}
+        for pid, name, category, items, daily in summary_rows:
             total_items += items
-            product_items_map[s.product_id] = product_items_map.get(s.product_id, 0.0) + items
-            # 记录最大每日消耗值（若有）
-            if s.daily_consumption is not None:
-                prev = product_daily_map.get(s.product_id)
-                product_daily_map[s.product_id] = max(prev or 0.0, float(s.daily_consumption))
+            product_items_map[pid] = items
+            product_info[pid] = (name or '', category or '')
+            if daily is not None:
+                product_daily_map[pid] = daily
 
         product_count = Product.query.filter_by(merchant_id=merchant_id).count()
 
-        # 已移除旧的30天低库存预警逻辑
-
-        # 新增：分类断货与过期提醒
+        # 分类断货提醒
         supplement_stockout_90 = []
         packaging_stockout_35 = []
-        # 过期提醒需逐批次计算
-        now = datetime.now()
-        supplement_expiry_360 = []
-
         for pid, items in product_items_map.items():
             daily = product_daily_map.get(pid, 0.0)
             days_left = (items / daily) if daily and daily > 0 else None
-            prod = Product.query.filter_by(id=pid, merchant_id=merchant_id).first()
-            prod_name = prod.name if prod else ''
-            prod_category = (prod.category or '') if prod else ''
-
-            # 已移除旧的30天低库存列表
-
-            # 分类断货提醒：补剂 90天
-            if prod_category == '补剂' and days_left is not None and days_left <= float(SUPPLEMENT_STOCKOUT_DAYS_THRESHOLD):
-                supplement_stockout_90.append({
-                    'product_id': pid,
-                    'name': prod_name,
-                    'items': round(items, 2),
-                    'daily_consumption': round(daily, 2),
-                    'days_to_stockout': round(days_left, 2)
-                })
-
-            # 分类断货提醒：包装用耗材 35天
-            if prod_category == '包装用耗材' and days_left is not None and days_left <= float(PACKAGING_STOCKOUT_DAYS_THRESHOLD):
-                packaging_stockout_35.append({
-                    'product_id': pid,
-                    'name': prod_name,
-                    'items': round(items, 2),
-                    'daily_consumption': round(daily, 2),
-                    'days_to_stockout': round(days_left, 2)
-                })
-
-        # 2) 入库/出库概览（按箱数统计）
-        # 过期提醒：补剂 360天（逐批次，忽略库存为0的批次）
-        for s in hk_stock_rows:
-            prod = Product.query.filter_by(id=s.product_id, merchant_id=merchant_id).first()
-            if not prod or (prod.category or '') != '补剂':
-                continue
-            # 只提醒仍有库存的批次
-            if not s.quantity or s.quantity <= 0:
+            prod_name, prod_category = product_info[pid]
+            if days_left is None:
                 continue
-            if not s.expiry_date:
-                continue
-            try:
-                days_to_expiry = (s.expiry_date - now.date()).days
-            except Exception:
-                continue
-            if days_to_expiry <= int(SUPPLEMENT_EXPIRY_DAYS_THRESHOLD):
-                units = parse_units_per_box(s.box_spec)
-                items = units * (s.quantity or 0)
-                supplement_expiry_360.append({
-                    'product_id': s.product_id,
-                    'name': prod.name or '',
-                    'expiry_date': s.expiry_date.strftime('%Y-%m-%d'),
-                    'days_to_expiry': days_to_expiry,
-                    'boxes': s.quantity or 0,
-                    'box_spec': s.box_spec,
-                    'items': round(items, 2)
-                })
+            alert = {
+                'product_id': pid,
+                'name': prod_name,
+                'items': round(items, 2),
+                'daily_consumption': round(daily, 2),
+                'days_to_stockout': round(days_left, 2)
+            }
+            # 补剂 90天
+            if prod_category == '补剂' and days_left <= float(SUPPLEMENT_STOCKOUT_DAYS_THRESHOLD):
+                supplement_stockout_90.append(alert)
+            # 包装用耗材 35天
+            if prod_category == '包装用耗材' and days_left <= float(PACKAGING_STOCKOUT_DAYS_THRESHOLD):
+                packaging_stockout_35.append(alert)
+
+        # 过期提醒：补剂 360天（逐批次，过滤条件下推到 SQL）
+        expiry_cutoff = now.date() + timedelta(days=int(SUPPLEMENT_EXPIRY_DAYS_THRESHOLD))
+        expiry_rows = db.session.query(
+            Stock.product_id, Stock.box_spec, Stock.quantity, Stock.items_expr(), Stock.expiry_date, Product.name
+        ).join(Product, product_join).filter(
+            hk_filter,
+            Product.category == '补剂',
+            Stock.expiry_date.isnot(None),
+            Stock.expiry_date <= expiry_cutoff
+        ).order_by(Stock.id).all()
+        supplement_expiry_360 = []
+        for pid, box_spec, boxes, items, expiry_date, name in expiry_rows:
+            supplement_expiry_360.append({
+                'product_id': pid,
+                'name': name or '',
+                'expiry_date': expiry_date.strftime('%Y-%m-%d'),
+                'days_to_expiry': (expiry_date - now.date()).days,
+                'boxes': boxes or 0,
+                'box_spec': box_spec,
+                'items': round(items, 2)
+            })
 
-        now = datetime.now()
+        # 2) 入库/出库概览（按箱数统计）：一次条件聚合得到今日/近7天/近30天
         start_today = datetime(now.year, now.month, now.day)
         start_week = start_today - timedelta(days=6)
         start_month = start_today - timedelta(days=29)
 
-        def sum_records(op_type, since):
-            q = Record.query.filter(
-                Record.merchant_id == merchant_id,
-                Record.operation_type == op_type,
-                Record.date >= since
-            )
-            return sum((r.quantity or 0) for r in q.all())
+        def sum_since(since):
+            return db.func.coalesce(db.func.sum(db.case((Record.date >= since, Record.quantity), else_=0)), 0)
 
-        incoming_today = sum_records('入库', start_today)
-        incoming_week = sum_records('入库', start_week)
-        incoming_month = sum_records('入库', start_month)
-
-        outgoing_today = sum_records('出库', start_today)
-        outgoing_week = sum_records('出库', start_week)
-        outgoing_month = sum_records('出库', start_month)
-
-        # 3) 产品表现（最近30天）
-        start_30d = start_month
-        outgoing_30d = db.session.query(Record).filter(
+        flow_rows = db.session.query(
+            Record.operation_type,
+            sum_since(start_today),
+            sum_since(start_week),
+            sum_since(start_month)
+        ).filter(
+            Record.merchant_id == merchant_id,
+            Record.operation_type.in_(['入库', '出库']),
+            Record.date >= start_month
+        ).group_by(Record.operation_type).all()
+        flow = {op: (int(today), int(week), int(month)) for op, today, week, month in flow_rows}
+        incoming_today, incoming_week, incoming_month = flow.get('入库', (0, 0, 0))
+        outgoing_today, outgoing_week, outgoing_month = flow.get('出库', (0, 0, 0))
+
+        # 3) 产品表现（最近30天）：产品左连接出库汇总子查询
+        outgoing_30d = db.session.query(
+            Record.product_id.label('product_id'),
+            db.func.sum(Record.quantity).label('qty')
+        ).filter(
             Record.merchant_id == merchant_id,
             Record.operation_type == '出库',
-            Record.date >= start_30d
+            Record.date >= start_month
+        ).group_by(Record.product_id).subquery()
+        product_perf = db.session.query(
+            Product.id, Product.name, db.func.coalesce(outgoing_30d.c.qty, 0)
+        ).outerjoin(outgoing_30d, outgoing_30d.c.product_id == Product.id).filter(
+            Product.merchant_id == merchant_id
         ).all()
-        outgoing_by_product = {}
-        for r in outgoing_30d:
-            outgoing_by_product[r.product_id] = outgoing_by_product.get(r.product_id, 0) + (r.quantity or 0)
+        perf_pool = [{'product_id': pid, 'name': name or '', 'outgoing_boxes': int(qty)} for pid, name, qty in product_perf]
 
         # 最畅销 Top 5
-        best_sellers = []
-        for pid, qty in sorted(outgoing_by_product.items(), key=lambda x: x[1], reverse=True)[:5]:
-            prod = Product.query.filter_by(id=pid, merchant_id=merchant_id).first()
-            best_sellers.append({'product_id': pid, 'name': prod.name if prod else '', 'outgoing_boxes': qty})
-
+        best_sellers = [
+            p for p in sorted(perf_pool, key=lambda x: x['outgoing_boxes'], reverse=True)
+            if p['outgoing_boxes'] > 0
+        ][:5]
         # 滞销（包含出库为0的产品），取最少的5个
-        all_products = Product.query.filter_by(merchant_id=merchant_id).all()
-        slow_movers_pool = []
-        for p in all_products:
-            slow_qty = outgoing_by_product.get(p.id, 0)
-            slow_movers_pool.append({'product_id': p.id, 'name': p.name, 'outgoing_boxes': slow_qty})
-        slow_movers = sorted(slow_movers_pool, key=lambda x: x['outgoing_boxes'])[:5]
+        slow_movers = sorted(perf_pool, key=lambda x: x['outgoing_boxes'])[:5]
 
         # 4) 库位利用率（按香港库存中出现的库位计算）
-        locations = set()
-        for s in hk_stock_rows:
-            if s.location:
-                locations.add(s.location)
-        total_locations = len(locations)
-        occupied_locations = len({s.location for s in hk_stock_rows if s.location})
-
-        # 5) 深圳待调拨数量与滞留时间
-        sz_rows = Stock.query.filter(
+        total_locations = db.session.query(
+            db.func.count(db.distinct(Stock.location))
+        ).filter(hk_filter, Stock.location.isnot(None)).scalar() or 0
+        occupied_locations = total_locations
+
+        # 5) 深圳待调拨数量与滞留时间：最近一次深圳入库时间用分组 MAX 子查询一次取回
+        # 规格/批次/过期日期可为空，两侧按 uq_stock_identity 的 COALESCE 归一后再比较（列与列的 = 不匹配 NULL）
+        _, _, stock_box_spec, stock_batch, stock_expiry, _ = Stock.identity_exprs()
+        record_box_spec = db.func.coalesce(ShenzhenRecord.box_spec, db.literal_column("''"))
+        record_batch = db.func.coalesce(ShenzhenRecord.batch_number, db.literal_column("''"))
+        record_expiry = db.func.coalesce(ShenzhenRecord.expiry_date, db.literal_column("'1900-01-01'"))
+        latest_inbound = db.session.query(
+            ShenzhenRecord.product_id.label('product_id'),
+            record_box_spec.label('box_spec'),
+            record_batch.label('batch_number'),
+            record_expiry.label('expiry_date'),
+            db.func.max(ShenzhenRecord.date).label('last_date')
+        ).filter(
+            ShenzhenRecord.merchant_id == merchant_id,
+            ShenzhenRecord.operation_type == '入库'
+        ).group_by(
+            ShenzhenRecord.product_id, record_box_spec, record_batch, record_expiry
+        ).subquery()
+        sz_rows = db.session.query(
+            Stock.product_id, Stock.quantity, Stock.items_expr(), Product.name, latest_inbound.c.last_date
+        ).outerjoin(Product, product_join).outerjoin(latest_inbound, db.and_(
+            latest_inbound.c.product_id == Stock.product_id,
+            latest_inbound.c.box_spec == stock_box_spec,
+            latest_inbound.c.batch_number == stock_batch,
+            latest_inbound.c.expiry_date == stock_expiry
+        )).filter(
             Stock.merchant_id == merchant_id,
-            Stock.location.in_(['Shenzhen', 'shenzhen']),
+            Stock.site == SITE_SHENZHEN,
             Stock.quantity > 0
-        ).all()
+        ).order_by(Stock.id).all()
         pending_boxes = 0
         retention_days = []
         items_detail = []
-        for s in sz_rows:
-            units = parse_units_per_box(s.box_spec)
-            boxes = (s.quantity or 0)
-            items = units * boxes
+        for pid, boxes, items, name, last_date in sz_rows:
+            boxes = boxes or 0
             pending_boxes += boxes
-
-            # 查找最近一次深圳入库记录以估算滞留天数
-            rec = db.session.query(ShenzhenRecord).filter(
-                ShenzhenRecord.merchant_id == merchant_id,
-                ShenzhenRecord.product_id == s.product_id,
-                ShenzhenRecord.operation_type == '入库',
-                ShenzhenRecord.box_spec == s.box_spec,
-                ShenzhenRecord.batch_number == s.batch_number,
-                ShenzhenRecord.expiry_date == s.expiry_date
-            ).order_by(ShenzhenRecord.date.desc()).first()
-
             days = None
-            if rec and rec.date:
-                days = (now - rec.date).days
+            if last_date:
+                days = (now - last_date).days
                 retention_days.append(days)
-
-            prod = Product.query.filter_by(id=s.product_id, merchant_id=merchant_id).first()
             items_detail.append({
-                'product_id': s.product_id,
-                'name': (prod.name if prod else ''),
+                'product_id': pid,
+                'name': name or '',
                 'boxes': boxes,
                 'items': round(items, 2),
                 'days_since_inbound': days
@@ -1014,111 +1481,167 @@ def dashboard_data():
         print(error_msg)
         return jsonify({'message': error_msg}), 500
 
+# 出入库记录分页：默认每页条数与上限
+RECORDS_PAGE_SIZE = 100
+RECORDS_MAX_PAGE_SIZE = 1000
+
+
+def parse_local_date_range(start_str, end_str):
+    """将北京时间的起止日期（YYYY-MM-DD）转换为数据库中存储时间的 [起, 止) 区间"""
+    start = end = None
+    if start_str:
+        start = datetime.strptime(start_str, '%Y-%m-%d') - timedelta(hours=8)
+    if end_str:
+        end = datetime.strptime(end_str, '%Y-%m-%d') + timedelta(days=1) - timedelta(hours=8)
+    return start, end
+
+
+def encode_record_cursor(date, record_id):
+    return f"{date.isoformat()}|{record_id}"
+
+
+def decode_record_cursor(cursor):
+    date_str, _, record_id = cursor.partition('|')
+    if not record_id:
+        raise ValueError('cursor 格式不正确')
+    return datetime.fromisoformat(date_str), record_id
+
+
+def apply_record_filters(query, merchant_id, args):
+    """按查询参数为记录查询追加筛选条件（日期、产品、类型、操作人、库位、原因）"""
+    start, end = parse_local_date_range(args.get('start_date'), args.get('end_date'))
+    query = query.filter(Record.merchant_id == merchant_id)
+    if start:
+        query = query.filter(Record.date >= start)
+    if end:
+        query = query.filter(Record.date < end)
+    if args.get('product_id'):
+        query = query.filter(Record.product_id == args['product_id'])
+    if args.get('operation_type'):
+        query = query.filter(Record.operation_type == args['operation_type'])
+    if args.get('location'):
+        query = query.filter(Record.location == args['location'])
+    if args.get('reason'):
+        query = query.filter(Record.reason == args['reason'])
+    if args.get('operator'):
+        query = query.filter(User.username == args['operator'])
+    return query
+
+
 # 获取出入库记录
+# 支持参数：start_date/end_date（北京时间日期）、product_id、operation_type、operator、location、reason、
+# limit（每页条数）、cursor（上一页响应头 X-Next-Cursor 的值）、include_total=1（返回 X-Total-Count）
 @app.route('/api/records', methods=['GET'])
 @login_required
+@merchant_cache.conditional
 def get_records():
     try:
         # 确保用户有当前商户
-        if not current_user.current_merchant_id:
+        merchant_id = current_user.current_merchant_id
+        if not merchant_id:
             return jsonify({'message': '请先选择商户'}), 400
-            
-        # 优化查询：使用JOIN一次性获取记录和产品信息，避免N+1查询问题
-        records_with_products = db.session.query(Record, Product).join(
+
+        # 列投影查询：记录、产品名与操作人一次取回，结构化字段无需再解析 additional_info
+        query = db.session.query(
+            Record.id,
+            Record.product_id,
+            Product.name,
+            Record.operation_type,
+            Record.quantity,
+            Record.date,
+            Record.reason,
+            Record.location,
+            Record.box_spec,
+            Record.batch_number,
+            Record.expiry_date,
+            User.username,
+            Record.items_expr()
+        ).join(
             Product, Record.product_id == Product.id
+        ).outerjoin(
+            User, Record.operator_id == User.id
         ).filter(
-            Record.merchant_id == current_user.current_merchant_id,
-            Product.merchant_id == current_user.current_merchant_id
-        ).order_by(Record.date.desc()).all()
-        
-        # 批量获取操作人信息，避免重复查询
-        operator_ids = [r.operator_id for r, p in records_with_products if r.operator_id is not None]
-        operators = {}
-        if operator_ids:
-            users = User.query.filter(User.id.in_(operator_ids)).all()
-            operators = {user.id: user.username for user in users}
-        
+            Product.merchant_id == merchant_id
+        )
+        try:
+            limit = min(max(int(request.args.get('limit', RECORDS_PAGE_SIZE)), 1), RECORDS_MAX_PAGE_SIZE)
+            cursor = decode_record_cursor(request.args['cursor']) if request.args.get('cursor') else None
+            query = apply_record_filters(query, merchant_id, request.args)
+        except ValueError as e:
+            return jsonify({'message': f'查询参数无效: {str(e)}'}), 400
+
+        total = None
+        if request.args.get('include_total') in ('1', 'true'):
+            total = query.order_by(None).count()
+
+        # 键集分页：按 (date, id) 倒序，从游标之后继续读取，多取一条判断是否还有下一页
+        if cursor:
+            cursor_date, cursor_id = cursor
+            query = query.filter(db.or_(
+                Record.date < cursor_date,
+                db.and_(Record.date == cursor_date, Record.id < cursor_id)
+            ))
+        rows = query.order_by(Record.date.desc(), Record.id.desc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
         result = []
-        for r, product in records_with_products:
-            try:
-                # 转换为北京时间
-                local_date = None
-                if r.date:
-                    beijing_time = r.date + timedelta(hours=8)
-                    local_date = beijing_time.strftime('%Y-%m-%d %H:%M:%S')
-
-                # 获取规格信息
-                box_spec = '0'  # 默认值为0
-                if r.additional_info and '箱规格: ' in r.additional_info:
-                    box_spec = r.additional_info.split('箱规格: ')[1].split(',')[0]
-                
-                # 转换规格为数值
-                box_spec_value = float(box_spec) if box_spec.isdigit() else 0
-
-                # 获取数量信息
-                quantity = r.quantity if r.quantity else 0
-
-                # 计算总数
-                total = quantity * box_spec_value
-
-                # 移除单价信息处理
-
-                # 修复过期日期显示问题，同时处理"保质期"和"过期日期"两种关键词
-                expiry_date = '无'
-                if r.additional_info:
-                    if '保质期: ' in r.additional_info:
-                        expiry_date = r.additional_info.split('保质期: ')[1].split(',')[0]
-                    elif '过期日期: ' in r.additional_info:
-                        expiry_date = r.additional_info.split('过期日期: ')[1].split(',')[0]
-
-                # 提取操作原因，根据操作类型提取入库原因或出库原因
-                reason = '无'
-                if r.additional_info:
-                    if r.operation_type == '入库' and '入库原因: ' in r.additional_info:
-                        reason = r.additional_info.split('入库原因: ')[1].split(',')[0]
-                    elif r.operation_type == '出库' and '出库原因: ' in r.additional_info:
-                        reason = r.additional_info.split('出库原因: ')[1].split(',')[0]
-
-                # 安全获取操作人信息，使用预先查询的operators字典
-                operator_name = '未知'
-                if r.operator_id is not None:
-                    operator_name = operators.get(r.operator_id, '未知')
-
-                # 安全获取库位信息
-                location = '无'
-                if r.additional_info and '库位: ' in r.additional_info:
-                    location = r.additional_info.split('库位: ')[-1].split(',')[0]
-
-                # 安全获取批次号
-                batch_number = '无'
-                if r.additional_info and '批次号: ' in r.additional_info:
-                    batch_number = r.additional_info.split('批次号: ')[1].split(',')[0]
-
-                result.append({
-                    'id': r.id,
-                    'product_id': r.product_id,
-                    'product_name': product.name,
-                    'operation_type': r.operation_type,
-                    'quantity': quantity,
-                    'date': local_date,
-                    'reason': reason,
-                    'location': location,
-                    'box_spec': box_spec,
-                    'batch_number': batch_number,
-                    'expiry_date': expiry_date,
-                    'operator': operator_name,
-                    'total': total
-                })
-            except Exception as inner_e:
-                print(f"处理记录 {r.id} 时出错: {str(inner_e)}")
-                # 继续处理下一条记录，不中断
+        for (record_id, product_id, product_name, operation_type, quantity, date,
+             reason, location, box_spec, batch_number, expiry_date, operator_name, items) in rows:
+            # 转换为北京时间
+            local_date = None
+            if date:
+                beijing_time = date + timedelta(hours=8)
+                local_date = beijing_time.strftime('%Y-%m-%d %H:%M:%S')
+
+            quantity = quantity or 0
+
+            result.append({
+                'id': record_id,
+                'product_id': product_id,
+                'product_name': product_name,
+                'operation_type': operation_type,
+                'quantity': quantity,
+                'date': local_date,
+                'reason': reason or '无',
+                'location': location or '无',
+                'box_spec': box_spec or '0',
+                'batch_number': batch_number or '无',
+                'expiry_date': expiry_date.strftime('%Y-%m-%d') if expiry_date else '无',
+                'operator': operator_name or '未知',
+                'total': items or 0
+            })
 
-        return jsonify(result)
+        response = jsonify(result)
+        if has_more and rows[-1][5] is not None:
+            response.headers['X-Next-Cursor'] = encode_record_cursor(rows[-1][5], rows[-1][0])
+        if total is not None:
+            response.headers['X-Total-Count'] = str(total)
+        return response
     except Exception as e:
         error_msg = f"获取操作记录失败: {str(e)}"
         print(error_msg)
         return jsonify({'message': error_msg}), 500
 
+# 记录筛选项：去重后的操作人与操作原因，供筛选下拉框使用
+@app.route('/api/records/filters', methods=['GET'])
+@login_required
+def get_record_filter_options():
+    merchant_id = current_user.current_merchant_id
+    if not merchant_id:
+        return jsonify({'message': '请先选择商户'}), 400
+    operators = db.session.query(User.username).join(
+        Record, Record.operator_id == User.id
+    ).filter(Record.merchant_id == merchant_id).distinct().all()
+    reasons = db.session.query(Record.reason).filter(
+        Record.merchant_id == merchant_id,
+        Record.reason.isnot(None)
+    ).distinct().all()
+    return jsonify({
+        'operators': sorted(name for (name,) in operators if name),
+        'reasons': sorted(reason for (reason,) in reasons if reason)
+    })
+
 # 记录修改路由处理，支持修改记录的原因、数量和规格，并同步更新库存
 @app.route('/api/records/update', methods=['POST'])
 @login_required
@@ -1142,32 +1665,11 @@ def update_record():
             
         # 获取原始数据，用于计算差值
         old_quantity = record.quantity
-        old_box_spec = 0
-        old_reason = ''
-        
-        # 从additional_info中提取原始规格
-        if '箱规格: ' in record.additional_info:
-            old_box_spec_str = record.additional_info.split('箱规格: ')[1].split(',')[0]
-            try:
-                old_box_spec = float(old_box_spec_str)
-            except ValueError:
-                old_box_spec = 0
-                
-        # 从additional_info中提取原始原因
-        if record.operation_type == '入库' and '入库原因: ' in record.additional_info:
-            old_reason = record.additional_info.split('入库原因: ')[1].split(',')[0]
-        elif record.operation_type == '出库' and '出库原因: ' in record.additional_info:
-            old_reason = record.additional_info.split('出库原因: ')[1].split(',')[0]
-            
-        # 从additional_info中提取原始批次号
-        old_batch_number = None
-        if '批次号: ' in record.additional_info:
-            old_batch_number = record.additional_info.split('批次号: ')[1].split(',')[0]
-            
-        # 从additional_info中提取原始过期日期
-        old_expiry_date = None
-        if '过期日期: ' in record.additional_info:
-            old_expiry_date = record.additional_info.split('过期日期: ')[1].split(',')[0]
+        old_box_spec = record.box_spec
+        old_reason = record.reason or ''
+        old_batch_number = record.batch_number
+        old_expiry_date = record.expiry_date.strftime('%Y-%m-%d') if record.expiry_date else None
+        location = record.location
         
         # 获取新数据
         new_quantity = data.get('quantity', old_quantity)
@@ -1178,89 +1680,90 @@ def update_record():
         
         # 计算数量差值
         quantity_diff = new_quantity - old_quantity
+
+        # 记录当前对应的库存维度（修改记录字段之前确定）
+        identity = record_stock_identity(record)
         
-        # 更新记录
+        # 更新记录的结构化字段
         record.quantity = new_quantity
+        record.box_spec = str(new_box_spec) if new_box_spec is not None else None
+        record.reason = new_reason
+        if new_batch_number:
+            record.batch_number = new_batch_number
+        if new_expiry_date:
+            try:
+                record.expiry_date = datetime.strptime(new_expiry_date, '%Y-%m-%d').date()
+            except ValueError:
+                return jsonify({'success': False, 'message': '过期日期格式应为 YYYY-MM-DD'}), 400
+        record.additional_info = format_record_info(
+            record.operation_type, record.reason, record.box_spec,
+            record.batch_number, record.expiry_date, record.location
+        )
         
-        # 更新additional_info中的规格、原因、批次号和过期日期
-        additional_info = record.additional_info
-        
-        # 更新规格
-        if '箱规格: ' in additional_info:
-            additional_info = additional_info.replace(f'箱规格: {old_box_spec_str}', f'箱规格: {new_box_spec}')
-        
-        # 更新原因
-        if record.operation_type == '入库' and '入库原因: ' in additional_info:
-            additional_info = additional_info.replace(f'入库原因: {old_reason}', f'入库原因: {new_reason}')
-        elif record.operation_type == '出库' and '出库原因: ' in additional_info:
-            additional_info = additional_info.replace(f'出库原因: {old_reason}', f'出库原因: {new_reason}')
-        
-        # 更新批次号
-        if new_batch_number and '批次号: ' in additional_info:
-            additional_info = additional_info.replace(f'批次号: {old_batch_number}', f'批次号: {new_batch_number}')
-        
-        # 更新过期日期
-        if new_expiry_date and '过期日期: ' in additional_info:
-            additional_info = additional_info.replace(f'过期日期: {old_expiry_date}', f'过期日期: {new_expiry_date}')
-        
-        record.additional_info = additional_info
-        
-        # 同步更新库存
-        # 提取库位和批次号信息
-        location = None
-        
-        if '库位: ' in record.additional_info:
-            location = record.additional_info.split('库位: ')[1].split(',')[0]
-            
-        # 使用原始批次号查找库存记录
-        batch_number = old_batch_number
+        # 同步更新库存：按记录流水（或记录字段）对应的库存维度定位库存行
+        stock = Stock.query.filter(Stock.identity_clause(identity)).first()
         
         # 根据操作类型更新库存
+        # 库存行按唯一键合并了多次入库，规格或批次变更时只移动本条记录的数量，不改写整行
+        target_box_spec = str(new_box_spec) if new_box_spec is not None else None
+        target_batch_number = new_batch_number or old_batch_number
+        movements = []
         if record.operation_type == '入库':
-            # 查找对应的库存记录
-            stock = Stock.query.filter_by(
-                product_id=record.product_id,
-                batch_number=batch_number,
-                location=location,
-                merchant_id=record.merchant_id,
-                box_spec=str(old_box_spec_str)  # 使用原始规格
-            ).first()
-            
             if stock:
-                # 更新库存数量
-                stock.quantity += quantity_diff
-                # 更新规格
-                stock.box_spec = str(new_box_spec)
-                # 更新批次号（如果有新的批次号）
-                if new_batch_number:
-                    stock.batch_number = new_batch_number
+                if target_box_spec == stock.box_spec and target_batch_number == stock.batch_number:
+                    # 更新库存数量
+                    stock.quantity += quantity_diff
+                    movements.append(movement_row(stock, quantity_diff, MOVEMENT_RECORD_UPDATE, record.id))
+                else:
+                    if (stock.quantity or 0) < old_quantity:
+                        return jsonify({'success': False, 'message': '原库存不足，无法修改规格或批次'}), 400
+                    stock.quantity -= old_quantity
+                    target = inbound_stock_row(
+                        record.merchant_id, record.product_id, target_box_spec, new_quantity,
+                        target_batch_number, stock.expiry_date, stock.location,
+                        unit_price=stock.unit_price,
+                        in_transit=stock.in_transit,
+                        daily_consumption=stock.daily_consumption
+                    )
+                    BatchOperations.upsert_stock([target])
+                    movements.append(movement_row(stock, -old_quantity, MOVEMENT_RECORD_UPDATE, record.id))
+                    movements.append(movement_row(target, new_quantity, MOVEMENT_RECORD_UPDATE, record.id))
             else:
                 # 如果找不到对应的库存记录，可能是因为规格变更，创建新记录
                 return jsonify({'success': False, 'message': '找不到对应的库存记录，无法更新'}), 404
                 
         elif record.operation_type == '出库':
-            # 查找对应的库存记录
-            stock = Stock.query.filter_by(
-                product_id=record.product_id,
-                batch_number=batch_number,
-                location=location,
-                merchant_id=record.merchant_id,
-                box_spec=str(old_box_spec_str)  # 使用原始规格
-            ).first()
-            
             if stock:
+                if target_batch_number != stock.batch_number:
+                    # 批次变更：原批次恢复出库数量，从新批次扣减
+                    target = Stock.query.filter_by(
+                        product_id=record.product_id,
+                        batch_number=target_batch_number,
+                        location=location,
+                        merchant_id=record.merchant_id,
+                        box_spec=old_box_spec
+                    ).first()
+                    if not target:
+                        return jsonify({'success': False, 'message': '找不到新批次的库存记录，无法更新'}), 404
+                    stock.quantity = (stock.quantity or 0) + old_quantity
+                    movements.append(movement_row(stock, old_quantity, MOVEMENT_RECORD_UPDATE, record.id))
+                    stock = target
+                    quantity_diff = new_quantity
                 # 更新库存数量（出库是减少库存，所以这里是减去差值）
                 stock.quantity -= quantity_diff
+                movements.append(movement_row(stock, -quantity_diff, MOVEMENT_RECORD_UPDATE, record.id))
                 # 检查库存是否足够
                 if stock.quantity < 0:
                     return jsonify({'success': False, 'message': '库存不足，无法更新'}), 400
-                # 更新批次号（如果有新的批次号）
-                if new_batch_number:
-                    stock.batch_number = new_batch_number
             else:
                 return jsonify({'success': False, 'message': '找不到对应的库存记录，无法更新'}), 404
         
         # 提交更改
+        record_movements(record.merchant_id, movements)
+        refresh_product_summaries(record.merchant_id, [record.product_id])
+        merchant_cache.bump_version(record.merchant_id)
+        record_changes(record.merchant_id, 'stock', [record.product_id])
+        record_changes(record.merchant_id, 'record', [record.id])
         db.session.commit()
         
         return jsonify({
@@ -1302,74 +1805,9 @@ def delete_record_api(record_id):
          if record.merchant_id != current_user.current_merchant_id:
              return jsonify({'success': False, 'message': '记录不属于当前商户'}), 403
  
-         # 从记录中解析规格、批次、过期和库位
-         info = record.additional_info or ''
-         box_spec = None
-         batch_number = None
-         expiry_date_str = None
-         location = None
- 
-         if '箱规格: ' in info:
-             try:
-                 box_spec = info.split('箱规格: ')[1].split(',')[0]
-             except Exception:
-                 box_spec = None
-         if '批次号: ' in info:
-             try:
-                 batch_number = info.split('批次号: ')[1].split(',')[0]
-             except Exception:
-                 batch_number = None
-         if '过期日期: ' in info:
-             try:
-                 expiry_date_str = info.split('过期日期: ')[1].split(',')[0]
-             except Exception:
-                 expiry_date_str = None
-         elif '保质期: ' in info:
-             try:
-                 expiry_date_str = info.split('保质期: ')[1].split(',')[0]
-             except Exception:
-                 expiry_date_str = None
-         if '库位: ' in info:
-             try:
-                 location = info.split('库位: ')[1].split(',')[0]
-             except Exception:
-                 location = None
- 
-         # 规范化字段
-         if batch_number in ['无', 'None', '']:
-             batch_number = None
-         if location in ['无', 'None', '']:
-             location = None
-         expiry_date = None
-         if expiry_date_str and expiry_date_str not in ['无', 'None', '']:
-             try:
-                 expiry_date = datetime.strptime(expiry_date_str, '%Y-%m-%d').date()
-             except Exception:
-                 expiry_date = None
- 
-         # 查找对应库存
-         query = Stock.query.filter(
-             Stock.product_id == record.product_id,
-             Stock.merchant_id == record.merchant_id
-         )
-         if box_spec is not None:
-             query = query.filter(Stock.box_spec == str(box_spec))
-         else:
-             query = query.filter(Stock.box_spec.is_(None))
-         if batch_number is not None:
-             query = query.filter(Stock.batch_number == batch_number)
-         else:
-             query = query.filter(Stock.batch_number.is_(None))
-         if location is not None:
-             query = query.filter(Stock.location == location)
-         else:
-             query = query.filter(Stock.location.is_(None))
-         if expiry_date is not None:
-             query = query.filter(Stock.expiry_date == expiry_date)
-         else:
-             query = query.filter(Stock.expiry_date.is_(None))
- 
-         stock = query.first()
+         # 按记录流水（流水上线前的记录取结构化字段）对应的库存维度查找库存
+         identity = record_stock_identity(record)
+         stock = Stock.query.filter(Stock.identity_clause(identity)).first()
          qty = record.quantity or 0
  
          if record.operation_type == '入库':
@@ -1379,26 +1817,27 @@ def delete_record_api(record_id):
              if (stock.quantity or 0) < qty:
                  return jsonify({'success': False, 'message': '库存不足，无法删除该入库记录'}), 400
              stock.quantity = (stock.quantity or 0) - qty
+             record_movements(record.merchant_id, [movement_row(identity, -qty, MOVEMENT_RECORD_DELETE, record.id)])
          elif record.operation_type == '出库':
              # 删除出库记录需恢复库存
              if stock:
                  stock.quantity = (stock.quantity or 0) + qty
              else:
-                 stock = Stock(
-                     product_id=record.product_id,
-                     box_spec=str(box_spec) if box_spec is not None else None,
-                     quantity=qty,
-                     batch_number=batch_number,
-                     expiry_date=expiry_date,
-                     location=location,
-                     merchant_id=record.merchant_id
-                 )
-                 db.session.add(stock)
+                 BatchOperations.upsert_stock([inbound_stock_row(
+                     record.merchant_id, record.product_id,
+                     identity['box_spec'], qty, identity['batch_number'], identity['expiry_date'], identity['location'],
+                     unit_price=None
+                 )])
+             record_movements(record.merchant_id, [movement_row(identity, qty, MOVEMENT_RECORD_DELETE, record.id)])
          else:
              return jsonify({'success': False, 'message': '不支持的记录类型'}), 400
  
          # 删除记录
          db.session.delete(record)
+         refresh_product_summaries(record.merchant_id, [record.product_id])
+         merchant_cache.bump_version(record.merchant_id)
+         record_changes(record.merchant_id, 'stock', [record.product_id])
+         record_changes(record.merchant_id, 'record', [record.id], CHANGE_DELETE)
          db.session.commit()
  
          return jsonify({'success': True, 'message': '记录已删除'})
@@ -1407,10 +1846,14 @@ def delete_record_api(record_id):
          return jsonify({'success': False, 'message': f'删除记录失败: {str(e)}'}), 500
 # 库存更新路由处理，支持更新在途数量、日常消耗量和深圳库存等信息
 @app.route('/api/stock/update', methods=['POST'])
+@login_required
 def update_stock():
     data = request.json
     try:
-        stocks = Stock.query.filter_by(product_id=data['product_id']).all()
+        stocks = Stock.query.filter_by(
+            product_id=data['product_id'],
+            merchant_id=current_user.current_merchant_id
+        ).all()
         if not stocks:
             return jsonify({'success': False, 'message': '未找到产品库存信息'}), 404
 
@@ -1439,6 +1882,9 @@ def update_stock():
             has_updates = True
 
         if has_updates:
+            refresh_product_summaries(current_user.current_merchant_id, [data['product_id']])
+            merchant_cache.bump_version(current_user.current_merchant_id)
+            record_changes(current_user.current_merchant_id, 'stock', [data['product_id']])
             db.session.commit()
             return jsonify({'success': True, 'message': '更新成功'})
         else:
@@ -1447,10 +1893,129 @@ def update_stock():
         db.session.rollback()
         return jsonify({'success': False, 'message': str(e)})
 
+# 批量导入每日消耗/在途数量/深圳库存：Excel 表头 -> 库存字段及类型
+STOCK_BULK_FIELDS = {
+    'daily_consumption': ('每日消耗', float),
+    'in_transit': ('在途数量', int),
+    'shenzhen_stock': ('深圳库存', int),
+}
+
+
+def read_stock_bulk_rows(file_storage):
+    """以只读模式流式读取上传的 xlsx，按表头转换为 {product_id, 字段...} 行列表"""
+    workbook = load_workbook(file_storage, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if not header:
+            raise ValueError('Excel文件为空')
+        columns = {str(name).strip(): index for index, name in enumerate(header) if name is not None}
+        if '产品编号' not in columns:
+            raise ValueError('Excel文件缺少必要的列：产品编号')
+        field_columns = {
+            field: columns[label]
+            for field, (label, _) in STOCK_BULK_FIELDS.items()
+            if label in columns
+        }
+        if not field_columns:
+            raise ValueError('Excel文件缺少需要更新的列：每日消耗/在途数量/深圳库存')
+
+        items = []
+        for values in rows:
+            product_id = values[columns['产品编号']] if columns['产品编号'] < len(values) else None
+            if product_id is None or str(product_id).strip() == '':
+                continue
+            item = {'product_id': str(product_id).strip()}
+            for field, index in field_columns.items():
+                value = values[index] if index < len(values) else None
+                if value is not None and str(value).strip() != '':
+                    item[field] = value
+            items.append(item)
+        return items
+    finally:
+        workbook.close()
+
+
+# 批量更新库存的每日消耗、在途数量和深圳库存，支持 JSON 或 Excel 上传，一次请求完成
+@app.route('/api/stock/bulk-update', methods=['POST'])
+@login_required
+def bulk_update_stock():
+    merchant_id = current_user.current_merchant_id
+    if not merchant_id:
+        return jsonify({'success': False, 'message': '请先选择商户'}), 400
+    try:
+        if 'file' in request.files:
+            upload = request.files['file']
+            if not upload.filename.lower().endswith('.xlsx'):
+                return jsonify({'success': False, 'message': '仅支持 .xlsx 格式的Excel文件'}), 400
+            items = read_stock_bulk_rows(upload)
+        else:
+            data = request.get_json(silent=True) or {}
+            items = data.get('items')
+            if not isinstance(items, list):
+                return jsonify({'success': False, 'message': '请提供 items 列表或上传Excel文件'}), 400
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'读取Excel文件失败: {str(e)}'}), 400
+
+    # 逐行校验并转换类型，同一产品出现多次时以后出现的为准
+    values_by_product = {}
+    invalid = []
+    for index, item in enumerate(items, start=1):
+        product_id = str(item.get('product_id') or '').strip()
+        if not product_id:
+            invalid.append({'row': index, 'message': '缺少产品编号'})
+            continue
+        values = {}
+        try:
+            for field, (label, cast) in STOCK_BULK_FIELDS.items():
+                if item.get(field) is not None:
+                    values[field] = cast(float(item[field])) if cast is int else cast(item[field])
+        except (TypeError, ValueError):
+            invalid.append({'row': index, 'product_id': product_id, 'message': '数值格式错误'})
+            continue
+        if not values:
+            invalid.append({'row': index, 'product_id': product_id, 'message': '没有需要更新的数据'})
+            continue
+        values_by_product.setdefault(product_id, {}).update(values)
+
+    if not values_by_product:
+        return jsonify({
+            'success': False,
+            'message': '没有有效的更新数据',
+            'invalid': invalid
+        }), 400
+
+    try:
+        # 当前商家下涉及产品的全部库存行一次更新（PostgreSQL 上为一条 UPDATE ... FROM VALUES）
+        stock_rows = BatchOperations.update_stock_by_product(merchant_id, values_by_product, list(STOCK_BULK_FIELDS))
+        if stock_rows:
+            refresh_product_summaries(merchant_id, {product_id for _, product_id in stock_rows})
+            merchant_cache.bump_version(merchant_id)
+            record_changes(merchant_id, 'stock', {product_id for _, product_id in stock_rows})
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'批量更新失败: {str(e)}'}), 500
+
+    updated_products = {product_id for _, product_id in stock_rows}
+    not_found = [product_id for product_id in values_by_product if product_id not in updated_products]
+    return jsonify({
+        'success': True,
+        'message': f'批量更新成功，共更新{len(updated_products)}个产品（{len(stock_rows)}条库存记录）',
+        'updated_products': len(updated_products),
+        'updated_rows': len(stock_rows),
+        'not_found': not_found,
+        'invalid': invalid
+    })
+
 #会话检查装饰器，用于验证会话时效性，确保安全性，超时自动退出
+# 只读取会话 Cookie，不加载用户、不访问数据库；用户被删除后由下一次业务请求登出
 @app.route('/api/check-session', methods=['GET'])
-@login_required
 def check_session():
+    if not session.get('_user_id'):
+        return login_manager.unauthorized()
     current_time = datetime.now()
     
     # 检查登录时间，强制1小时后登出
@@ -1474,7 +2039,10 @@ def check_session():
 @app.route('/api/products/<product_id>', methods=['DELETE'])
 def delete_product(product_id):
     try:
-        # 删除相关的库存记录
+        # 删除相关的库存记录（剩余数量以流水冲减为 0）
+        remaining = Stock.query.filter(Stock.product_id == product_id, Stock.quantity != 0).all()
+        for stock in remaining:
+            record_movements(stock.merchant_id, [movement_row(stock, -stock.quantity, MOVEMENT_PRODUCT_DELETE)])
         Stock.query.filter_by(product_id=product_id).delete()
         # 删除相关的操作记录
         Record.query.filter_by(product_id=product_id).delete()
@@ -1482,6 +2050,10 @@ def delete_product(product_id):
         product = Product.query.get(product_id)
         if product:
             db.session.delete(product)
+            delete_product_summaries(product_id)
+            merchant_cache.bump_version(product.merchant_id)
+            record_changes(product.merchant_id, 'stock', [product_id])
+            record_changes(product.merchant_id, 'product', [product_id], CHANGE_DELETE)
             db.session.commit()
             return jsonify({'success': True, 'message': '产品删除成功'})
         return jsonify({'success': False, 'message': '产品不存在'})
@@ -1495,35 +2067,34 @@ def delete_product(product_id):
 @app.route('/api/users', methods=['GET'])
 @login_required
 def get_users():
-    users = User.query.all()
-    result = []
+    # 用户与权限一次联表取回：管理员连接全部权限，普通用户只连接已分配的权限
+    granted = db.exists().where(
+        UserPermission.user_id == User.id,
+        UserPermission.permission_id == Permission.id
+    )
+    rows = db.session.query(User, Permission).outerjoin(
+        Permission, db.or_(User.is_admin.is_(True), granted)
+    ).order_by(User.id, Permission.id).all()
 
-    for user in users:
-        # 获取用户权限
-        user_permissions = []
-        if user.is_admin:
-            # 管理员拥有所有权限
-            permissions = Permission.query.all()
-            user_permissions = [{'id': p.id, 'name': p.name, 'description': p.description} for p in permissions]
-        else:
-            # 普通用户只有分配的权限
-            user_permission_records = UserPermission.query.filter_by(user_id=user.id).all()
-            for up in user_permission_records:
-                permission = Permission.query.get(up.permission_id)
-                if permission:
-                    user_permissions.append({
-                        'id': permission.id,
-                        'name': permission.name,
-                        'description': permission.description
-                    })
-
-        result.append({
-            'id': user.id,
-            'username': user.username,
-            'is_admin': user.is_admin,
-            'last_login': user.last_login.strftime('%Y-%m-%d %H:%M:%S') if user.last_login else None,
-            'permissions': user_permissions
-        })
+    result = []
+    by_user = {}
+    for user, permission in rows:
+        entry = by_user.get(user.id)
+        if entry is None:
+            entry = by_user[user.id] = {
+                'id': user.id,
+                'username': user.username,
+                'is_admin': user.is_admin,
+                'last_login': user.last_login.strftime('%Y-%m-%d %H:%M:%S') if user.last_login else None,
+                'permissions': []
+            }
+            result.append(entry)
+        if permission is not None:
+            entry['permissions'].append({
+                'id': permission.id,
+                'name': permission.name,
+                'description': permission.description
+            })
 
     return jsonify(result)
 
@@ -1558,6 +2129,7 @@ def create_user():
         new_user.set_password(data['password'])
         new_user.is_admin = data.get('is_admin', False)
         new_user.current_merchant_id = current_user.current_merchant_id
+        new_user.permissions_version = next_permissions_version()
 
         db.session.add(new_user)
         db.session.flush()  # 获取用户ID
@@ -1610,6 +2182,7 @@ def delete_user(user_id):
         # 删除用户
         db.session.delete(user)
         db.session.commit()
+        identity_cache.invalidate(user_id)
         return jsonify({'message': '用户删除成功'}), 200
     except Exception as e:
         db.session.rollback()
@@ -1660,8 +2233,10 @@ def update_user_permissions(user_id):
             if isinstance(is_admin_val, str):
                 is_admin_val = is_admin_val.lower() in ('true', '1', 'yes')
             user.is_admin = bool(is_admin_val)
-            
+
+        bump_permissions_version(user_id)
         db.session.commit()
+        identity_cache.invalidate(user_id)
         return jsonify({'message': '用户权限更新成功'}), 200
     except Exception as e:
         db.session.rollback()
@@ -1671,25 +2246,12 @@ def update_user_permissions(user_id):
 @app.route('/api/users/current', methods=['GET'])
 @login_required
 def get_current_user():
-    # 获取当前用户权限
-    user_permissions = []
-    if current_user.is_admin:
-        # 管理员拥有所有权限
-        permissions = Permission.query.all()
-        user_permissions = [p.name for p in permissions]
-    else:
-        # 普通用户只有分配的权限
-        user_permission_records = UserPermission.query.filter_by(user_id=current_user.id).all()
-        for up in user_permission_records:
-            permission = Permission.query.get(up.permission_id)
-            if permission:
-                user_permissions.append(permission.name)
-
+    # 当前用户权限：会话内缓存，权限版本号未变化时不查询权限表
     return jsonify({
         'id': current_user.id,
         'username': current_user.username,
         'is_admin': current_user.is_admin,
-        'permissions': user_permissions
+        'permissions': sorted(user_permissions(current_user))
     })
 
 # 获取所有商户库存的API路由
@@ -1697,43 +2259,33 @@ def get_current_user():
 @login_required
 def get_all_merchants_stock():
     try:
-        # 获取所有商户信息
-        merchants = Merchant.query.all()
+        # 所有商户的库存一次联表取回（统一过滤零库存，不含深圳），按商户ID排序
+        rows = QueryOptimizer.optimize_stock_query(
+            None, {'site': 'hk', 'in_stock': True}
+        ).order_by(Stock.merchant_id, Stock.id).all()
         
         result = []
-        for merchant in merchants:
-            # 获取该商户的库存信息（统一过滤零库存，不含深圳）
-            stock_items = Stock.query.filter(
-                Stock.merchant_id == merchant.id,
-                Stock.quantity > 0,
-                Stock.location.is_(None) | Stock.location.notin_(['Shenzhen', 'shenzhen'])
-            ).all()
-            
-            for item in stock_items:
-                product = Product.query.get(item.product_id)
-                if product:
-                    result.append({
-                        'id': item.id,
-                        'merchant_id': merchant.id,
-                        'merchant_name': merchant.name,
-                        'product_id': item.product_id,
-                        'name': product.name,
-                        'category': product.category,
-                        'supplier': product.supplier,
-                        'unit': product.unit,
-                        'box_spec': item.box_spec,
-                        'quantity': item.quantity,
-                        'batch_number': item.batch_number,
-                        'expiry_date': item.expiry_date.strftime('%Y-%m-%d') if item.expiry_date else None,
-                        'in_transit': item.in_transit,
-                        'daily_consumption': item.daily_consumption,
-                        'location': item.location,
-                        'unit_price': item.unit_price,
-                        'shenzhen_stock': item.shenzhen_stock
-                    })
+        for item in rows:
+            result.append({
+                'id': item.id,
+                'merchant_id': item.merchant_id,
+                'merchant_name': item.merchant_name,
+                'product_id': item.product_id,
+                'name': item.name,
+                'category': item.category,
+                'supplier': item.supplier,
+                'unit': item.unit,
+                'box_spec': item.box_spec,
+                'quantity': item.quantity,
+                'batch_number': item.batch_number,
+                'expiry_date': item.expiry_date.strftime('%Y-%m-%d') if item.expiry_date else None,
+                'in_transit': item.in_transit,
+                'daily_consumption': item.daily_consumption,
+                'location': item.location,
+                'unit_price': item.unit_price,
+                'shenzhen_stock': item.shenzhen_stock
+            })
         
-        # 按商户ID排序
-        result.sort(key=lambda x: x['merchant_id'])
         
         return jsonify(result)
     except Exception as e:
@@ -1741,113 +2293,327 @@ def get_all_merchants_stock():
         print(error_msg)
         return jsonify({'message': error_msg}), 500
 
-# 检查并导出Excel文件的函数
+# 检查并导出Excel文件的函数（由后台任务调用）
 def check_and_export_excel(merchant_id):
     """检查今天是否已经为该商户保存过Excel文件，如果没有则生成"""
-    try:
-        # 在无持久化文件系统的环境（如 Vercel）默认禁用归档导出
-        if os.environ.get('ENABLE_ARCHIVE_EXPORT', 'false').lower() != 'true':
-            print('归档导出已禁用（设置 ENABLE_ARCHIVE_EXPORT=true 可启用）')
-            return
-        # 获取商户名称
-        merchant = Merchant.query.get(merchant_id)
-        if not merchant:
-            return
-        
-        # 确保导出目录存在（固定到项目根目录）
-        base_dir = os.path.abspath(os.path.dirname(__file__))
-        archive_dir = os.path.join(base_dir, 'Archive')
-        os.makedirs(archive_dir, exist_ok=True)
-
-        # 生成今天的文件名
-        today_str = datetime.now().strftime('%Y%m%d')
-        safe_name = sanitize_filename(merchant.name)
-        stock_filename = os.path.join(archive_dir, f"{safe_name}_{today_str}_库存.xlsx")
-        records_filename = os.path.join(archive_dir, f"{safe_name}_{today_str}_出入库记录.xlsx")
-        
-        # 检查文件是否已存在
-        stock_exists = os.path.exists(stock_filename)
-        records_exists = os.path.exists(records_filename)
-        
-        # 如果文件不存在，则生成
-        if not stock_exists:
-            export_stock_to_excel(merchant_id)
-            print(f"已为商户 {merchant.name} 生成今日库存Excel文件")
-        else:
-            print(f"商户 {merchant.name} 今日库存Excel文件已存在，跳过生成")
-            
-        if not records_exists:
-            export_records_to_excel(merchant_id)
-            print(f"已为商户 {merchant.name} 生成今日出入库记录Excel文件")
-        else:
-            print(f"商户 {merchant.name} 今日出入库记录Excel文件已存在，跳过生成")
-            
-    except Exception as e:
-        print(f"检查或生成Excel文件时出错: {e}")
-
-# 添加导出库存到Excel的函数
-def export_stock_to_excel(merchant_id):
     # 在无持久化文件系统的环境（如 Vercel）默认禁用归档导出
     if os.environ.get('ENABLE_ARCHIVE_EXPORT', 'false').lower() != 'true':
+        print('归档导出已禁用（设置 ENABLE_ARCHIVE_EXPORT=true 可启用）')
         return
     # 获取商户名称
     merchant = Merchant.query.get(merchant_id)
     if not merchant:
         return
 
-    # 获取库存信息（统一过滤零库存）
-    stock_items = Stock.query.filter(
-        Stock.merchant_id == merchant_id,
-        Stock.quantity > 0
-    ).all()
     # 确保导出目录存在（固定到项目根目录）
     base_dir = os.path.abspath(os.path.dirname(__file__))
     archive_dir = os.path.join(base_dir, 'Archive')
     os.makedirs(archive_dir, exist_ok=True)
-    # 生成文件名（清理商户名）
+
+    # 生成今天的文件名
+    today_str = datetime.now().strftime('%Y%m%d')
     safe_name = sanitize_filename(merchant.name)
-    filename = os.path.join(archive_dir, f"{safe_name}_{datetime.now().strftime('%Y%m%d')}_库存.xlsx")
+    stock_filename = os.path.join(archive_dir, f"{safe_name}_{today_str}_库存.xlsx")
+    records_filename = os.path.join(archive_dir, f"{safe_name}_{today_str}_出入库记录.xlsx")
 
-    # 创建Excel文件
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "库存"
+    # 文件不存在时才生成，异常向上抛出由任务记录失败原因
+    if not os.path.exists(stock_filename):
+        export_stock_to_excel(merchant_id)
+        print(f"已为商户 {merchant.name} 生成今日库存Excel文件")
+    else:
+        print(f"商户 {merchant.name} 今日库存Excel文件已存在，跳过生成")
 
-    # 添加表头（不包含产品单位与单价）
-    headers = ['产品编号', '品名', '产品类别', '供应商', '香港库存', '深圳库存', '在途数量', '每日消耗', '规格', '箱数', '批次号', '过期日期', '库位']
-    ws.append(headers)
+    if not os.path.exists(records_filename):
+        export_records_to_excel(merchant_id)
+        print(f"已为商户 {merchant.name} 生成今日出入库记录Excel文件")
+    else:
+        print(f"商户 {merchant.name} 今日出入库记录Excel文件已存在，跳过生成")
+
+
+@register_job_handler('archive_export')
+def run_archive_export_job(job):
+    check_and_export_excel(job.merchant_id)
 
-    # 添加库存数据
-    for item in stock_items:
-        product = Product.query.get(item.product_id)
-        # 获取规格信息
-        box_spec_info = item.box_spec  # 假设箱规格信息在这里
-        box_quantity = item.quantity  # 假设库存数量在这里
-        expiry_date = item.expiry_date.strftime('%Y-%m-%d') if item.expiry_date else '无'
-        location = item.location if item.location else '无'
-        # 不输出单价
-
-        ws.append([
+
+@register_job_handler('stock_snapshot')
+def run_stock_snapshot_job(job):
+    take_snapshot(job.merchant_id)
+
+
+def enqueue_stock_snapshot(merchant_id):
+    """将商户当日库存快照加入后台任务队列（每商户每日一个任务）并唤醒执行器"""
+    try:
+        today = datetime.now().date()
+        job = enqueue_job(
+            'stock_snapshot',
+            f"stock_snapshot:{merchant_id}:{today.strftime('%Y%m%d')}",
+            merchant_id=merchant_id,
+            run_date=today
+        )
+        if job_executor and job.status == 'pending':
+            job_executor.wake()
+        return job
+    except Exception as e:
+        db.session.rollback()
+        print(f"库存快照任务入队失败: {e}")
+        return None
+
+
+def enqueue_daily_jobs(merchant_id):
+    """商户的每日后台任务：当日归档与库存快照"""
+    enqueue_archive_export(merchant_id)
+    enqueue_stock_snapshot(merchant_id)
+
+
+def enqueue_archive_export(merchant_id):
+    """将商户当日归档加入后台任务队列（每商户每日一个任务）并唤醒执行器；未启用归档时不入队"""
+    if os.environ.get('ENABLE_ARCHIVE_EXPORT', 'false').lower() != 'true':
+        return None
+    try:
+        today = datetime.now().date()
+        job = enqueue_job(
+            'archive_export',
+            f"archive_export:{merchant_id}:{today.strftime('%Y%m%d')}",
+            merchant_id=merchant_id,
+            run_date=today
+        )
+        if job_executor and job.status == 'pending':
+            job_executor.wake()
+        return job
+    except Exception as e:
+        db.session.rollback()
+        print(f"归档任务入队失败: {e}")
+        return None
+
+
+# 查询后台任务：管理员可查看全部商户，其他用户仅查看当前商户；支持 status、job_type、limit 参数
+@app.route('/api/jobs', methods=['GET'])
+@login_required
+def list_jobs():
+    query = BackgroundJob.query
+    if not current_user.is_admin:
+        query = query.filter(BackgroundJob.merchant_id == current_user.current_merchant_id)
+    if request.args.get('status'):
+        query = query.filter(BackgroundJob.status == request.args['status'])
+    if request.args.get('job_type'):
+        query = query.filter(BackgroundJob.job_type == request.args['job_type'])
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+    except ValueError:
+        return jsonify({'message': '查询参数无效: limit'}), 400
+    jobs = query.order_by(BackgroundJob.id.desc()).limit(limit).all()
+    return jsonify([job.to_dict() for job in jobs])
+
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    job = db.session.get(BackgroundJob, job_id)
+    if not job or (not current_user.is_admin and job.merchant_id != current_user.current_merchant_id):
+        return jsonify({'message': '任务不存在'}), 404
+    return jsonify(job.to_dict())
+
+
+def parse_change_cursor(value):
+    """解析变更流游标（非负整数），未提供时返回 None"""
+    if value in (None, ''):
+        return None
+    cursor = int(value)
+    if cursor < 0:
+        raise ValueError(value)
+    return cursor
+
+
+# 变更流增量接口：since 之后的变更（同一实体只保留最后一次）；不带 since 时只返回当前游标
+@app.route('/api/changes', methods=['GET'])
+@login_required
+def get_changes():
+    merchant_id = current_user.current_merchant_id
+    if not merchant_id:
+        return jsonify({'message': '请先选择商户'}), 400
+    try:
+        since = parse_change_cursor(request.args.get('since'))
+    except ValueError:
+        return jsonify({'message': '查询参数无效: since'}), 400
+    purge_changes_if_due()
+    return jsonify(fetch_changes(merchant_id, since))
+
+
+# 变更流 SSE 推送：断线重连时浏览器通过 Last-Event-ID 携带上次的游标
+@app.route('/api/changes/stream', methods=['GET'])
+@login_required
+def stream_change_feed():
+    merchant_id = current_user.current_merchant_id
+    if not merchant_id:
+        return jsonify({'message': '请先选择商户'}), 400
+    try:
+        since = parse_change_cursor(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    except ValueError:
+        return jsonify({'message': '查询参数无效: since'}), 400
+    return Response(
+        stream_with_context(stream_changes(merchant_id, since)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# Excel 导出：表头定义与逐行生成器，下载接口与每日归档共用
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+EXPORT_BATCH_SIZE = 500
+STOCK_EXPORT_HEADERS = ['产品编号', '品名', '产品类别', '供应商', '香港库存', '深圳库存', '在途数量', '每日消耗', '规格', '箱数', '批次号', '过期日期', '库位']
+RECORD_EXPORT_HEADERS = ['日期', '品名', '操作类型', '库位', '数量', '规格', '总数', '批次号', '过期日期', '操作原因', '操作人']
+
+
+def iter_stock_export_rows(merchant_id=None):
+    """按批次流式读取库存（联表取产品信息，过滤零库存，不含深圳），逐行生成导出数据
+
+    merchant_id 为 None 时导出所有商户，每行首列为商户名称。
+    """
+    query = QueryOptimizer.optimize_stock_query(merchant_id, {
+        'site': 'hk',
+        'in_stock': True,
+        'include_orphans': True
+    }).order_by(Stock.merchant_id, Stock.product_id, Stock.id).yield_per(EXPORT_BATCH_SIZE)
+
+    for item in query:
+        row = [
             item.product_id,
-            product.name if product else '未知',
-            product.category if product else '未知',
-            product.supplier if product else '未知',
+            item.name or '未知',
+            item.category or '未知',
+            item.supplier or '未知',
             item.quantity,  # 香港库存
             item.shenzhen_stock,  # 深圳库存
             item.in_transit,  # 在途数量
             item.daily_consumption,  # 每日消耗
-            box_spec_info,  # 规格
-            box_quantity,  # 箱数
+            item.box_spec,  # 规格
+            item.quantity,  # 箱数
             item.batch_number,  # 批次号
-            expiry_date,  # 过期日期
-            location  # 库位
-        ])
+            item.expiry_date.strftime('%Y-%m-%d') if item.expiry_date else '无',  # 过期日期
+            item.location or '无'  # 库位
+        ]
+        if merchant_id is None:
+            row.insert(0, item.merchant_name)
+        yield row
 
-    # 保存文件
-    wb.save(filename)
 
-# 添加导出记录到Excel的函数
-def export_records_to_excel(merchant_id):
+def iter_record_export_rows(merchant_id, args=None):
+    """按批次流式读取出入库记录（联表取品名与操作人），逐行生成导出数据
+
+    args 支持与 /api/records 相同的筛选参数；日期按北京时间输出。
+    """
+    query = db.session.query(
+        Record.date,
+        Product.name,
+        Record.operation_type,
+        Record.location,
+        Record.quantity,
+        Record.box_spec,
+        Record.batch_number,
+        Record.expiry_date,
+        Record.reason,
+        User.username,
+        Record.items_expr()
+    ).outerjoin(
+        Product, Record.product_id == Product.id
+    ).outerjoin(
+        User, Record.operator_id == User.id
+    )
+    query = apply_record_filters(query, merchant_id, args or {})
+    query = query.order_by(Record.date.desc(), Record.id.desc()).yield_per(EXPORT_BATCH_SIZE)
+
+    for (date, product_name, operation_type, location, quantity, box_spec,
+         batch_number, expiry_date, reason, operator_name, items) in query:
+        quantity = quantity or 0
+        yield [
+            (date + timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S') if date else '',
+            product_name or '未知',
+            operation_type,
+            location or '无',
+            quantity,
+            box_spec or '0',
+            items or 0,
+            batch_number or '无',
+            expiry_date.strftime('%Y-%m-%d') if expiry_date else '无',
+            reason or '无',
+            operator_name or '未知'
+        ]
+
+
+def write_xlsx(target, title, headers, rows):
+    """以 write_only 模式逐行写出工作簿，内存占用与行数无关；target 可为路径或文件对象"""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    ws.append(headers)
+    for row in rows:
+        ws.append(row)
+    wb.save(target)
+
+
+def send_xlsx(download_name, title, headers, rows):
+    """边查询边生成工作簿并流式发送，首批数据在整个文件写完之前即可到达浏览器"""
+    rows = iter(rows)
+    # 先取第一行：查询出错时仍能在发送响应头之前返回错误
+    first = next(rows, None)
+    if first is not None:
+        rows = itertools.chain([first], rows)
+    response = Response(stream_with_context(iter_xlsx_chunks(title, headers, rows)), mimetype=XLSX_MIMETYPE)
+    try:
+        download_name.encode('ascii')
+        names = {'filename': download_name}
+    except UnicodeEncodeError:
+        fallback = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': fallback, 'filename*': "UTF-8''" + quote(download_name, safe="!#$&+-.^_`|~")}
+    response.headers.set('Content-Disposition', 'attachment', **names)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+# 下载库存Excel：默认当前商户，all_merchants=1 时导出所有商户
+@app.route('/api/export/stock', methods=['GET'])
+@login_required
+def download_stock_excel():
+    today_str = datetime.now().strftime('%Y%m%d')
+    try:
+        if request.args.get('all_merchants') in ('1', 'true'):
+            return send_xlsx(
+                f"所有商户_{today_str}_库存.xlsx", '所有商户库存',
+                ['商户名称'] + STOCK_EXPORT_HEADERS, iter_stock_export_rows(None)
+            )
+
+        merchant = Merchant.query.get(current_user.current_merchant_id) if current_user.current_merchant_id else None
+        if not merchant:
+            return jsonify({'message': '请先选择商户'}), 400
+        return send_xlsx(
+            f"{sanitize_filename(merchant.name)}_{today_str}_库存.xlsx", '库存',
+            STOCK_EXPORT_HEADERS, iter_stock_export_rows(merchant.id)
+        )
+    except Exception as e:
+        return jsonify({'message': f'导出库存失败: {str(e)}'}), 500
+
+
+# 下载出入库记录Excel，支持与 /api/records 相同的筛选参数（不分页）
+@app.route('/api/export/records', methods=['GET'])
+@login_required
+def download_records_excel():
+    merchant = Merchant.query.get(current_user.current_merchant_id) if current_user.current_merchant_id else None
+    if not merchant:
+        return jsonify({'message': '请先选择商户'}), 400
+    try:
+        # 提前校验日期参数，避免写入过程中才报错
+        parse_local_date_range(request.args.get('start_date'), request.args.get('end_date'))
+    except ValueError as e:
+        return jsonify({'message': f'查询参数无效: {str(e)}'}), 400
+    try:
+        today_str = datetime.now().strftime('%Y%m%d')
+        return send_xlsx(
+            f"{sanitize_filename(merchant.name)}_{today_str}_出入库记录.xlsx", '出入库记录',
+            RECORD_EXPORT_HEADERS, iter_record_export_rows(merchant.id, request.args)
+        )
+    except Exception as e:
+        return jsonify({'message': f'导出记录失败: {str(e)}'}), 500
+
+
+# 添加导出库存到Excel的函数（每日归档）
+def export_stock_to_excel(merchant_id):
     # 在无持久化文件系统的环境（如 Vercel）默认禁用归档导出
     if os.environ.get('ENABLE_ARCHIVE_EXPORT', 'false').lower() != 'true':
         return
@@ -1856,96 +2622,35 @@ def export_records_to_excel(merchant_id):
     if not merchant:
         return
 
-    # 获取出入库记录
-    records = Record.query.filter_by(merchant_id=merchant_id).all()
     # 确保导出目录存在（固定到项目根目录）
     base_dir = os.path.abspath(os.path.dirname(__file__))
     archive_dir = os.path.join(base_dir, 'Archive')
     os.makedirs(archive_dir, exist_ok=True)
     # 生成文件名（清理商户名）
     safe_name = sanitize_filename(merchant.name)
-    filename = os.path.join(archive_dir, f"{safe_name}_{datetime.now().strftime('%Y%m%d')}_出入库记录.xlsx")
+    filename = os.path.join(archive_dir, f"{safe_name}_{datetime.now().strftime('%Y%m%d')}_库存.xlsx")
 
-    # 创建Excel文件
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "出入库记录"
+    write_xlsx(filename, '库存', STOCK_EXPORT_HEADERS, iter_stock_export_rows(merchant_id))
 
-    # 修改表头为新的格式（移除单价）
-    headers = ['日期', '品名', '操作类型', '库位', '数量', '规格', '总数', '批次号', '过期日期', '操作原因', '操作人']
-    ws.append(headers)
+# 添加导出记录到Excel的函数（每日归档）
+def export_records_to_excel(merchant_id):
+    # 在无持久化文件系统的环境（如 Vercel）默认禁用归档导出
+    if os.environ.get('ENABLE_ARCHIVE_EXPORT', 'false').lower() != 'true':
+        return
+    # 获取商户名称
+    merchant = Merchant.query.get(merchant_id)
+    if not merchant:
+        return
 
-    # 添加记录数据
-    for record in records:
-        product = Product.query.get(record.product_id)
-        
-        # 提取附加信息中的各项数据
-        # 获取规格信息
-        box_spec = '0'  # 默认值为0
-        if record.additional_info and '箱规格: ' in record.additional_info:
-            box_spec = record.additional_info.split('箱规格: ')[1].split(',')[0]
-        
-        # 转换规格为数值
-        box_spec_value = float(box_spec) if box_spec.replace('.', '', 1).isdigit() else 0
-
-        # 获取数量信息
-        quantity = record.quantity if record.quantity else 0
-
-        # 计算总数
-        total = quantity * box_spec_value
-
-        # 不处理单价信息
-
-        # 提取库位信息
-        location = '无'
-        if record.additional_info and '库位: ' in record.additional_info:
-            location = record.additional_info.split('库位: ')[1].split(',')[0]
-
-        # 提取批次号信息
-        batch_number = '无'
-        if record.additional_info and '批次号: ' in record.additional_info:
-            batch_number = record.additional_info.split('批次号: ')[1].split(',')[0]
-
-        # 提取过期日期信息
-        expiry_date = '无'
-        if record.additional_info:
-            if '保质期: ' in record.additional_info:
-                expiry_date = record.additional_info.split('保质期: ')[1].split(',')[0]
-            elif '过期日期: ' in record.additional_info:
-                expiry_date = record.additional_info.split('过期日期: ')[1].split(',')[0]
-
-        # 提取操作原因
-        reason = '无'
-        if record.additional_info:
-            if record.operation_type == '入库' and '入库原因: ' in record.additional_info:
-                reason = record.additional_info.split('入库原因: ')[1].split(',')[0]
-            elif record.operation_type == '出库' and '出库原因: ' in record.additional_info:
-                reason = record.additional_info.split('出库原因: ')[1].split(',')[0]
-
-        # 安全获取操作人信息
-        operator_name = '未知'
-        if record.operator_id:
-            operator = User.query.get(record.operator_id)
-            if operator:
-                operator_name = operator.username
-
-        # 添加行数据
-        ws.append([
-            record.date.strftime('%Y-%m-%d %H:%M:%S'),
-            product.name if product else '未知',
-            record.operation_type,
-            location,
-            quantity,
-            box_spec,
-            total,
-            batch_number,
-            expiry_date,
-            reason,
-            operator_name
-        ])
+    # 确保导出目录存在（固定到项目根目录）
+    base_dir = os.path.abspath(os.path.dirname(__file__))
+    archive_dir = os.path.join(base_dir, 'Archive')
+    os.makedirs(archive_dir, exist_ok=True)
+    # 生成文件名（清理商户名）
+    safe_name = sanitize_filename(merchant.name)
+    filename = os.path.join(archive_dir, f"{safe_name}_{datetime.now().strftime('%Y%m%d')}_出入库记录.xlsx")
 
-    # 保存文件
-    wb.save(filename)
+    write_xlsx(filename, '出入库记录', RECORD_EXPORT_HEADERS, iter_record_export_rows(merchant_id))
 
 # =========================
 # 深圳仓专用 API（独立出入库与记录）
@@ -1957,24 +2662,23 @@ def get_shenzhen_stock():
     product_id = request.args.get('product_id')
     merchant_id = current_user.current_merchant_id
 
-    query = Stock.query.filter(
-        Stock.merchant_id == merchant_id,
-        Stock.location.in_(['Shenzhen', 'shenzhen']),
-        Stock.quantity > 0
-    )
-    if product_id:
-        query = query.filter(Stock.product_id == product_id)
+    rows = QueryOptimizer.optimize_stock_query(merchant_id, {
+        'site': 'shenzhen',
+        'in_stock': True,
+        'product_id': product_id,
+        'product_ids': split_id_list(request.args.get('product_ids')),
+        'include_orphans': True
+    }).order_by(Stock.id).all()
 
     items = []
-    for s in query.all():
-        product = Product.query.filter_by(id=s.product_id, merchant_id=merchant_id).first()
+    for s in rows:
         items.append({
             'id': s.id,
             'product_id': s.product_id,
-            'name': product.name if product else '',
-            'category': product.category if product else '',
-            'supplier': product.supplier if product else '',
-            'unit': product.unit if product else '',
+            'name': s.name or '',
+            'category': s.category or '',
+            'supplier': s.supplier or '',
+            'unit': s.unit or '',
             'box_spec': s.box_spec,
             'quantity': s.quantity or 0,
             'batch_number': s.batch_number or '',
@@ -2009,46 +2713,32 @@ def shenzhen_incoming():
 
     merchant_id = current_user.current_merchant_id
 
-    # 查找现有深圳库存（按产品、规格、批次、过期日期、库位）
-    stock = Stock.query.filter_by(
-        product_id=data['product_id'],
-        box_spec=data['box_spec'],
-        batch_number=data['batch_number'],
-        expiry_date=expiry_date_obj,
-        location='Shenzhen',
-        merchant_id=merchant_id
-    ).first()
+    try:
+        # 深圳库存（按产品、规格、批次、过期日期、库位）：已有行则累加，否则新建
+        stock_row = inbound_stock_row(
+            merchant_id, data['product_id'], data['box_spec'], qty,
+            data['batch_number'], expiry_date_obj, 'Shenzhen'
+        )
+        BatchOperations.upsert_stock([stock_row])
 
-    if stock:
-        stock.quantity = (stock.quantity or 0) + qty
-    else:
-        stock = Stock(
+        # 写入深圳出入库记录（仅深圳页面展示）
+        rec = ShenzhenRecord(
+            id=generate_unique_id(),
             product_id=data['product_id'],
-            box_spec=data['box_spec'],
+            operation_type='入库',
             quantity=qty,
+            box_spec=data['box_spec'],
             batch_number=data['batch_number'],
             expiry_date=expiry_date_obj,
-            location='Shenzhen',
             merchant_id=merchant_id,
-            unit_price=0.0
+            operator_id=current_user.id
         )
-        db.session.add(stock)
-
-    # 写入深圳出入库记录（仅深圳页面展示）
-    rec = ShenzhenRecord(
-        id=generateUniqueId(),
-        product_id=data['product_id'],
-        operation_type='入库',
-        quantity=qty,
-        box_spec=data['box_spec'],
-        batch_number=data['batch_number'],
-        expiry_date=expiry_date_obj,
-        merchant_id=merchant_id,
-        operator_id=current_user.id
-    )
-    db.session.add(rec)
-
-    try:
+        db.session.add(rec)
+        record_movements(merchant_id, [movement_row(stock_row, qty, MOVEMENT_INBOUND, rec.id)])
+        refresh_product_summaries(merchant_id, [data['product_id']])
+        merchant_cache.bump_version(merchant_id)
+        record_changes(merchant_id, 'stock', [data['product_id']])
+        record_changes(merchant_id, 'shenzhen_record', [rec.id])
         db.session.commit()
         return jsonify({'message': '深圳入库成功'}), 201
     except Exception as e:
@@ -2086,7 +2776,7 @@ def shenzhen_outgoing():
     query = Stock.query.filter(
         Stock.product_id == data['product_id'],
         Stock.box_spec == data['box_spec'],
-        Stock.location == 'Shenzhen',
+        Stock.site == SITE_SHENZHEN,
         Stock.merchant_id == merchant_id
     )
     if batch_number:
@@ -2104,7 +2794,7 @@ def shenzhen_outgoing():
 
     # 写入深圳出库记录
     rec = ShenzhenRecord(
-        id=generateUniqueId(),
+        id=generate_unique_id(),
         product_id=data['product_id'],
         operation_type='出库',
         quantity=qty,
@@ -2115,6 +2805,11 @@ def shenzhen_outgoing():
         operator_id=current_user.id
     )
     db.session.add(rec)
+    record_movements(merchant_id, [movement_row(stock, -qty, MOVEMENT_OUTBOUND, rec.id)])
+    refresh_product_summaries(merchant_id, [data['product_id']])
+    merchant_cache.bump_version(merchant_id)
+    record_changes(merchant_id, 'stock', [data['product_id']])
+    record_changes(merchant_id, 'shenzhen_record', [rec.id])
 
     try:
         db.session.commit()
@@ -2153,6 +2848,19 @@ def init_app():
         try:
             # 创建数据库表并初始化默认数据
             db.create_all()
+            ensure_schema()
+            # 回填顺序与 scripts/migrate_schema.py 一致：汇总表的件数与站点依赖回填结果，须在构建汇总之前完成
+            # 一次性数据迁移只检查完成标记，有待处理的历史数据时留给迁移脚本批量执行（汇总与期初流水随之由脚本构建）
+            migrated = [
+                run_data_migration('record_columns', backfill_record_columns, has_pending=record_columns_pending),
+                run_data_migration('units_per_box', backfill_units_per_box, has_pending=units_per_box_pending),
+                run_data_migration('stock_site', backfill_stock_site, has_pending=stock_site_pending),
+                # 入库依赖库存唯一索引：空库存表直接建索引，有历史重复行时由迁移脚本合并后建立
+                run_data_migration('stock_compaction', compact_stock_rows, has_pending=stock_compaction_pending),
+            ]
+            if all(migrated):
+                ensure_inventory_summaries()
+                ensure_stock_ledger()
             seed_defaults()
             # 运行一次管理员密码兼容处理（Flask 3移除before_first_request）
             ensure_admin_password_compat_seed()
@@ -0,0 +1,248 @@
+"""
+商户变更流模块
+写操作在提交前调用 record_changes 追加变更行（与数据变更同一事务），客户端据此只更新变化的数据，
+无需在每次写操作后重新下载整个列表。游标即商户数据版本号 merchant.data_version：bump_version 在事务中
+持有商户行锁，同一商户的版本号按提交顺序递增，按 since=<游标> 拉取之后的变更不会漏读。
+  - GET /api/changes?since=<游标>：增量拉取；不带 since 时只返回当前游标（先取游标再全量加载列表）
+  - GET /api/changes/stream：SSE 推送，断线后浏览器携带 Last-Event-ID 自动续传
+等待新变更时，PostgreSQL（psycopg2）上由进程内监听线程 LISTEN 唤醒；其他数据库或 LISTEN 不可用
+（如经事务模式连接池连接）时按 CHANGE_FEED_POLL_SECONDS 轮询数据库，不依赖外部消息服务。
+"""
+import json
+import os
+import select
+import threading
+import time
+from datetime import datetime, timedelta
+
+from extensions import db
+from models import ChangeEvent, Merchant
+
+CHANGE_CHANNEL = 'change_feed'
+CHANGE_UPSERT = 'upsert'
+CHANGE_DELETE = 'delete'
+# 变更行保留时长（小时），游标早于保留范围的客户端会收到 reset，需重新全量加载
+CHANGE_FEED_RETENTION_HOURS = float(os.environ.get('CHANGE_FEED_RETENTION_HOURS', '24'))
+# 无 LISTEN 时轮询数据库的间隔（秒）
+CHANGE_FEED_POLL_SECONDS = float(os.environ.get('CHANGE_FEED_POLL_SECONDS', '1'))
+# 单个 SSE 连接最长保持时间（秒），到期后由浏览器自动重连，适配 Serverless 函数执行时限
+CHANGE_FEED_STREAM_SECONDS = float(os.environ.get('CHANGE_FEED_STREAM_SECONDS', '25'))
+CHANGE_FEED_HEARTBEAT_SECONDS = 15
+# 单次增量返回的最大变更行数（同一版本的变更不会被拆开）
+CHANGE_FEED_PAGE_SIZE = 500
+# 同一进程内两次过期清理的最小间隔（秒）
+CHANGE_FEED_PURGE_INTERVAL = 3600
+
+_last_purge = 0.0
+
+
+def record_changes(merchant_id, entity, ids, action=CHANGE_UPSERT):
+    """在当前事务中追加变更行，需在 merchant_cache.bump_version 之后、提交之前调用
+
+    entity 为 stock（ids 为产品ID，表示该产品的库存行有变化）、record、product 或 shenzhen_record。
+    """
+    entity_ids = sorted({str(entity_id) for entity_id in ids if entity_id not in (None, '')})
+    if not merchant_id or not entity_ids:
+        return
+    version = db.session.query(Merchant.data_version).filter(Merchant.id == merchant_id).scalar()
+    if version is None:
+        return
+    now = datetime.now()
+    db.session.execute(db.insert(ChangeEvent), [{
+        'merchant_id': merchant_id,
+        'version': version,
+        'entity': entity,
+        'entity_id': entity_id,
+        'action': action,
+        'created_at': now
+    } for entity_id in entity_ids])
+    if db.session.get_bind().dialect.name == 'postgresql':
+        # 通知在事务提交时才投递，回滚则不会发出
+        db.session.execute(
+            db.text('SELECT pg_notify(:channel, :payload)'),
+            {'channel': CHANGE_CHANNEL, 'payload': str(merchant_id)}
+        )
+
+
+def current_cursor(merchant_id):
+    return db.session.query(Merchant.data_version).filter(Merchant.id == merchant_id).scalar()
+
+
+def fetch_changes(merchant_id, since=None, limit=CHANGE_FEED_PAGE_SIZE):
+    """返回 since 之后的变更（同一实体只保留最后一次）与新游标；游标无法续接时 reset 为 True"""
+    cursor = current_cursor(merchant_id) or 0
+    result = {'merchant_id': merchant_id, 'cursor': cursor, 'changes': [], 'has_more': False, 'reset': False}
+    if since is None:
+        return result
+    if since > cursor:
+        # 游标来自重建前的数据库或其他商户
+        result['reset'] = True
+        return result
+    if since == cursor:
+        return result
+
+    oldest = db.session.query(db.func.min(ChangeEvent.version)).filter(
+        ChangeEvent.merchant_id == merchant_id
+    ).scalar()
+    if oldest is None or oldest > since + 1:
+        # since 之后的部分变更已过期清理
+        result['reset'] = True
+        return result
+
+    base = ChangeEvent.query.filter(ChangeEvent.merchant_id == merchant_id)
+    rows = base.filter(ChangeEvent.version > since).order_by(
+        ChangeEvent.version, ChangeEvent.id
+    ).limit(limit + 1).all()
+    if len(rows) > limit:
+        overflow_version = rows[limit].version
+        kept = [row for row in rows[:limit] if row.version < overflow_version]
+        if not kept:
+            # 单个版本的变更超过一页时整版本返回
+            kept = base.filter(ChangeEvent.version == rows[0].version).order_by(ChangeEvent.id).all()
+        rows = kept
+        result['has_more'] = True
+        result['cursor'] = rows[-1].version
+    elif rows:
+        result['cursor'] = max(cursor, rows[-1].version)
+
+    latest = {}
+    for row in rows:
+        key = (row.entity, row.entity_id)
+        latest.pop(key, None)
+        latest[key] = row
+    result['changes'] = [row.to_dict() for row in latest.values()]
+    return result
+
+
+def purge_expired_changes():
+    """删除超过保留期的变更行并提交，返回删除行数"""
+    cutoff = datetime.now() - timedelta(hours=CHANGE_FEED_RETENTION_HOURS)
+    count = ChangeEvent.query.filter(
+        ChangeEvent.created_at < cutoff
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def purge_changes_if_due():
+    global _last_purge
+    now = time.monotonic()
+    if now - _last_purge < CHANGE_FEED_PURGE_INTERVAL:
+        return
+    _last_purge = now
+    try:
+        purge_expired_changes()
+    except Exception as e:
+        db.session.rollback()
+        print(f'清理过期变更失败: {e}')
+
+
+class ChangeNotifier:
+    """进程内变更通知：PostgreSQL 上由一个后台线程 LISTEN，按商户唤醒等待中的 SSE 连接"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._generations = {}
+        self._thread = None
+        self.listening = False
+
+    def ensure_started(self, engine):
+        if self._thread is not None:
+            return
+        with self._condition:
+            if self._thread is not None:
+                return
+            if engine.dialect.name != 'postgresql' or engine.dialect.driver != 'psycopg2':
+                self._thread = False
+                return
+            self._thread = threading.Thread(target=self._listen, args=(engine,), name='change-feed-listener', daemon=True)
+            self._thread.start()
+
+    def _listen(self, engine):
+        # 使用独立连接（不占用连接池），断开后每 30 秒重试一次，期间 SSE 连接退化为轮询
+        connect_args, connect_params = engine.dialect.create_connect_args(engine.url)
+        while True:
+            conn = None
+            try:
+                conn = engine.dialect.dbapi.connect(*connect_args, **connect_params)
+                conn.autocommit = True
+                conn.cursor().execute(f'LISTEN {CHANGE_CHANNEL}')
+                self.listening = True
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self.wake(int(notify.payload))
+                        except ValueError:
+                            continue
+            except Exception as e:
+                print(f'变更通知监听失败，改为轮询: {e}')
+            finally:
+                self.listening = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(30)
+
+    def generation(self, merchant_id):
+        with self._condition:
+            return self._generations.get(merchant_id, 0)
+
+    def wake(self, merchant_id):
+        with self._condition:
+            self._generations[merchant_id] = self._generations.get(merchant_id, 0) + 1
+            self._condition.notify_all()
+
+    def wait(self, merchant_id, generation, timeout):
+        with self._condition:
+            self._condition.wait_for(lambda: self._generations.get(merchant_id, 0) != generation, timeout)
+
+
+notifier = ChangeNotifier()
+
+
+def _sse(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, ensure_ascii=False)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def stream_changes(merchant_id, since=None):
+    """SSE 生成器：change 事件携带增量变更，reset 事件要求客户端全量重新加载，到期后结束连接"""
+    notifier.ensure_started(db.engine)
+    started = time.monotonic()
+    last_sent = started
+    yield f'retry: {int(CHANGE_FEED_POLL_SECONDS * 1000)}\n\n'
+    while True:
+        generation = notifier.generation(merchant_id)
+        result = fetch_changes(merchant_id, since)
+        # 不在等待期间占用数据库连接和事务
+        db.session.close()
+        if since is None or result['reset']:
+            since = result['cursor']
+            yield _sse('reset' if result['reset'] else 'ready', {'merchant_id': merchant_id, 'cursor': since, 'reset': result['reset']}, since)
+            last_sent = time.monotonic()
+        elif result['changes'] or result['cursor'] != since:
+            since = result['cursor']
+            yield _sse('change', result, since)
+            last_sent = time.monotonic()
+            if result['has_more']:
+                continue
+
+        now = time.monotonic()
+        remaining = CHANGE_FEED_STREAM_SECONDS - (now - started)
+        if remaining <= 0:
+            return
+        if now - last_sent >= CHANGE_FEED_HEARTBEAT_SECONDS:
+            yield ': keep-alive\n\n'
+            last_sent = now
+        timeout = CHANGE_FEED_HEARTBEAT_SECONDS if notifier.listening else CHANGE_FEED_POLL_SECONDS
+        notifier.wait(merchant_id, generation, min(timeout, remaining))
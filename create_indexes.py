@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 """
 数据库索引创建脚本
-用于为现有数据库添加性能优化索引
+用于为现有数据库添加性能优化索引；`python create_indexes.py audit` 只读审计现有索引并给出增删建议
 """
 import os
 import sys
+from datetime import datetime, timedelta
 from flask import Flask
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateIndex
 from extensions import db
 from models import *
 
@@ -56,7 +59,8 @@ def create_indexes():
                 "CREATE INDEX IF NOT EXISTS idx_record_operator ON record(operator_id);",
                 "CREATE INDEX IF NOT EXISTS idx_record_date_merchant ON record(date, merchant_id);",
                 "CREATE INDEX IF NOT EXISTS idx_record_product_operation ON record(product_id, operation_type);",
-                "CREATE INDEX IF NOT EXISTS idx_record_recent_duplicates ON record(product_id, operation_type, quantity, date);",
+                # 防重复提交改由幂等键表实现，删除旧的一分钟查重索引
+                "DROP INDEX IF EXISTS idx_record_recent_duplicates;",
                 
                 # User表索引
                 "CREATE INDEX IF NOT EXISTS idx_user_merchant ON \"user\"(current_merchant_id);",
@@ -66,6 +70,8 @@ def create_indexes():
                 "CREATE INDEX IF NOT EXISTS idx_shenzhen_record_date ON shenzhen_record(date);",
                 "CREATE INDEX IF NOT EXISTS idx_shenzhen_record_product ON shenzhen_record(product_id);",
             ]
+            # 有库存行的部分索引（依赖 stock.site 列，需先运行 scripts/migrate_schema.py）
+            indexes += [partial_index_sql(index, engine.dialect) for index in RECOMMENDED_PARTIAL_INDEXES]
             
             # 执行索引创建
             with engine.connect() as conn:
@@ -85,6 +91,248 @@ def create_indexes():
             print(f"❌ 创建索引时发生错误: {str(e)}")
             sys.exit(1)
 
+# 应用中的高频查询（参数在审计时按库中实际数据填充），用于检查执行计划是否走索引
+HOT_QUERIES = [
+    ('库存列表 /api/stock',
+     "SELECT * FROM stock WHERE merchant_id = :merchant_id AND site = 'hk' AND quantity > 0 ORDER BY id"),
+    ('出库候选库存行 /api/outgoing/allocate',
+     "SELECT * FROM stock WHERE merchant_id = :merchant_id AND site = 'hk' AND product_id = :product_id "
+     "AND quantity > 0 ORDER BY id"),
+    ('汇总刷新 refresh_product_summaries',
+     "SELECT product_id, SUM(quantity), COUNT(id) FROM stock "
+     "WHERE merchant_id = :merchant_id AND product_id = :product_id AND quantity > 0 GROUP BY product_id"),
+    ('仪表盘临期库存 /api/dashboard',
+     "SELECT product_id, box_spec, quantity, expiry_date FROM stock "
+     "WHERE merchant_id = :merchant_id AND site = 'hk' AND quantity > 0 AND expiry_date <= :expiry_before"),
+    ('深圳库存 /api/shenzhen/stock',
+     "SELECT * FROM stock WHERE merchant_id = :merchant_id AND site = 'shenzhen' AND quantity > 0"),
+    ('出入库记录分页 /api/records',
+     "SELECT * FROM record WHERE merchant_id = :merchant_id ORDER BY date DESC, id DESC LIMIT 50"),
+    ('按日期筛选记录 /api/records?start_date',
+     "SELECT * FROM record WHERE merchant_id = :merchant_id AND date >= :since ORDER BY date DESC, id DESC LIMIT 50"),
+    ('按产品筛选记录 /api/records?product_id',
+     "SELECT * FROM record WHERE merchant_id = :merchant_id AND product_id = :product_id ORDER BY date DESC, id DESC LIMIT 50"),
+    ('仪表盘出入库概览 /api/dashboard',
+     "SELECT operation_type, SUM(quantity) FROM record WHERE merchant_id = :merchant_id AND date >= :since GROUP BY operation_type"),
+    ('产品库存概览 /api/stock/summary',
+     "SELECT * FROM product_inventory_summary WHERE merchant_id = :merchant_id ORDER BY product_id"),
+    ('产品列表 /api/products',
+     "SELECT * FROM product WHERE merchant_id = :merchant_id"),
+]
+
+def _is_partial(index):
+    return any(index.dialect_options[dialect].get('where') is not None for dialect in ('postgresql', 'sqlite'))
+
+
+# 部分索引直接取自 models 中 Stock/Record 声明的索引（带 postgresql_where/sqlite_where 的），不另行维护：
+# 库存查询几乎都带 quantity > 0，零库存行不必进入索引；PostgreSQL 上带 INCLUDE 列，可只扫描索引
+RECOMMENDED_PARTIAL_INDEXES = [
+    index
+    for model in (Stock, Record)
+    for index in sorted(model.__table__.indexes, key=lambda index: index.name)
+    if _is_partial(index)
+]
+
+
+def partial_index_sql(index, dialect):
+    """按方言编译模型中声明的部分索引的建表语句（WHERE 与 INCLUDE 随方言取舍）"""
+    return f"{CreateIndex(index, if_not_exists=True).compile(dialect=dialect)};"
+
+# 单列索引的取值种类不超过该数且表行数达到 LOW_SELECTIVITY_MIN_ROWS 时视为低选择性
+LOW_SELECTIVITY_MAX_DISTINCT = 5
+LOW_SELECTIVITY_MIN_ROWS = 100
+
+
+def _index_where(index):
+    options = index.get('dialect_options') or {}
+    where = options.get('postgresql_where') or options.get('sqlite_where')
+    return str(where) if where is not None else None
+
+
+def list_table_indexes(inspector, table_name):
+    """返回表上的索引（含主键与唯一约束）：[{name, columns, unique, where, kind}]"""
+    entries = []
+    pk = inspector.get_pk_constraint(table_name)
+    if pk and pk.get('constrained_columns'):
+        entries.append({'name': pk.get('name') or f'{table_name}_pkey', 'columns': pk['constrained_columns'],
+                        'unique': True, 'where': None, 'kind': 'primary'})
+    for constraint in inspector.get_unique_constraints(table_name):
+        entries.append({'name': constraint['name'], 'columns': constraint['column_names'],
+                        'unique': True, 'where': None, 'kind': 'unique'})
+    constraint_names = {entry['name'] for entry in entries}
+    for index in inspector.get_indexes(table_name):
+        if index['name'] in constraint_names:
+            continue
+        entries.append({'name': index['name'], 'columns': list(index['column_names']),
+                        'unique': bool(index.get('unique')), 'where': _index_where(index), 'kind': 'index'})
+    return entries
+
+
+def find_redundant_indexes(entries):
+    """找出被其他索引左前缀覆盖或完全重复的普通索引：[(索引, 覆盖它的索引)]"""
+    redundant = []
+    for index in entries:
+        if index['kind'] != 'index' or index['unique'] or None in index['columns']:
+            continue
+        for other in entries:
+            if other is index or other['where'] != index['where'] or None in other['columns']:
+                continue
+            width = len(index['columns'])
+            if other['columns'][:width] != index['columns']:
+                continue
+            # 列完全相同的两个普通索引只标记名称靠后的一个
+            if len(other['columns']) == width and other['kind'] == 'index' and not other['unique'] \
+                    and other['name'] > index['name']:
+                continue
+            redundant.append((index, other))
+            break
+    return redundant
+
+
+def find_low_selectivity_indexes(conn, table_name, entries, foreign_key_columns=()):
+    """找出取值种类很少的单列普通索引（如 operation_type），这类索引很少被选用却拖慢写入
+
+    外键列上的索引用于删除父表行时查找子表，不在此列。
+    """
+    result = []
+    for index in entries:
+        if index['kind'] != 'index' or index['unique'] or index['where'] or len(index['columns']) != 1:
+            continue
+        column = index['columns'][0]
+        if column is None or column in foreign_key_columns:
+            continue
+        distinct, total = conn.execute(db.text(
+            f'SELECT COUNT(DISTINCT {column}), COUNT(*) FROM "{table_name}"'
+        )).one()
+        if total >= LOW_SELECTIVITY_MIN_ROWS and distinct <= LOW_SELECTIVITY_MAX_DISTINCT:
+            result.append((index, distinct, total))
+    return result
+
+
+def sample_query_params(conn):
+    """从库中取一个有库存的商户与产品作为高频查询的参数"""
+    row = conn.execute(db.text(
+        'SELECT merchant_id, product_id FROM stock WHERE quantity > 0 ORDER BY id LIMIT 1'
+    )).first()
+    today = datetime.now()
+    return {
+        'merchant_id': row[0] if row else 1,
+        'product_id': row[1] if row else '',
+        'expiry_before': (today + timedelta(days=360)).date(),
+        'since': today - timedelta(days=30),
+    }
+
+
+def explain_query(conn, sql, params):
+    """返回 (执行计划文本行, 是否存在全表扫描)"""
+    if conn.dialect.name == 'postgresql':
+        lines = [row[0] for row in conn.execute(db.text('EXPLAIN ANALYZE ' + sql), params)]
+        full_scan = any('Seq Scan' in line for line in lines)
+    else:
+        lines = [row[-1] for row in conn.execute(db.text('EXPLAIN QUERY PLAN ' + sql), params)]
+        full_scan = any(line.startswith('SCAN ') and ' USING ' not in line for line in lines)
+    return lines, full_scan
+
+
+def audit_indexes():
+    """审计索引：列出各表索引，标记冗余与低选择性索引，检查高频查询执行计划并给出增删建议（只读）"""
+    app = create_app()
+
+    with app.app_context():
+        engine = db.engine
+        inspector = inspect(engine)
+        tables = [name for name in ('stock', 'record', 'product', 'shenzhen_record', 'product_inventory_summary')
+                  if name in inspector.get_table_names()]
+        drops = []
+        with engine.connect() as conn:
+            print("\n📋 现有索引:")
+            entries_by_table = {}
+            for table_name in tables:
+                entries = list_table_indexes(inspector, table_name)
+                entries_by_table[table_name] = entries
+                print(f"  {table_name}（{len(entries)} 个）")
+                for index in entries:
+                    flags = [index['kind']] if index['kind'] != 'index' else []
+                    if index['unique'] and index['kind'] == 'index':
+                        flags.append('unique')
+                    if index['where']:
+                        flags.append(f"WHERE {index['where']}")
+                    suffix = f"  [{', '.join(flags)}]" if flags else ''
+                    print(f"    - {index['name']} ({', '.join(str(c) for c in index['columns'])}){suffix}")
+
+            print("\n🔁 冗余索引（被其他索引左前缀覆盖）:")
+            found = False
+            for table_name, entries in entries_by_table.items():
+                for index, other in find_redundant_indexes(entries):
+                    found = True
+                    drops.append(index['name'])
+                    print(f"  {table_name}.{index['name']} ({', '.join(index['columns'])}) "
+                          f"被 {other['name']} ({', '.join(other['columns'])}) 覆盖")
+            if not found:
+                print("  无")
+
+            print("\n📉 低选择性单列索引:")
+            found = False
+            for table_name, entries in entries_by_table.items():
+                foreign_key_columns = {
+                    column for fk in inspector.get_foreign_keys(table_name) for column in fk['constrained_columns']
+                }
+                for index, distinct, total in find_low_selectivity_indexes(conn, table_name, entries, foreign_key_columns):
+                    found = True
+                    if index['name'] not in drops:
+                        drops.append(index['name'])
+                    print(f"  {table_name}.{index['name']} ({index['columns'][0]})：{total} 行中只有 {distinct} 种取值")
+            if not found:
+                print("  无")
+
+            print("\n🔍 高频查询执行计划:")
+            params = sample_query_params(conn)
+            slow = []
+            for name, sql in HOT_QUERIES:
+                table_name = sql.split(' FROM ')[1].split()[0]
+                if table_name not in tables:
+                    continue
+                try:
+                    lines, full_scan = explain_query(conn, sql, params)
+                except Exception as e:
+                    print(f"  {name}: 无法获取执行计划（{e}）")
+                    conn.rollback()
+                    continue
+                marker = '⚠️ 全表扫描' if full_scan else '✅'
+                print(f"  {marker} {name}")
+                for line in lines:
+                    print(f"      {line}")
+                if full_scan:
+                    slow.append(name)
+
+            additions = []
+            for index in RECOMMENDED_PARTIAL_INDEXES:
+                table_name, name, columns = index.table.name, index.name, [column.name for column in index.columns]
+                if table_name not in tables:
+                    continue
+                exists = any(
+                    index['name'] == name or (index['columns'][:len(columns)] == columns and index['where'])
+                    for index in entries_by_table[table_name]
+                )
+                if not exists:
+                    additions.append(partial_index_sql(index, conn.dialect))
+
+        print("\n💡 索引建议:")
+        if drops:
+            print("  可删除（每个索引都会拖慢库存/记录的每次写入）:")
+            for name in drops:
+                print(f"    DROP INDEX IF EXISTS {name};")
+        if additions:
+            print("  可新增（部分索引只收录有库存的行，更小且与查询条件一致）:")
+            for statement in additions:
+                print(f"    {statement}")
+        if slow:
+            print(f"  以下查询仍为全表扫描，请检查筛选列是否有索引: {'、'.join(slow)}")
+        if not drops and not additions and not slow:
+            print("  当前索引与高频查询匹配，无需调整")
+        print("  （审计只读，不会修改数据库；删除前请确认模型 models.py 中未再声明同名索引，否则下次迁移会重新创建）")
+
+
 def analyze_database():
     """分析数据库性能"""
     app = create_app()
@@ -125,6 +373,8 @@ if __name__ == '__main__':
     
     if len(sys.argv) > 1 and sys.argv[1] == 'analyze':
         analyze_database()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'audit':
+        audit_indexes()
     else:
         create_indexes()
         analyze_database()
@@ -0,0 +1,177 @@
+"""
+写操作幂等键模块
+客户端在入库/出库请求头中携带 Idempotency-Key（每次提交生成一个，网络重试时复用），
+服务端以 (用户, 键) 唯一约束登记：首次请求正常执行，视图以 commit_and_respond() 提交，
+键的完成状态与响应随业务写入在同一事务内保存，重试直接返回原响应；
+并发的同键请求只有一个能登记成功，处理中的键在保留期内不会被重新执行；超过保留期的键在后续请求中顺带清理。
+"""
+import hashlib
+import os
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, g, jsonify, request
+from flask_login import current_user
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_KEY_MAX_LENGTH = 100
+# 幂等键保留时长（小时），超过后同一键视为新请求
+IDEMPOTENCY_TTL_HOURS = float(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24'))
+# 同一进程内两次过期清理的最小间隔（秒）
+IDEMPOTENCY_PURGE_INTERVAL = 3600
+
+_last_purge = 0.0
+
+
+def purge_expired_keys():
+    """删除超过保留期的幂等键并提交，返回删除行数"""
+    cutoff = datetime.now() - timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+    count = IdempotencyKey.query.filter(
+        IdempotencyKey.created_at < cutoff
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def _purge_if_due():
+    global _last_purge
+    now = time.monotonic()
+    if now - _last_purge < IDEMPOTENCY_PURGE_INTERVAL:
+        return
+    _last_purge = now
+    try:
+        purge_expired_keys()
+    except Exception as e:
+        db.session.rollback()
+        print(f'清理过期幂等键失败: {e}')
+
+
+def _error(message, status):
+    return jsonify({'error': True, 'success': False, 'message': message}), status
+
+
+def _claim(user_id, key, endpoint, request_hash):
+    """登记幂等键：返回 (键ID, None) 表示首次执行，返回 (None, 响应) 表示不再执行视图"""
+    entry = IdempotencyKey.query.filter_by(user_id=user_id, key=key).first()
+    if entry is None:
+        try:
+            entry = IdempotencyKey(
+                user_id=user_id,
+                key=key,
+                endpoint=endpoint,
+                request_hash=request_hash,
+                status='pending'
+            )
+            db.session.add(entry)
+            db.session.flush()
+            entry_id = entry.id
+            db.session.commit()
+            return entry_id, None
+        except IntegrityError:
+            # 并发的同键请求已先登记，以已存在的记录为准
+            db.session.rollback()
+            entry = IdempotencyKey.query.filter_by(user_id=user_id, key=key).first()
+            if entry is None:
+                return None, _error('相同的请求正在处理中，请稍后再试', 409)
+
+    now = datetime.now()
+    if entry.created_at < now - timedelta(hours=IDEMPOTENCY_TTL_HOURS):
+        # 超过保留期的键视为新请求：条件更新重新登记，更新行数为 1 才算取得执行权
+        entry_id = entry.id
+        claimed = IdempotencyKey.query.filter(
+            IdempotencyKey.id == entry_id,
+            IdempotencyKey.created_at == entry.created_at
+        ).update({
+            'endpoint': endpoint,
+            'request_hash': request_hash,
+            'status': 'pending',
+            'response_status': None,
+            'response_body': None,
+            'created_at': now
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return entry_id, None
+        return None, _error('相同的请求正在处理中，请稍后再试', 409)
+
+    if entry.endpoint != endpoint or entry.request_hash != request_hash:
+        return None, _error(f'{IDEMPOTENCY_HEADER} 已用于另一个请求，请为新的提交生成新的键', 422)
+    if entry.status == 'done':
+        response = current_app.response_class(
+            entry.response_body,
+            status=entry.response_status,
+            mimetype='application/json'
+        )
+        response.headers['Idempotent-Replayed'] = 'true'
+        return None, response
+    # 处理中（或执行进程在提交前退出）的键在保留期内不重新执行，避免重复写入
+    return None, _error('相同的请求正在处理中，请稍后再试', 409)
+
+
+def commit_and_respond(payload, status=200):
+    """写操作视图的提交出口：提交业务写入并返回 JSON 响应；
+    请求携带幂等键时，键的完成状态与响应在同一事务内写入，提交成功即不会被重复执行"""
+    response = current_app.make_response((jsonify(payload), status))
+    entry_id = g.get('idempotency_entry_id')
+    if entry_id is not None:
+        IdempotencyKey.query.filter(IdempotencyKey.id == entry_id).update({
+            'status': 'done',
+            'response_status': response.status_code,
+            'response_body': response.get_data(as_text=True)
+        }, synchronize_session=False)
+    db.session.commit()
+    g.idempotency_completed = True
+    return response
+
+
+def _finish(entry_id, response):
+    """视图未经 commit_and_respond 提交时收尾：无写入的成功响应（如预览）照常保存；
+    失败响应不保存并释放键（失败请求已回滚，可安全重试）"""
+    if g.pop('idempotency_completed', False):
+        return
+    query = IdempotencyKey.query.filter(IdempotencyKey.id == entry_id)
+    if response is not None and 200 <= response.status_code < 300:
+        query.update({
+            'status': 'done',
+            'response_status': response.status_code,
+            'response_body': response.get_data(as_text=True)
+        }, synchronize_session=False)
+    else:
+        query.delete(synchronize_session=False)
+    db.session.commit()
+
+
+def idempotent(view):
+    """写操作视图装饰器：请求携带 Idempotency-Key 时保证同一键只执行一次；未携带时直接执行"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (request.headers.get(IDEMPOTENCY_HEADER) or '').strip()
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return _error(f'{IDEMPOTENCY_HEADER} 过长（最多 {IDEMPOTENCY_KEY_MAX_LENGTH} 个字符）', 400)
+
+        _purge_if_due()
+        request_hash = hashlib.sha256(request.get_data()).hexdigest()
+        entry_id, replay = _claim(current_user.id, key, request.endpoint, request_hash)
+        if replay is not None:
+            return replay
+
+        response = None
+        g.idempotency_entry_id = entry_id
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+            return response
+        finally:
+            g.pop('idempotency_entry_id', None)
+            try:
+                _finish(entry_id, response)
+            except Exception as e:
+                db.session.rollback()
+                print(f'保存幂等键结果失败: {e}')
+    return wrapper
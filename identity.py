@@ -0,0 +1,130 @@
+"""
+登录身份缓存模块
+Flask-Login 每个请求都会调用 user_loader 加载当前用户，这里把用户解析为轻量的 UserPrincipal
+（ID、用户名、管理员标记、当前商户、权限集合）并在缓存中保留很短的时间，命中时请求不再查询用户表。
+缓存复用 Flask-Caching 后端（CACHE_TYPE=redis 时多实例共享失效）；切换商户、修改权限、删除用户后
+调用 invalidate 立即失效，其余情况下最多在 USER_CACHE_TTL_SECONDS 秒后重新加载。
+默认的进程内缓存只能使本实例失效，因此：
+  - 写请求不读缓存，始终按数据库中的当前商户与权限执行（写入归属由当前商户决定）
+  - 切换商户时把新商户记入会话（签名 Cookie，各实例共享），缓存身份的当前商户与会话不符时重新加载
+"""
+import os
+
+from flask import has_request_context, request, session
+from flask_login import UserMixin
+
+from extensions import db
+from permissions import user_permissions
+
+# 身份缓存时长（秒），设为 0 时每个请求都从数据库加载用户
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', '30'))
+# 写请求方法：加载身份时跳过缓存
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+SESSION_MERCHANT_KEY = 'identity_merchant_id'
+
+
+def remember_merchant(merchant_id):
+    """登录或切换商户后在会话中记录当前商户，其他实例上缓存的旧身份据此失效"""
+    if has_request_context():
+        session[SESSION_MERCHANT_KEY] = merchant_id
+
+
+def _cached_identity_usable(principal):
+    if not has_request_context():
+        return True
+    if request.method in WRITE_METHODS:
+        return False
+    return session.get(SESSION_MERCHANT_KEY, principal.current_merchant_id) == principal.current_merchant_id
+
+
+class UserPrincipal(UserMixin):
+    """请求期间代表已登录用户的只读身份，不绑定数据库会话；需要修改用户时按 ID 更新 User 表"""
+
+    def __init__(self, id, username, is_admin, current_merchant_id, permissions_version, permissions):
+        self.id = id
+        self.username = username
+        self.is_admin = bool(is_admin)
+        self.current_merchant_id = current_merchant_id
+        self.permissions_version = permissions_version or 0
+        self.permissions = frozenset(permissions)
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(
+            user.id,
+            user.username,
+            user.is_admin,
+            user.current_merchant_id,
+            user.permissions_version,
+            user_permissions(user)
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'username': self.username,
+            'is_admin': self.is_admin,
+            'current_merchant_id': self.current_merchant_id,
+            'permissions_version': self.permissions_version,
+            'permissions': sorted(self.permissions)
+        }
+
+    def permission_names(self):
+        return self.permissions
+
+    def has_permission(self, permission_name):
+        return permission_name in self.permissions
+
+
+class IdentityCache:
+    """短时身份缓存：缓存后端不可用时退化为直接查询数据库"""
+
+    def __init__(self, cache=None, ttl=USER_CACHE_TTL_SECONDS):
+        self.cache = cache
+        self.ttl = ttl
+
+    @staticmethod
+    def make_key(user_id):
+        return f'identity:{user_id}'
+
+    def load(self, user_id):
+        """按 ID 返回 UserPrincipal，用户不存在时返回 None；写请求或缓存身份与会话中的当前商户不符时读数据库"""
+        from models import User
+
+        user_id = int(user_id)
+        key = self.make_key(user_id)
+        if self.cache is not None and self.ttl > 0:
+            try:
+                data = self.cache.get(key)
+                if data is not None:
+                    principal = UserPrincipal.from_dict(data)
+                    if _cached_identity_usable(principal):
+                        return principal
+            except Exception as e:
+                print(f'读取身份缓存失败: {e}')
+
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        principal = UserPrincipal.from_user(user)
+        if self.cache is not None and self.ttl > 0:
+            try:
+                self.cache.set(key, principal.to_dict(), timeout=self.ttl)
+            except Exception as e:
+                print(f'写入身份缓存失败: {e}')
+        return principal
+
+    def invalidate(self, *user_ids):
+        """删除用户的身份缓存，需在相关修改提交之后调用"""
+        if self.cache is None:
+            return
+        for user_id in {user_id for user_id in user_ids if user_id}:
+            try:
+                self.cache.delete(self.make_key(user_id))
+            except Exception as e:
+                print(f'清除身份缓存失败: {e}')
+
@@ -0,0 +1,168 @@
+"""
+产品库存汇总表维护模块
+库存变更后、提交前调用 refresh_product_summaries(商户ID, 产品ID列表)，在同一事务内按产品重新聚合库存行
+并写入 product_inventory_summary；rebuild_summaries / verify_summaries 供命令行全量重建与漂移校验。
+"""
+from datetime import datetime
+
+from extensions import db
+from models import ProductInventorySummary, Stock
+from utils import SITE_SHENZHEN
+
+SUMMARY_FIELDS = ('hk_boxes', 'hk_items', 'hk_batches', 'daily_consumption', 'shenzhen_boxes', 'shenzhen_items')
+EMPTY_SUMMARY = {
+    'hk_boxes': 0,
+    'hk_items': 0.0,
+    'hk_batches': 0,
+    'daily_consumption': None,
+    'shenzhen_boxes': 0,
+    'shenzhen_items': 0.0,
+}
+
+
+def _upsert(rows, update_columns):
+    """按 (product_id, merchant_id) 批量插入或更新汇总行"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        for row in rows:
+            db.session.merge(ProductInventorySummary(**row))
+        db.session.flush()
+        return
+    stmt = insert(ProductInventorySummary)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['product_id', 'merchant_id'],
+        set_={column: stmt.excluded[column] for column in update_columns}
+    )
+    db.session.execute(stmt, rows)
+
+
+def compute_summaries(merchant_id=None, product_ids=None):
+    """从库存行聚合汇总数据（仅统计数量>0 的行），返回 {(商户ID, 产品ID): 字段字典}"""
+    is_shenzhen = db.case((Stock.site == SITE_SHENZHEN, 1), else_=0)
+    query = db.session.query(
+        Stock.merchant_id,
+        Stock.product_id,
+        is_shenzhen,
+        db.func.sum(Stock.quantity),
+        db.func.sum(Stock.items_expr()),
+        db.func.count(Stock.id),
+        db.func.max(Stock.daily_consumption)
+    ).filter(
+        Stock.quantity > 0,
+        Stock.product_id.isnot(None)
+    )
+    if merchant_id is not None:
+        query = query.filter(Stock.merchant_id == merchant_id)
+    if product_ids is not None:
+        query = query.filter(Stock.product_id.in_(list(product_ids)))
+    query = query.group_by(Stock.merchant_id, Stock.product_id, is_shenzhen)
+
+    summaries = {}
+    for row_merchant_id, product_id, shenzhen, boxes, items, batches, daily in query:
+        summary = summaries.setdefault((row_merchant_id, product_id), dict(EMPTY_SUMMARY))
+        boxes = int(boxes or 0)
+        items = float(items or 0)
+        if shenzhen:
+            summary['shenzhen_boxes'] += boxes
+            summary['shenzhen_items'] += items
+        else:
+            summary['hk_boxes'] += boxes
+            summary['hk_items'] += items
+            summary['hk_batches'] += batches
+            if daily is not None:
+                summary['daily_consumption'] = max(summary['daily_consumption'] or 0.0, float(daily))
+    return summaries
+
+
+def refresh_product_summaries(merchant_id, product_ids):
+    """重新计算指定产品的汇总行（不提交，需在库存变更之后、提交之前调用）"""
+    product_ids = sorted({product_id for product_id in product_ids if product_id})
+    if not merchant_id or not product_ids:
+        return
+    db.session.flush()
+    now = datetime.now()
+    # 先写入/触碰汇总行以取得行锁：并发事务对同一产品的刷新因此串行，聚合时能看到前一事务已提交的库存
+    _upsert([
+        dict(EMPTY_SUMMARY, product_id=product_id, merchant_id=merchant_id, updated_at=now)
+        for product_id in product_ids
+    ], ['updated_at'])
+    fresh = compute_summaries(merchant_id, product_ids)
+    _upsert([
+        dict(fresh.get((merchant_id, product_id), EMPTY_SUMMARY),
+             product_id=product_id, merchant_id=merchant_id, updated_at=now)
+        for product_id in product_ids
+    ], SUMMARY_FIELDS + ('updated_at',))
+
+
+def delete_product_summaries(product_id):
+    """删除产品时同步删除其汇总行（不提交）"""
+    ProductInventorySummary.query.filter_by(product_id=product_id).delete(synchronize_session=False)
+
+
+def delete_merchant_summaries(merchant_id):
+    """删除商户时同步删除其全部汇总行（不提交）"""
+    ProductInventorySummary.query.filter_by(merchant_id=merchant_id).delete(synchronize_session=False)
+
+
+def rebuild_summaries(merchant_id=None):
+    """全量重建汇总表（可限定商户）并提交，返回写入行数"""
+    fresh = compute_summaries(merchant_id)
+    query = ProductInventorySummary.query
+    if merchant_id is not None:
+        query = query.filter(ProductInventorySummary.merchant_id == merchant_id)
+    query.delete(synchronize_session=False)
+    now = datetime.now()
+    rows = [
+        dict(summary, merchant_id=row_merchant_id, product_id=product_id, updated_at=now)
+        for (row_merchant_id, product_id), summary in fresh.items()
+    ]
+    if rows:
+        db.session.execute(db.insert(ProductInventorySummary), rows)
+    db.session.commit()
+    return len(rows)
+
+
+def _same(expected, actual):
+    if expected is None or actual is None:
+        return (expected or 0) == (actual or 0)
+    return abs(float(expected) - float(actual)) < 1e-6
+
+
+def verify_summaries(merchant_id=None):
+    """对比汇总表与库存实时聚合结果，返回漂移列表 [{merchant_id, product_id, field, expected, actual}]"""
+    expected = compute_summaries(merchant_id)
+    query = ProductInventorySummary.query
+    if merchant_id is not None:
+        query = query.filter(ProductInventorySummary.merchant_id == merchant_id)
+    stored = {(row.merchant_id, row.product_id): row for row in query}
+
+    drift = []
+    for key in sorted(set(expected) | set(stored), key=lambda item: (item[0], item[1])):
+        summary = expected.get(key, EMPTY_SUMMARY)
+        row = stored.get(key)
+        for field in SUMMARY_FIELDS:
+            actual = getattr(row, field) if row is not None else None
+            if row is None and summary[field] in (0, 0.0, None):
+                continue
+            if not _same(summary[field], actual):
+                drift.append({
+                    'merchant_id': key[0],
+                    'product_id': key[1],
+                    'field': field,
+                    'expected': summary[field],
+                    'actual': actual
+                })
+    return drift
+
+
+def ensure_inventory_summaries():
+    """汇总表为空而库存不为空时（首次部署或新建表后）执行一次全量重建"""
+    has_summary = db.session.query(ProductInventorySummary.product_id).limit(1).first() is not None
+    has_stock = db.session.query(Stock.id).filter(Stock.quantity > 0).limit(1).first() is not None
+    if not has_summary and has_stock:
+        count = rebuild_summaries()
+        print(f'已重建产品库存汇总 {count} 行')
@@ -0,0 +1,153 @@
+"""
+后台任务模块
+任务持久化在 background_job 表中，通过去重键保证幂等入队；
+既可由线程池在应用进程内执行，也可由 scripts/run_jobs.py 以命令行方式执行（适合定时任务）。
+"""
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models import BackgroundJob
+
+# 失败任务最多重试次数（重新入队时检查）
+JOB_MAX_ATTEMPTS = 3
+# 运行中超过该时长视为执行进程已退出，重新置为待执行
+JOB_STALE_MINUTES = 15
+
+# 任务类型 -> 处理函数，处理函数接收 BackgroundJob，抛出异常即视为失败
+JOB_HANDLERS = {}
+
+
+def register_job_handler(job_type):
+    """注册任务处理函数的装饰器"""
+    def decorator(func):
+        JOB_HANDLERS[job_type] = func
+        return func
+    return decorator
+
+
+def enqueue_job(job_type, dedupe_key, merchant_id=None, run_date=None):
+    """按去重键幂等入队：已存在则直接返回原任务，失败且未超过重试次数的任务重新置为待执行"""
+    job = BackgroundJob.query.filter_by(dedupe_key=dedupe_key).first()
+    if job is None:
+        try:
+            job = BackgroundJob(
+                job_type=job_type,
+                dedupe_key=dedupe_key,
+                merchant_id=merchant_id,
+                run_date=run_date,
+                status='pending',
+                attempts=0
+            )
+            db.session.add(job)
+            db.session.commit()
+        except IntegrityError:
+            # 并发入队时唯一约束冲突，以已存在的任务为准
+            db.session.rollback()
+            job = BackgroundJob.query.filter_by(dedupe_key=dedupe_key).first()
+    elif job.status == 'failed' and job.attempts < JOB_MAX_ATTEMPTS:
+        job.status = 'pending'
+        job.error = None
+        db.session.commit()
+    return job
+
+
+def delete_merchant_jobs(merchant_id):
+    """删除商户时同步删除其后台任务（不提交）"""
+    BackgroundJob.query.filter_by(merchant_id=merchant_id).delete(synchronize_session=False)
+
+
+def requeue_stale_jobs(stale_minutes=JOB_STALE_MINUTES):
+    """将长时间停留在运行中的任务重新置为待执行，返回处理数量"""
+    deadline = datetime.now() - timedelta(minutes=stale_minutes)
+    count = BackgroundJob.query.filter(
+        BackgroundJob.status == 'running',
+        BackgroundJob.started_at < deadline
+    ).update({'status': 'pending'}, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def claim_next_job():
+    """领取最早的待执行任务：条件更新 pending -> running，更新行数为 1 才算领取成功"""
+    while True:
+        job_id = db.session.query(BackgroundJob.id).filter(
+            BackgroundJob.status == 'pending'
+        ).order_by(BackgroundJob.id).limit(1).scalar()
+        if job_id is None:
+            return None
+        claimed = BackgroundJob.query.filter(
+            BackgroundJob.id == job_id,
+            BackgroundJob.status == 'pending'
+        ).update({
+            'status': 'running',
+            'started_at': datetime.now(),
+            'attempts': BackgroundJob.attempts + 1
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return db.session.get(BackgroundJob, job_id)
+
+
+def run_job(job):
+    """执行单个已领取的任务并记录结果"""
+    handler = JOB_HANDLERS.get(job.job_type)
+    try:
+        if handler is None:
+            raise ValueError(f'未注册的任务类型: {job.job_type}')
+        handler(job)
+        job.status = 'done'
+        job.error = None
+    except Exception as e:
+        db.session.rollback()
+        print(f'后台任务 {job.id}（{job.job_type}）执行失败: {e}')
+        job.status = 'failed'
+        job.error = f'{e}\n{traceback.format_exc()}'[-2000:]
+    job.finished_at = datetime.now()
+    db.session.commit()
+    return job.status
+
+
+def run_pending_jobs(max_jobs=None):
+    """依次领取并执行待执行任务，直到队列为空或达到 max_jobs，返回执行数量"""
+    requeue_stale_jobs()
+    count = 0
+    while max_jobs is None or count < max_jobs:
+        job = claim_next_job()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+
+class JobExecutor:
+    """进程内线程池执行器：入队后唤醒，在后台线程中清空待执行队列"""
+
+    def __init__(self, app, max_workers=1):
+        self.app = app
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job-worker')
+        self._lock = threading.Lock()
+        self._draining = False
+
+    def wake(self):
+        """提交一次队列清理；已有线程在清理时不重复提交"""
+        with self._lock:
+            if self._draining:
+                return
+            self._draining = True
+        self._pool.submit(self._drain)
+
+    def _drain(self):
+        try:
+            with self.app.app_context():
+                run_pending_jobs()
+        except Exception as e:
+            print(f'后台任务执行器异常: {e}')
+        finally:
+            with self._lock:
+                self._draining = False
@@ -0,0 +1,337 @@
+"""
+数据库结构升级模块
+db.create_all() 只会创建缺失的表，不会为已有表补充新列或新索引，
+这里负责在线补齐列/索引，并对历史数据做一次性回填。
+回填与整理由 scripts/migrate_schema.py 批量执行，完成后在 data_migration 表中记录标记；
+应用启动时只检查标记，仅在没有待处理数据时（如新建的数据库）顺带记录，不在冷启动中做批量回填。
+"""
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models import DataMigration, Record, ShenzhenRecord, Stock
+from utils import parse_record_info, parse_units_per_box, site_for_location
+
+
+# 需要在已有表上补齐的列：表名 -> [(列名, DDL 类型)]
+ADDED_COLUMNS = {
+    'merchant': [
+        ('data_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ],
+    'user': [
+        ('permissions_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ],
+    'stock': [
+        ('units_per_box', 'FLOAT'),
+        ('site', 'VARCHAR(20)'),
+    ],
+    'shenzhen_record': [
+        ('units_per_box', 'FLOAT'),
+    ],
+    'record': [
+        ('box_spec', 'VARCHAR(50)'),
+        ('batch_number', 'VARCHAR(50)'),
+        ('expiry_date', 'DATE'),
+        ('location', 'VARCHAR(20)'),
+        ('reason', 'VARCHAR(100)'),
+        ('units_per_box', 'FLOAT'),
+    ],
+}
+
+# 需要先整理历史数据才能创建的索引：表名 -> [索引名]，由对应的迁移函数创建，ensure_schema 跳过
+DEFERRED_INDEXES = {
+    # 库存唯一键，由 compact_stock_rows 合并重复行后创建
+    'stock': ['uq_stock_identity'],
+}
+
+# 已从模型中移除、需要在已有表上删除的索引：表名 -> [索引名]
+DROPPED_INDEXES = {
+    # 防重复提交改由 idempotency_key 表实现
+    'record': ['idx_record_recent_duplicates'],
+}
+
+
+def ensure_schema():
+    """为已有表补齐新增列与模型中声明的索引、删除已废弃的索引（幂等）。"""
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    # user 在 PostgreSQL 中是保留字，表名需按方言加引号
+    quote = db.engine.dialect.identifier_preparer.quote
+    with db.engine.begin() as conn:
+        for table_name, columns in ADDED_COLUMNS.items():
+            if table_name not in existing_tables:
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table_name)}
+            for column_name, ddl_type in columns:
+                if column_name not in existing:
+                    conn.execute(db.text(f'ALTER TABLE {quote(table_name)} ADD COLUMN {column_name} {ddl_type}'))
+                    print(f'已添加列: {table_name}.{column_name}')
+        for table_name, index_names in DROPPED_INDEXES.items():
+            if table_name not in existing_tables:
+                continue
+            existing = {index['name'] for index in inspector.get_indexes(table_name)}
+            for index_name in index_names:
+                if index_name in existing:
+                    conn.execute(db.text(f'DROP INDEX {index_name}'))
+                    print(f'已删除索引: {table_name}.{index_name}')
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        deferred = DEFERRED_INDEXES.get(table.name, ())
+        for index in table.indexes:
+            if index.name not in deferred:
+                index.create(bind=db.engine, checkfirst=True)
+
+
+def data_migration_applied(name):
+    return db.session.get(DataMigration, name) is not None
+
+
+def mark_data_migration(name):
+    """记录数据迁移已完成并提交（并发记录时以先写入者为准）"""
+    try:
+        db.session.add(DataMigration(name=name))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+
+
+def run_data_migration(name, migrate, has_pending=None, batch_size=500):
+    """执行一次性数据迁移并记录完成标记，已有标记时直接跳过，返回是否已完成。
+    has_pending 为空时（迁移脚本）总是执行；不为空时（应用启动）仅在没有待处理数据时执行并记录，
+    否则提示执行 scripts/migrate_schema.py。"""
+    if data_migration_applied(name):
+        return True
+    if has_pending is not None and has_pending():
+        print(f'数据迁移 {name} 尚未完成，请执行 python scripts/migrate_schema.py')
+        return False
+    migrate(batch_size=batch_size)
+    mark_data_migration(name)
+    return True
+
+
+def _record_columns_pending():
+    return db.and_(
+        Record.additional_info.isnot(None),
+        Record.box_spec.is_(None),
+        Record.batch_number.is_(None),
+        Record.location.is_(None),
+        Record.reason.is_(None),
+    )
+
+
+def record_columns_pending():
+    """是否仍有未回填结构化字段的历史记录"""
+    return db.session.query(Record.id).filter(_record_columns_pending()).limit(1).first() is not None
+
+
+def backfill_record_columns(batch_size=500):
+    """从 additional_info 解析历史记录的结构化字段，按主键分批回填并逐批提交。
+    无法解析的记录保持原样，完成后由 data_migration 标记保证不再重复扫描。"""
+    pending = _record_columns_pending()
+    last_id = ''
+    updated = 0
+    while True:
+        rows = db.session.query(Record.id, Record.additional_info).filter(
+            pending, Record.id > last_id
+        ).order_by(Record.id).limit(batch_size).all()
+        if not rows:
+            break
+        mappings = []
+        for record_id, info in rows:
+            fields = parse_record_info(info)
+            if any(value is not None for value in fields.values()):
+                fields['id'] = record_id
+                mappings.append(fields)
+        if mappings:
+            db.session.bulk_update_mappings(Record, mappings)
+        db.session.commit()
+        updated += len(mappings)
+        last_id = rows[-1][0]
+        print(f'已回填记录 {updated} 条（当前位置 {last_id}）')
+    return updated
+
+
+def units_per_box_pending():
+    """是否仍有规格未解析出每箱单位数的库存、出入库记录或深圳记录"""
+    return any(
+        db.session.query(model.id).filter(
+            model.units_per_box.is_(None), model.box_spec.isnot(None)
+        ).limit(1).first() is not None
+        for model in (Stock, Record, ShenzhenRecord)
+    )
+
+
+def backfill_units_per_box(batch_size=500):
+    """为库存、出入库记录与深圳记录解析 box_spec 回填 units_per_box，按主键分批回填并逐批提交。
+    汇总表已建立时，同批刷新回填了库存行的产品汇总（回填前按每箱 1 件计算的件数随之更正）。"""
+    from change_feed import record_changes
+    from inventory_summary import refresh_product_summaries
+    from models import ProductInventorySummary
+    from performance_optimization import MerchantCache
+
+    has_summary = db.session.query(ProductInventorySummary.product_id).limit(1).first() is not None
+    total = 0
+    for model in (Stock, Record, ShenzhenRecord):
+        last_id = None
+        updated = 0
+        while True:
+            query = db.session.query(model.id, model.box_spec, model.merchant_id, model.product_id).filter(
+                model.units_per_box.is_(None),
+                model.box_spec.isnot(None)
+            )
+            if last_id is not None:
+                query = query.filter(model.id > last_id)
+            rows = query.order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            mappings = []
+            by_merchant = {}
+            for row_id, box_spec, merchant_id, product_id in rows:
+                units = parse_units_per_box(box_spec)
+                if units is not None:
+                    mappings.append({'id': row_id, 'units_per_box': units})
+                    by_merchant.setdefault(merchant_id, set()).add(product_id)
+            if mappings:
+                db.session.bulk_update_mappings(model, mappings)
+                if model is Stock and has_summary:
+                    for merchant_id, product_ids in by_merchant.items():
+                        refresh_product_summaries(merchant_id, product_ids)
+                        MerchantCache.bump_version(merchant_id)
+                        record_changes(merchant_id, 'stock', product_ids)
+            db.session.commit()
+            updated += len(mappings)
+            last_id = rows[-1][0]
+        print(f'已回填 {model.__tablename__}.units_per_box {updated} 行')
+        total += updated
+    return total
+
+
+def stock_site_pending():
+    """是否仍有未回填站点的库存行"""
+    return db.session.query(Stock.id).filter(Stock.site.is_(None)).limit(1).first() is not None
+
+
+def backfill_stock_site(batch_size=500):
+    """按库位为库存行回填站点 site（hk/shenzhen），按主键分批回填并逐批提交。"""
+    last_id = 0
+    updated = 0
+    while True:
+        rows = db.session.query(Stock.id, Stock.location).filter(
+            Stock.site.is_(None), Stock.id > last_id
+        ).order_by(Stock.id).limit(batch_size).all()
+        if not rows:
+            break
+        db.session.bulk_update_mappings(Stock, [
+            {'id': row_id, 'site': site_for_location(location)} for row_id, location in rows
+        ])
+        db.session.commit()
+        updated += len(rows)
+        last_id = rows[-1][0]
+    if updated:
+        print(f'已回填 stock.site {updated} 行')
+    return updated
+
+
+def index_exists(index_name):
+    """按名称查询索引是否存在；SQLite 的反射会跳过表达式索引，因此直接查系统表。"""
+    if db.engine.dialect.name == 'sqlite':
+        sql = "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"
+    elif db.engine.dialect.name == 'postgresql':
+        sql = 'SELECT 1 FROM pg_indexes WHERE indexname = :name'
+    else:
+        inspector = inspect(db.engine)
+        return any(
+            index['name'] == index_name
+            for table_name in inspector.get_table_names()
+            for index in inspector.get_indexes(table_name)
+        )
+    with db.engine.connect() as conn:
+        return conn.execute(db.text(sql), {'name': index_name}).first() is not None
+
+
+def drop_stock_identity_index():
+    """删除库存唯一索引：导入可能含重复库存行的历史数据前调用，导入后由 compact_stock_rows 合并并重建。"""
+    with db.engine.begin() as conn:
+        conn.execute(db.text('DROP INDEX IF EXISTS uq_stock_identity'))
+    DataMigration.query.filter_by(name='stock_compaction').delete(synchronize_session=False)
+    db.session.commit()
+
+
+def stock_compaction_pending():
+    """唯一索引尚未建立且库存表中已有数据时需要整理（空表直接建索引即可）"""
+    if 'stock' not in inspect(db.engine).get_table_names() or index_exists('uq_stock_identity'):
+        return False
+    return db.session.query(Stock.id).limit(1).first() is not None
+
+
+def compact_stock_rows(batch_size=500):
+    """一次性整理库存表：合并唯一键（商户、产品、规格、批次、过期日期、库位）相同的库存行、删除零库存行，
+    然后创建唯一索引 uq_stock_identity。按商户+产品分批处理并逐批提交，索引已存在时直接返回。"""
+    from change_feed import record_changes
+    from inventory_summary import ensure_inventory_summaries, refresh_product_summaries
+    from performance_optimization import MerchantCache
+
+    if 'stock' not in inspect(db.engine).get_table_names() or index_exists('uq_stock_identity'):
+        return 0
+    # 下面按产品刷新汇总会写入汇总行，汇总表为空时须先全量构建，否则 ensure_inventory_summaries 会因表非空而跳过
+    ensure_inventory_summaries()
+
+    empty = db.or_(Stock.quantity.is_(None), Stock.quantity == 0)
+    identity = Stock.identity_exprs()
+    duplicated = db.session.query(Stock.merchant_id, Stock.product_id).group_by(
+        *identity
+    ).having(db.func.count(Stock.id) > 1)
+    emptied = db.session.query(Stock.merchant_id, Stock.product_id).filter(empty)
+    pairs = sorted(set(duplicated.all()) | set(emptied.all()), key=lambda pair: (pair[0], str(pair[1])))
+
+    removed = 0
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start:start + batch_size]
+        conditions = [db.tuple_(Stock.merchant_id, Stock.product_id).in_(
+            [pair for pair in batch if pair[1] is not None]
+        )]
+        orphan_merchants = [merchant_id for merchant_id, product_id in batch if product_id is None]
+        if orphan_merchants:
+            # 没有产品的残留行只会是空行，随零库存行一起删除
+            conditions.append(db.and_(Stock.merchant_id.in_(orphan_merchants), Stock.product_id.is_(None)))
+        rows = Stock.query.filter(db.or_(*conditions)).order_by(Stock.id).all()
+        groups = {}
+        for row in rows:
+            groups.setdefault(Stock.identity_key(row), []).append(row)
+        for group in groups.values():
+            keeper, others = group[0], group[1:]
+            if others:
+                keeper.quantity = sum(row.quantity or 0 for row in group)
+                # 在途、日均消耗、深圳库存是按产品维护并复制到各行的值，取最大值
+                for column in ('in_transit', 'daily_consumption', 'shenzhen_stock'):
+                    values = [getattr(row, column) for row in group if getattr(row, column) is not None]
+                    if values:
+                        setattr(keeper, column, max(values))
+                if keeper.unit_price is None:
+                    keeper.unit_price = next((row.unit_price for row in others if row.unit_price is not None), None)
+            if not keeper.quantity:
+                others = group
+            for row in others:
+                db.session.delete(row)
+            removed += len(others)
+        db.session.flush()
+
+        by_merchant = {}
+        for merchant_id, product_id in batch:
+            products = by_merchant.setdefault(merchant_id, [])
+            if product_id is not None:
+                products.append(product_id)
+        for merchant_id, product_ids in by_merchant.items():
+            refresh_product_summaries(merchant_id, product_ids)
+            MerchantCache.bump_version(merchant_id)
+            record_changes(merchant_id, 'stock', product_ids)
+        db.session.commit()
+        print(f'已整理库存 {min(start + batch_size, len(pairs))}/{len(pairs)} 个产品，累计删除 {removed} 行')
+
+    for index in Stock.__table__.indexes:
+        if index.name == 'uq_stock_identity':
+            index.create(bind=db.engine)
+            print('已创建索引: stock.uq_stock_identity')
+    return removed
@@ -1,13 +1,36 @@
-from datetime import datetime
+from datetime import date, datetime
+from sqlalchemy.orm import validates
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from extensions import db
+from utils import parse_units_per_box, site_for_location, DEFAULT_UNITS_PER_BOX, SITE_HK
+
+
+# 唯一键中过期日期为空时的占位值，与 uq_stock_identity 中的 COALESCE 默认值一致
+STOCK_NO_EXPIRY = date(1900, 1, 1)
+
+
+class UnitsPerBoxMixin:
+    """box_spec 赋值时同步解析出数值型的每箱单位数，件数统计可直接在 SQL 中计算"""
+    units_per_box = db.Column(db.Float)
+
+    @validates('box_spec')
+    def _sync_units_per_box(self, key, value):
+        self.units_per_box = parse_units_per_box(value)
+        return value
+
+    @classmethod
+    def items_expr(cls):
+        """件数 SQL 表达式：数量 × COALESCE(每箱单位数, 1)"""
+        return cls.quantity * db.func.coalesce(cls.units_per_box, DEFAULT_UNITS_PER_BOX)
 
 
 class Merchant(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    # 商户数据版本号：每次库存/产品/记录变更时递增，用于缓存失效
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     def to_dict(self):
         return {
@@ -30,7 +53,7 @@ class Product(db.Model):
     )
 
 
-class Stock(db.Model):
+class Stock(UnitsPerBoxMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.String(20), db.ForeignKey('product.id'), index=True)
     box_spec = db.Column(db.String(50))
@@ -40,6 +63,8 @@ class Stock(db.Model):
     in_transit = db.Column(db.Integer)
     daily_consumption = db.Column(db.Float)
     location = db.Column(db.String(20), index=True)
+    # 站点（hk/shenzhen）：location 赋值时同步归一化，替代对大小写不一的库位字符串做 NOT IN 比较
+    site = db.Column(db.String(20), default=SITE_HK)
     merchant_id = db.Column(db.Integer, db.ForeignKey('merchant.id'), nullable=False, index=True)
     unit_price = db.Column(db.Float)
     shenzhen_stock = db.Column(db.Integer, default=0)
@@ -48,10 +73,63 @@ class Stock(db.Model):
         db.Index('idx_stock_product_merchant', 'product_id', 'merchant_id'),
         db.Index('idx_stock_location_batch', 'location', 'batch_number'),
         db.Index('idx_stock_expiry_quantity', 'expiry_date', 'quantity'),
+        # 只收录有库存的行（出库只扣减数量，零库存行会越积越多）；PostgreSQL 上 INCLUDE 查询所需列以便只扫描索引
+        db.Index(
+            'idx_stock_in_stock_site_product', 'merchant_id', 'site', 'product_id',
+            sqlite_where=db.text('quantity > 0'),
+            postgresql_where=db.text('quantity > 0'),
+            postgresql_include=['id', 'box_spec', 'quantity', 'batch_number', 'expiry_date', 'location',
+                                'in_transit', 'daily_consumption', 'shenzhen_stock']
+        ),
+        db.Index(
+            'idx_stock_in_stock_site_expiry', 'merchant_id', 'site', 'expiry_date',
+            sqlite_where=db.text('quantity > 0'),
+            postgresql_where=db.text('quantity > 0'),
+            postgresql_include=['product_id', 'box_spec', 'quantity', 'units_per_box']
+        ),
     )
 
-
-class Record(db.Model):
+    @validates('location')
+    def _sync_site(self, key, value):
+        self.site = site_for_location(value)
+        return value
+
+    @classmethod
+    def identity_exprs(cls):
+        """库存行唯一键表达式：可空列以 COALESCE 归一（唯一索引中 NULL 互不相等），入库 ON CONFLICT 按此推断"""
+        return (
+            cls.merchant_id,
+            cls.product_id,
+            db.func.coalesce(cls.box_spec, db.literal_column("''")),
+            db.func.coalesce(cls.batch_number, db.literal_column("''")),
+            db.func.coalesce(cls.expiry_date, db.literal_column("'1900-01-01'")),
+            db.func.coalesce(cls.location, db.literal_column("''")),
+        )
+
+    @staticmethod
+    def identity_key(row):
+        """与 identity_exprs 对应的 Python 侧键，row 为库存行、流水行或字段字典"""
+        get = row.get if isinstance(row, dict) else lambda name: getattr(row, name)
+        return (
+            get('merchant_id'),
+            get('product_id'),
+            get('box_spec') or '',
+            get('batch_number') or '',
+            get('expiry_date') or STOCK_NO_EXPIRY,
+            get('location') or '',
+        )
+
+    @classmethod
+    def identity_clause(cls, row):
+        """按唯一键定位库存行的查询条件（与唯一索引表达式一致，可走 uq_stock_identity）"""
+        return db.and_(*(expr == value for expr, value in zip(cls.identity_exprs(), cls.identity_key(row))))
+
+
+# 同一商户下（产品、规格、批次、过期日期、库位）只保留一行库存，入库合并到已有行
+db.Index('uq_stock_identity', *Stock.identity_exprs(), unique=True)
+
+
+class Record(UnitsPerBoxMixin, db.Model):
     id = db.Column(db.String(20), primary_key=True)
     product_id = db.Column(db.String(20), index=True)
     operation_type = db.Column(db.String(10), index=True)
@@ -60,17 +138,24 @@ class Record(db.Model):
     additional_info = db.Column(db.String(200))
     merchant_id = db.Column(db.Integer, db.ForeignKey('merchant.id'), nullable=False, index=True)
     operator_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
+    # 结构化字段：写入时直接填充，替代对 additional_info 的字符串解析
+    box_spec = db.Column(db.String(50))
+    batch_number = db.Column(db.String(50))
+    expiry_date = db.Column(db.Date)
+    location = db.Column(db.String(20))
+    reason = db.Column(db.String(100))
 
     operator = db.relationship('User', backref='records', lazy=True)
 
     __table_args__ = (
         db.Index('idx_record_date_merchant', 'date', 'merchant_id'),
         db.Index('idx_record_product_operation', 'product_id', 'operation_type'),
-        db.Index('idx_record_recent_duplicates', 'product_id', 'operation_type', 'quantity', 'date'),
+        db.Index('idx_record_merchant_batch', 'merchant_id', 'batch_number'),
+        db.Index('idx_record_merchant_location', 'merchant_id', 'location'),
     )
 
 
-class ShenzhenRecord(db.Model):
+class ShenzhenRecord(UnitsPerBoxMixin, db.Model):
     id = db.Column(db.String(20), primary_key=True)
     product_id = db.Column(db.String(20))
     operation_type = db.Column(db.String(10))  # 入库/出库/调拨
@@ -92,6 +177,8 @@ class User(db.Model):
     last_login = db.Column(db.DateTime)
     current_merchant_id = db.Column(db.Integer, db.ForeignKey('merchant.id'), nullable=True)
     is_admin = db.Column(db.Boolean, default=False)
+    # 权限版本号：权限或管理员状态变更时递增，会话中缓存的权限集合据此判断是否过期
+    permissions_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     permissions = db.relationship('UserPermission', backref='user', lazy='dynamic')
 
@@ -113,15 +200,19 @@ class User(db.Model):
     def get_id(self):
         return str(self.id)
 
+    def permission_names(self):
+        """一次查询解析用户拥有的权限名集合（管理员拥有全部权限）"""
+        query = db.session.query(Permission.name)
+        if not self.is_admin:
+            query = query.join(UserPermission, UserPermission.permission_id == Permission.id).filter(
+                UserPermission.user_id == self.id
+            )
+        return frozenset(name for name, in query.all())
+
     def has_permission(self, permission_name):
-        permission = Permission.query.filter_by(name=permission_name).first()
-        if not permission:
-            return False
-        user_permission = UserPermission.query.filter_by(
-            user_id=self.id,
-            permission_id=permission.id
-        ).first()
-        return user_permission is not None
+        from permissions import user_permissions
+
+        return permission_name in user_permissions(self)
 
 
 class Location(db.Model):
@@ -147,3 +238,195 @@ class UserPermission(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.now)
 
     __table_args__ = (db.UniqueConstraint('user_id', 'permission_id', name='unique_user_permission'),)
+
+
+class BackgroundJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(50), nullable=False)
+    # 去重键：同一键只会存在一个任务（如 每商户每日归档）
+    dedupe_key = db.Column(db.String(100), nullable=False, unique=True)
+    merchant_id = db.Column(db.Integer, db.ForeignKey('merchant.id'))
+    run_date = db.Column(db.Date)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending/running/done/failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('idx_job_status_id', 'status', 'id'),
+        db.Index('idx_job_merchant_created', 'merchant_id', 'created_at'),
+    )
+
+    def to_dict(self):
+        fmt = lambda value: value.strftime('%Y-%m-%d %H:%M:%S') if value else None
+        return {
+            'id': self.id,
+            'job_type': self.job_type,
+            'merchant_id': self.merchant_id,
+            'run_date': self.run_date.strftime('%Y-%m-%d') if self.run_date else None,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.error,
+            'created_at': fmt(self.created_at),
+            'started_at': fmt(self.started_at),
+            'finished_at': fmt(self.finished_at)
+        }
+
+
+class IdempotencyKey(db.Model):
+    """写操作幂等键：(用户, 键) 唯一，保存首次请求的成功响应，重试时直接返回"""
+    id = db.Column(db.Integer, primary_key=True)
+    # 不设外键：删除用户时无需级联清理，过期后统一清除
+    user_id = db.Column(db.Integer, nullable=False)
+    key = db.Column(db.String(100), nullable=False)
+    endpoint = db.Column(db.String(100), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)  # 请求体 SHA-256，同键不同请求体视为误用
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending/done
+    response_status = db.Column(db.Integer)
+    response_body = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'key', name='uq_idempotency_user_key'),
+        db.Index('idx_idempotency_created', 'created_at'),
+    )
+
+
+class DataMigration(db.Model):
+    """已完成的一次性数据迁移（回填、整理）标记：应用启动时据此跳过，不再扫描历史数据"""
+    name = db.Column(db.String(100), primary_key=True)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+
+class IdNodeLease(db.Model):
+    """主键分配器节点号租约：每个进程租用一个节点号（0-1023），到期前续租，过期后可被其他进程接管"""
+    node_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    holder = db.Column(db.String(100), nullable=False)  # 主机名:进程号:随机串
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class ProductInventorySummary(db.Model):
+    """按商户+产品汇总的库存（与库存变更在同一事务内刷新），供仪表盘与库存概览直接读取"""
+    product_id = db.Column(db.String(20), primary_key=True)
+    merchant_id = db.Column(db.Integer, db.ForeignKey('merchant.id'), primary_key=True)
+    hk_boxes = db.Column(db.Integer, nullable=False, default=0)  # 香港库存箱数（数量>0）
+    hk_items = db.Column(db.Float, nullable=False, default=0)  # 香港库存件数（箱数 × 每箱单位数）
+    hk_batches = db.Column(db.Integer, nullable=False, default=0)  # 香港库存批次行数
+    daily_consumption = db.Column(db.Float)  # 香港库存行中的最大每日消耗
+    shenzhen_boxes = db.Column(db.Integer, nullable=False, default=0)
+    shenzhen_items = db.Column(db.Float, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('idx_inventory_summary_merchant', 'merchant_id'),
+    )
+
+    def to_dict(self):
+        days_left = (self.hk_items / self.daily_consumption) if self.daily_consumption else None
+        return {
+            'product_id': self.product_id,
+            'merchant_id': self.merchant_id,
+            'hk_boxes': self.hk_boxes,
+            'hk_items': round(self.hk_items, 2),
+            'hk_batches': self.hk_batches,
+            'daily_consumption': self.daily_consumption,
+            'days_to_stockout': round(days_left, 2) if days_left is not None else None,
+            'shenzhen_boxes': self.shenzhen_boxes,
+            'shenzhen_items': round(self.shenzhen_items, 2),
+            'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S') if self.updated_at else None
+        }
+
+
+class ChangeEvent(db.Model):
+    """商户变更流（只追加）：写操作在提交前写入，version 为该事务递增后的商户数据版本号，用作客户端游标"""
+    id = db.Column(db.Integer, primary_key=True)
+    # 不设外键：删除商户时无需级联清理，过期后统一清除
+    merchant_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    entity = db.Column(db.String(30), nullable=False)  # stock（按产品ID）/record/product/shenzhen_record
+    entity_id = db.Column(db.String(50), nullable=False)
+    action = db.Column(db.String(10), nullable=False, default='upsert')  # upsert/delete
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('idx_change_event_merchant_version', 'merchant_id', 'version'),
+        db.Index('idx_change_event_created', 'created_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'entity': self.entity,
+            'id': self.entity_id,
+            'action': self.action
+        }
+
+
+class StockMovement(db.Model):
+    """库存流水（只追加）：库存数量的每次增减一行，维度与库存唯一键一致，Stock.quantity 等于对应维度的流水之和"""
+    id = db.Column(db.Integer, primary_key=True)
+    # 不设外键：产品改号、删除后流水仍保留原编号
+    merchant_id = db.Column(db.Integer, nullable=False)
+    product_id = db.Column(db.String(20), nullable=False)
+    box_spec = db.Column(db.String(50))
+    batch_number = db.Column(db.String(50))
+    expiry_date = db.Column(db.Date)
+    location = db.Column(db.String(20))
+    quantity_delta = db.Column(db.Integer, nullable=False)
+    movement_type = db.Column(db.String(20), nullable=False)  # 入库/出库/移位/修改记录/删除记录/删除产品/产品改号/期初/校正
+    source_id = db.Column(db.String(20))  # 对应的出入库记录或深圳记录ID
+    operator_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('idx_stock_movement_merchant_id', 'merchant_id', 'id'),
+        db.Index('idx_stock_movement_merchant_created', 'merchant_id', 'created_at'),
+        db.Index('idx_stock_movement_source', 'source_id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'product_id': self.product_id,
+            'box_spec': self.box_spec,
+            'batch_number': self.batch_number,
+            'expiry_date': self.expiry_date.strftime('%Y-%m-%d') if self.expiry_date else None,
+            'location': self.location,
+            'quantity_delta': self.quantity_delta,
+            'movement_type': self.movement_type,
+            'source_id': self.source_id,
+            'operator_id': self.operator_id,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None
+        }
+
+
+class StockSnapshot(db.Model):
+    """商户库存快照：截至 last_movement_id（含）的各维度结存，taken_at 为其中最晚一条流水的时间"""
+    id = db.Column(db.Integer, primary_key=True)
+    merchant_id = db.Column(db.Integer, nullable=False)
+    last_movement_id = db.Column(db.Integer, nullable=False)
+    taken_at = db.Column(db.DateTime, nullable=False)
+    line_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('idx_stock_snapshot_merchant_taken', 'merchant_id', 'taken_at'),
+    )
+
+
+class StockSnapshotLine(db.Model):
+    """快照明细：只保存结存不为 0 的维度"""
+    id = db.Column(db.Integer, primary_key=True)
+    snapshot_id = db.Column(db.Integer, db.ForeignKey('stock_snapshot.id', ondelete='CASCADE'), nullable=False)
+    product_id = db.Column(db.String(20), nullable=False)
+    box_spec = db.Column(db.String(50))
+    batch_number = db.Column(db.String(50))
+    expiry_date = db.Column(db.Date)
+    location = db.Column(db.String(20))
+    quantity = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('idx_stock_snapshot_line_snapshot_product', 'snapshot_id', 'product_id'),
+    )
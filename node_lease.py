@@ -0,0 +1,134 @@
+"""
+主键分配器节点号租约模块
+记录主键（utils.IdAllocator）中的节点号必须在同时运行的进程之间互不相同，否则两个进程在同一毫秒
+可能生成相同的 ID。由主机名、进程号推导节点号无法保证这一点（Vercel 多实例、进程号相差 1024 等），
+这里改为在 id_node_lease 表中租用节点号：
+  - 每个进程（fork 后的子进程重新租用）以条件插入/更新占用一个未被占用或已过期的节点号
+  - 租约有效期 ID_NODE_LEASE_SECONDS 秒（默认 600），剩余不足一半时续租；续租失败（已被接管）则改租新的节点号
+  - 写请求开始前先完成租用/续租（独立连接、独立事务），分配 ID 时不在业务事务中写租约表
+设置了 ID_NODE_ID 时直接使用该节点号，不租用。
+"""
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import has_app_context, request
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models import IdNodeLease
+from utils import ID_MAX_NODE, set_id_node_provider
+
+# 租约有效期（秒）；各实例时钟偏差需小于有效期的一半
+ID_NODE_LEASE_SECONDS = int(os.environ.get('ID_NODE_LEASE_SECONDS', '600'))
+# 只有写请求会分配主键
+LEASE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class NodeLease:
+    """当前进程的节点号租约，current_node() 返回一个在本次调用时由当前进程持有的节点号"""
+
+    def __init__(self, app=None, ttl_seconds=ID_NODE_LEASE_SECONDS, engine=None, preferred_node=None):
+        self.ttl_seconds = ttl_seconds
+        # 未指定 engine 时使用应用的 db.engine；preferred_node 为首选节点号（默认随机），便于测试争用
+        self.preferred_node = preferred_node
+        self._engine = engine
+        self._app = None
+        self._lock = threading.Lock()
+        self._pid = None
+        self._holder = None
+        self.node = None
+        self._renew_at = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        app.before_request(self._before_request)
+        set_id_node_provider(self.current_node)
+        app.extensions['node_lease'] = self
+
+    def _before_request(self):
+        if request.method in LEASE_METHODS and not os.environ.get('ID_NODE_ID'):
+            self.current_node()
+
+    def _connect(self):
+        if self._engine is not None:
+            return self._engine.begin()
+        if has_app_context():
+            return db.engine.begin()
+        with self._app.app_context():
+            return db.engine.begin()
+
+    def current_node(self):
+        with self._lock:
+            pid = os.getpid()
+            if pid != self._pid:
+                # fork 出的子进程不能沿用父进程的租约
+                self._pid = pid
+                self._holder = f'{socket.gethostname()}:{pid}:{os.urandom(4).hex()}'[-100:]
+                self.node = None
+            # 用墙上时钟判断：进程被冻结（如 Serverless 实例休眠）期间单调时钟可能不走，其他实例按墙上时钟判断过期
+            if self.node is None or time.time() >= self._renew_at:
+                if self.node is not None and not self._renew():
+                    print(f'节点号 {self.node} 的租约已被接管，改租新的节点号')
+                    self.node = None
+                if self.node is None:
+                    self.node = self._acquire()
+            return self.node
+
+    def _lease_window(self):
+        now = datetime.now()
+        return now, now + timedelta(seconds=self.ttl_seconds)
+
+    def _mark_renewed(self):
+        self._renew_at = time.time() + self.ttl_seconds / 2
+
+    def _renew(self):
+        now, expires_at = self._lease_window()
+        table = IdNodeLease.__table__
+        with self._connect() as conn:
+            result = conn.execute(table.update().where(
+                table.c.node_id == self.node,
+                table.c.holder == self._holder,
+                table.c.expires_at >= now
+            ).values(expires_at=expires_at))
+        if result.rowcount != 1:
+            return False
+        self._mark_renewed()
+        return True
+
+    def _acquire(self):
+        now, expires_at = self._lease_window()
+        table = IdNodeLease.__table__
+        with self._connect() as conn:
+            leases = {node_id: lease_expires for node_id, lease_expires in conn.execute(
+                db.select(table.c.node_id, table.c.expires_at)
+            )}
+        start = self.preferred_node
+        if start is None:
+            start = int.from_bytes(os.urandom(2), 'big')
+        for offset in range(ID_MAX_NODE + 1):
+            node = (start + offset) & ID_MAX_NODE
+            if node in leases and leases[node] >= now:
+                continue
+            try:
+                with self._connect() as conn:
+                    if node in leases:
+                        # 只接管仍处于过期状态的租约：并发接管时只有一个进程的条件更新生效
+                        result = conn.execute(table.update().where(
+                            table.c.node_id == node,
+                            table.c.expires_at < now
+                        ).values(holder=self._holder, expires_at=expires_at))
+                        if result.rowcount != 1:
+                            continue
+                    else:
+                        conn.execute(table.insert().values(node_id=node, holder=self._holder, expires_at=expires_at))
+            except IntegrityError:
+                # 其他进程同时插入了该节点号
+                continue
+            self._mark_renewed()
+            return node
+        raise RuntimeError('没有可用的主键节点号：同时运行的进程超过 1024 个')
@@ -2,9 +2,18 @@
 性能优化配置模块
 包含数据库连接池、缓存和其他性能优化设置
 """
+import functools
+import hashlib
 import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+from flask import Response, g, has_request_context, make_response, request
+from flask.json.provider import DefaultJSONProvider
 from flask_caching import Cache
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.pool import QueuePool
 
 # 数据库连接池配置
@@ -41,11 +50,28 @@ def get_optimized_db_config():
 
 # 缓存配置
 def get_cache_config():
-    """获取缓存配置"""
-    return {
-        'CACHE_TYPE': 'simple',  # 在生产环境中可以使用Redis
-        'CACHE_DEFAULT_TIMEOUT': 300  # 5分钟缓存
+    """获取缓存配置：CACHE_TYPE 可选 simple（默认，进程内）/ filesystem / redis / null
+
+    redis 后端通过 CACHE_REDIS_URL 连接，任何兼容 Redis 协议的服务（本地 redis-server、Valkey 等）均可。
+    """
+    cache_type = os.environ.get('CACHE_TYPE', 'simple').lower()
+    config = {
+        'CACHE_DEFAULT_TIMEOUT': int(os.environ.get('CACHE_DEFAULT_TIMEOUT', '300'))  # 5分钟缓存
     }
+    if cache_type == 'filesystem':
+        config['CACHE_TYPE'] = 'FileSystemCache'
+        config['CACHE_DIR'] = os.environ.get('CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'wms_cache')
+        config['CACHE_THRESHOLD'] = 2000
+    elif cache_type == 'redis':
+        config['CACHE_TYPE'] = 'RedisCache'
+        config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+        config['CACHE_KEY_PREFIX'] = 'wms:'
+    elif cache_type == 'null':
+        config['CACHE_TYPE'] = 'NullCache'
+    else:
+        config['CACHE_TYPE'] = 'SimpleCache'
+        config['CACHE_THRESHOLD'] = 1000
+    return config
 
 # 初始化缓存
 def init_cache(app):
@@ -59,6 +85,182 @@ def init_cache(app):
     cache.init_app(app)
     return cache
 
+# 商户级响应缓存
+class MerchantCache:
+    """商户级响应缓存
+
+    缓存键为 (商户ID, 商户数据版本号, 接口, 规范化查询参数)。写操作在提交前调用 bump_version
+    递增商户数据版本号（与数据变更同一事务），旧版本的缓存不再被读取，无需逐键删除。
+    版本号保存在 merchant 表中，多进程/多实例部署下同样不会读到过期数据。
+    响应随日期变化的接口（今日/本周统计、距过期天数等）使用 daily=True，缓存键再加上当天日期。
+    """
+
+    # 命中缓存时需要还原的响应头
+    CACHED_HEADERS = ('Content-Type', 'X-Next-Cursor', 'X-Total-Count')
+
+    def __init__(self, app=None):
+        self.cache = None
+        self.backend = None
+        self._lock = threading.Lock()
+        self._stats = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache = init_cache(app)
+        self.backend = app.config.get('CACHE_TYPE')
+        app.extensions['merchant_cache'] = self
+
+    @staticmethod
+    def data_version(merchant_id):
+        """读取商户当前数据版本号，商户不存在时返回 None"""
+        from models import Merchant
+        from extensions import db
+
+        return db.session.query(Merchant.data_version).filter(Merchant.id == merchant_id).scalar()
+
+    def request_version(self, merchant_id):
+        """同一请求内只读取一次商户数据版本号（缓存与 ETag 共用）"""
+        versions = g.setdefault('merchant_data_versions', {})
+        if merchant_id not in versions:
+            versions[merchant_id] = self.data_version(merchant_id)
+        return versions[merchant_id]
+
+    @staticmethod
+    def bump_version(*merchant_ids):
+        """在当前事务中递增商户数据版本号，需在写操作提交之前调用"""
+        from models import Merchant
+        from extensions import db
+
+        ids = {merchant_id for merchant_id in merchant_ids if merchant_id}
+        if ids:
+            db.session.query(Merchant).filter(Merchant.id.in_(ids)).update(
+                {Merchant.data_version: Merchant.data_version + 1},
+                synchronize_session=False
+            )
+
+    @staticmethod
+    def make_key(merchant_id, version, endpoint, view_args, args, daily=False):
+        """参数按名称和值排序后取摘要，参数顺序不同的相同请求命中同一缓存；daily 时键中带当天日期"""
+        normalized = (
+            sorted((key, str(value)) for key, value in view_args.items()),
+            sorted((key, sorted(values)) for key, values in args.lists())
+        )
+        digest = hashlib.sha1(repr(normalized).encode('utf-8')).hexdigest()
+        key = f'merchant:{merchant_id}:v{version}:{endpoint}:{digest}'
+        if daily:
+            # 与视图计算统计窗口使用同一时钟（datetime.now），跨过零点即换键
+            key += f':{datetime.now():%Y%m%d}'
+        return key
+
+    def _count(self, endpoint, field):
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {'hits': 0, 'misses': 0, 'errors': 0, 'not_modified': 0})
+            stats[field] += 1
+
+    def cached(self, func=None, *, daily=False):
+        """视图缓存装饰器（放在 login_required 之后）：只缓存当前商户 GET 请求的 200 JSON 响应
+
+        用法：@merchant_cache.cached，响应随日期变化时 @merchant_cache.cached(daily=True)。
+        """
+        if func is None:
+            return functools.partial(self.cached, daily=daily)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            from flask_login import current_user
+
+            merchant_id = current_user.current_merchant_id if current_user.is_authenticated else None
+            if self.cache is None or request.method != 'GET' or not merchant_id:
+                return func(*args, **kwargs)
+            version = self.request_version(merchant_id)
+            if version is None:
+                return func(*args, **kwargs)
+
+            endpoint = request.endpoint
+            key = self.make_key(merchant_id, version, endpoint, kwargs, request.args, daily)
+            try:
+                entry = self.cache.get(key)
+            except Exception as e:
+                print(f'读取缓存失败: {e}')
+                self._count(endpoint, 'errors')
+                entry = None
+            if entry is not None:
+                self._count(endpoint, 'hits')
+                return Response(entry['body'], status=entry['status'], headers=entry['headers'])
+
+            self._count(endpoint, 'misses')
+            response = make_response(func(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed and response.mimetype == 'application/json':
+                try:
+                    self.cache.set(key, {
+                        'body': response.get_data(),
+                        'status': response.status_code,
+                        'headers': [(name, value) for name, value in response.headers if name in self.CACHED_HEADERS]
+                    })
+                except Exception as e:
+                    print(f'写入缓存失败: {e}')
+                    self._count(endpoint, 'errors')
+            return response
+        return wrapper
+
+    def conditional(self, func=None, *, daily=False):
+        """条件请求装饰器（放在 login_required 之后、cached 之前）
+
+        以 (商户ID, 数据版本号, 接口, 查询参数) 生成强 ETag；If-None-Match 匹配时直接返回 304，不执行视图。
+        daily 与 cached 相同：响应随日期变化时 ETag 中带当天日期。
+        """
+        if func is None:
+            return functools.partial(self.conditional, daily=daily)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            from flask_login import current_user
+
+            merchant_id = current_user.current_merchant_id if current_user.is_authenticated else None
+            if request.method != 'GET' or not merchant_id:
+                return func(*args, **kwargs)
+            version = self.request_version(merchant_id)
+            if version is None:
+                return func(*args, **kwargs)
+
+            key = self.make_key(merchant_id, version, request.endpoint, kwargs, request.args, daily)
+            etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+            if request.if_none_match.contains(etag):
+                self._count(request.endpoint, 'not_modified')
+                response = Response(status=304)
+            else:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+
+    def stats(self):
+        """各接口的命中/未命中/304 次数与命中率"""
+        with self._lock:
+            endpoints = {endpoint: dict(stats) for endpoint, stats in self._stats.items()}
+        hits = sum(stats['hits'] for stats in endpoints.values())
+        misses = sum(stats['misses'] for stats in endpoints.values())
+        not_modified = sum(stats['not_modified'] for stats in endpoints.values())
+        for stats in endpoints.values():
+            total = stats['hits'] + stats['misses']
+            stats['hit_rate'] = round(stats['hits'] / total, 4) if total else None
+        return {
+            'backend': self.backend,
+            'hits': hits,
+            'misses': misses,
+            'not_modified': not_modified,
+            'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None,
+            'endpoints': endpoints
+        }
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
+
 # 性能监控装饰器
 def performance_monitor(func):
     """性能监控装饰器"""
@@ -79,6 +281,172 @@ def performance_monitor(func):
         return result
     return wrapper
 
+# 请求级性能计量
+class TimedJSONProvider(DefaultJSONProvider):
+    """在默认 JSON 序列化基础上累计当前请求的序列化耗时"""
+
+    def dumps(self, obj, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            metrics = g.get('request_metrics') if has_request_context() else None
+            if metrics is not None:
+                metrics['serialize_ms'] += (time.perf_counter() - start) * 1000
+
+
+class RequestMetrics:
+    """请求级性能计量
+
+    通过 SQLAlchemy 游标事件统计每个请求的 SQL 次数、SQL 总耗时与最慢语句，
+    并统计 JSON 序列化耗时；结果写入 Server-Timing 响应头，同时按接口汇总为直方图。
+    """
+
+    DURATION_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+    QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+    SLOW_REQUEST_MS = 1000
+    STATEMENT_MAX_LENGTH = 300
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self.started_at = datetime.now()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.json = TimedJSONProvider(app)
+        app.extensions['request_metrics'] = self
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('query_start_time')
+        if not starts:
+            return
+        elapsed_ms = (time.perf_counter() - starts.pop()) * 1000
+        metrics = g.get('request_metrics') if has_request_context() else None
+        if metrics is None:
+            return
+        metrics['sql_count'] += 1
+        metrics['sql_ms'] += elapsed_ms
+        if elapsed_ms > metrics['slowest_ms']:
+            metrics['slowest_ms'] = elapsed_ms
+            metrics['slowest_sql'] = ' '.join(statement.split())[:self.STATEMENT_MAX_LENGTH]
+
+    @staticmethod
+    def _before_request():
+        g.request_metrics = {
+            'start': time.perf_counter(),
+            'sql_count': 0,
+            'sql_ms': 0.0,
+            'slowest_ms': 0.0,
+            'slowest_sql': None,
+            'serialize_ms': 0.0
+        }
+
+    def _after_request(self, response):
+        metrics = g.get('request_metrics')
+        if metrics is None:
+            return response
+        total_ms = (time.perf_counter() - metrics['start']) * 1000
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={metrics["sql_ms"]:.2f};desc="{metrics["sql_count"]} queries", '
+            f'serialize;dur={metrics["serialize_ms"]:.2f}, total;dur={total_ms:.2f}'
+        )
+        endpoint = request.endpoint
+        if endpoint and endpoint != 'static':
+            self._record(f'{request.method} {endpoint}', metrics, total_ms)
+            if total_ms > self.SLOW_REQUEST_MS:
+                print(f"慢请求警告: {request.method} {request.path} 耗时 {total_ms:.0f}ms，"
+                      f"SQL {metrics['sql_count']} 次 / {metrics['sql_ms']:.0f}ms")
+        return response
+
+    @staticmethod
+    def _bucket_index(buckets, value):
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                return index
+        return len(buckets)
+
+    def _record(self, key, metrics, total_ms):
+        with self._lock:
+            stats = self._endpoints.get(key)
+            if stats is None:
+                stats = self._endpoints[key] = {
+                    'requests': 0,
+                    'total_ms': 0.0,
+                    'sql_ms': 0.0,
+                    'serialize_ms': 0.0,
+                    'queries': 0,
+                    'max_queries': 0,
+                    'max_ms': 0.0,
+                    'duration_hist': [0] * (len(self.DURATION_BUCKETS_MS) + 1),
+                    'sql_hist': [0] * (len(self.DURATION_BUCKETS_MS) + 1),
+                    'query_count_hist': [0] * (len(self.QUERY_COUNT_BUCKETS) + 1),
+                    'slowest_ms': 0.0,
+                    'slowest_sql': None
+                }
+            stats['requests'] += 1
+            stats['total_ms'] += total_ms
+            stats['sql_ms'] += metrics['sql_ms']
+            stats['serialize_ms'] += metrics['serialize_ms']
+            stats['queries'] += metrics['sql_count']
+            stats['max_queries'] = max(stats['max_queries'], metrics['sql_count'])
+            stats['max_ms'] = max(stats['max_ms'], total_ms)
+            stats['duration_hist'][self._bucket_index(self.DURATION_BUCKETS_MS, total_ms)] += 1
+            stats['sql_hist'][self._bucket_index(self.DURATION_BUCKETS_MS, metrics['sql_ms'])] += 1
+            stats['query_count_hist'][self._bucket_index(self.QUERY_COUNT_BUCKETS, metrics['sql_count'])] += 1
+            if metrics['slowest_ms'] > stats['slowest_ms']:
+                stats['slowest_ms'] = metrics['slowest_ms']
+                stats['slowest_sql'] = metrics['slowest_sql']
+
+    @staticmethod
+    def _histogram(buckets, counts):
+        bounds = list(buckets) + ['+Inf']
+        return [{'le': bound, 'count': count} for bound, count in zip(bounds, counts)]
+
+    def snapshot(self):
+        """按 SQL 总耗时倒序返回各接口的汇总数据（直方图为各区间计数，le 为区间上界）"""
+        with self._lock:
+            items = [(key, dict(stats)) for key, stats in self._endpoints.items()]
+        endpoints = []
+        for key, stats in sorted(items, key=lambda item: item[1]['sql_ms'], reverse=True):
+            requests_count = stats['requests']
+            endpoints.append({
+                'endpoint': key,
+                'requests': requests_count,
+                'avg_ms': round(stats['total_ms'] / requests_count, 2),
+                'max_ms': round(stats['max_ms'], 2),
+                'avg_sql_ms': round(stats['sql_ms'] / requests_count, 2),
+                'avg_serialize_ms': round(stats['serialize_ms'] / requests_count, 2),
+                'avg_queries': round(stats['queries'] / requests_count, 2),
+                'max_queries': stats['max_queries'],
+                'duration_ms_histogram': self._histogram(self.DURATION_BUCKETS_MS, stats['duration_hist']),
+                'sql_ms_histogram': self._histogram(self.DURATION_BUCKETS_MS, stats['sql_hist']),
+                'query_count_histogram': self._histogram(self.QUERY_COUNT_BUCKETS, stats['query_count_hist']),
+                'slowest_statement': {
+                    'ms': round(stats['slowest_ms'], 2),
+                    'sql': stats['slowest_sql']
+                }
+            })
+        return {
+            'since': self.started_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'endpoints': endpoints
+        }
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+            self.started_at = datetime.now()
+
 # 数据库查询优化工具
 class QueryOptimizer:
     """数据库查询优化工具类"""
@@ -100,26 +468,55 @@ class QueryOptimizer:
         ).order_by(Record.date.desc()).limit(limit).all()
     
     @staticmethod
-    def optimize_stock_query(merchant_id, filters=None):
-        """优化库存查询"""
-        from models import Stock, Product
+    def optimize_stock_query(merchant_id=None, filters=None):
+        """优化库存查询：Stock⨝Product(⨝Merchant) 列投影，一次查询取回库存列表所需字段
+
+        merchant_id 为 None 时查询所有商户并附带商户名；返回查询对象，由调用方排序/取数。
+        filters 支持：site（按 Stock.site 筛选，'hk' 香港 / 'shenzhen' 深圳）、in_stock（仅数量>0）、
+        product_id、product_ids（产品ID列表）、location、low_stock、include_orphans（保留找不到产品的库存行）。
+        """
+        from models import Stock, Product, Merchant
         from extensions import db
-        
-        query = db.session.query(Stock, Product).join(
-            Product, Stock.product_id == Product.id
-        ).filter(
-            Stock.merchant_id == merchant_id,
-            Product.merchant_id == merchant_id
-        )
-        
+
+        filters = filters or {}
+        columns = [
+            Stock.id, Stock.product_id, Stock.merchant_id, Stock.box_spec, Stock.quantity,
+            Stock.batch_number, Stock.expiry_date, Stock.in_transit, Stock.daily_consumption,
+            Stock.location, Stock.unit_price, Stock.shenzhen_stock,
+            Product.name.label('name'), Product.category.label('category'),
+            Product.supplier.label('supplier'), Product.unit.label('unit')
+        ]
+        product_join = Product.id == Stock.product_id
+        if merchant_id is None:
+            columns.append(Merchant.name.label('merchant_name'))
+        else:
+            product_join = db.and_(product_join, Product.merchant_id == merchant_id)
+
+        query = db.session.query(*columns)
+        if filters.get('include_orphans'):
+            query = query.outerjoin(Product, product_join)
+        else:
+            query = query.join(Product, product_join)
+        if merchant_id is None:
+            query = query.join(Merchant, Merchant.id == Stock.merchant_id)
+        else:
+            query = query.filter(Stock.merchant_id == merchant_id)
+
         # 应用过滤条件
-        if filters:
-            if 'location' in filters and filters['location']:
-                query = query.filter(Stock.location == filters['location'])
-            if 'low_stock' in filters and filters['low_stock']:
-                query = query.filter(Stock.quantity < 10)
-        
-        return query.all()
+        if filters.get('site'):
+            query = query.filter(Stock.site == filters['site'])
+        if filters.get('in_stock'):
+            query = query.filter(Stock.quantity > 0)
+        if filters.get('product_id'):
+            query = query.filter(Stock.product_id == filters['product_id'])
+        if filters.get('product_ids') is not None:
+            query = query.filter(Stock.product_id.in_(filters['product_ids']))
+        if filters.get('location'):
+            query = query.filter(Stock.location == filters['location'])
+        if filters.get('low_stock'):
+            query = query.filter(Stock.quantity < 10)
+
+        return query
 
 # 批量操作优化
 class BatchOperations:
@@ -136,10 +533,103 @@ class BatchOperations:
         db.session.commit()
     
     @staticmethod
-    def bulk_update_stock(updates):
-        """批量更新库存"""
+    def bulk_update_stock(updates, commit=True):
+        """批量更新库存（commit=False 时由调用方在同一事务内继续处理后提交）"""
         from models import Stock
         from extensions import db
         
         db.session.bulk_update_mappings(Stock, updates)
-        db.session.commit()
\ No newline at end of file
+        if commit:
+            db.session.commit()
+
+    @staticmethod
+    def update_stock_by_product(merchant_id, values_by_product, columns):
+        """按产品批量更新商户下全部库存行的指定列（不提交），返回被更新的 [(库存ID, 产品ID)]
+
+        values_by_product 为 {产品ID: {列名: 值}}，未给出的列保持原值。PostgreSQL 上以一条
+        UPDATE ... FROM (VALUES ...) 完成；其他数据库先查出库存行主键，再按主键批量更新（executemany）。
+        """
+        from models import Stock
+        from extensions import db
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            values = db.values(
+                db.column('product_id', db.String),
+                *(db.column(name, Stock.__table__.c[name].type) for name in columns),
+                name='bulk_values'
+            ).data([
+                (product_id, *(values.get(name) for name in columns))
+                for product_id, values in values_by_product.items()
+            ])
+            stmt = db.update(Stock).where(
+                Stock.merchant_id == merchant_id,
+                Stock.product_id == values.c.product_id
+            ).values({
+                name: db.func.coalesce(db.cast(values.c[name], Stock.__table__.c[name].type), Stock.__table__.c[name])
+                for name in columns
+            }).returning(Stock.id, Stock.product_id).execution_options(synchronize_session=False)
+            return [tuple(row) for row in db.session.execute(stmt)]
+
+        stock_rows = db.session.query(Stock.id, Stock.product_id).filter(
+            Stock.merchant_id == merchant_id,
+            Stock.product_id.in_(list(values_by_product))
+        ).all()
+        if stock_rows:
+            db.session.bulk_update_mappings(Stock, [
+                dict(values_by_product[product_id], id=stock_id) for stock_id, product_id in stock_rows
+            ])
+        return [tuple(row) for row in stock_rows]
+
+    @staticmethod
+    def upsert_stock(rows):
+        """入库写入库存：同一唯一键（商户、产品、规格、批次、过期日期、库位）已有行时累加数量，否则插入新行
+
+        使用 INSERT ... ON CONFLICT DO UPDATE（PostgreSQL 与 SQLite），在当前事务中执行、由调用方提交。
+        Core 插入不经过模型校验器，rows 需带上 units_per_box 与 site；同一批中重复的键先在内存中合并，
+        避免单条语句内对同一行更新两次。
+        """
+        from models import Stock
+        from extensions import db
+
+        merged = {}
+        for row in rows:
+            key = Stock.identity_key(row)
+            if key in merged:
+                merged[key]['quantity'] += row['quantity']
+            else:
+                merged[key] = dict(row)
+        if not merged:
+            return
+
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            for row in merged.values():
+                stock = Stock.query.filter_by(**{
+                    name: row.get(name) for name in
+                    ('merchant_id', 'product_id', 'box_spec', 'batch_number', 'expiry_date', 'location')
+                }).first()
+                if stock:
+                    stock.quantity = (stock.quantity or 0) + row['quantity']
+                else:
+                    db.session.add(Stock(**row))
+            db.session.flush()
+            return
+
+        stmt = insert(Stock)
+        excluded = stmt.excluded
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(Stock.identity_exprs()),
+            set_={
+                'quantity': db.func.coalesce(Stock.quantity, 0) + excluded.quantity,
+                # 已有行的单价、在途、日均消耗保持不变，仅补齐为空的字段
+                'unit_price': db.func.coalesce(Stock.unit_price, excluded.unit_price),
+                'units_per_box': db.func.coalesce(Stock.units_per_box, excluded.units_per_box),
+                'in_transit': db.func.coalesce(Stock.in_transit, excluded.in_transit),
+                'daily_consumption': db.func.coalesce(Stock.daily_consumption, excluded.daily_consumption),
+            }
+        )
+        db.session.execute(stmt, list(merged.values()))
@@ -0,0 +1,55 @@
+"""
+用户权限解析缓存模块
+权限在会话内只解析一次：权限名集合连同 (用户ID, 权限版本号) 戳记保存在会话中，
+之后每次检查只比对当前用户行上的 permissions_version，不再查询权限表。
+更新权限、修改管理员状态、创建用户时调用 bump_permissions_version 使旧戳记失效；
+删除用户后其会话在加载用户时即失效，无需单独处理。
+"""
+from flask import g, has_request_context, session
+
+from extensions import db
+
+SESSION_KEY = 'permission_cache'
+
+
+def permissions_stamp(user):
+    return [user.id, user.permissions_version or 0]
+
+
+def user_permissions(user):
+    """返回用户的权限名集合；会话中的缓存戳记与用户当前版本一致时不访问数据库"""
+    if not has_request_context():
+        return user.permission_names()
+    stamp = permissions_stamp(user)
+    resolved = g.setdefault('resolved_permissions', {})
+    key = tuple(stamp)
+    if key in resolved:
+        return resolved[key]
+
+    cached = session.get(SESSION_KEY)
+    if cached and cached.get('stamp') == stamp:
+        names = frozenset(cached.get('names') or ())
+    else:
+        names = user.permission_names()
+        session[SESSION_KEY] = {'stamp': stamp, 'names': sorted(names)}
+    resolved[key] = names
+    return names
+
+
+def bump_permissions_version(*user_ids):
+    """在当前事务中递增用户权限版本号，需在写操作提交之前调用"""
+    from models import User
+
+    ids = {user_id for user_id in user_ids if user_id}
+    if ids:
+        db.session.query(User).filter(User.id.in_(ids)).update(
+            {User.permissions_version: User.permissions_version + 1},
+            synchronize_session=False
+        )
+
+
+def next_permissions_version():
+    """新用户的初始版本号取现有最大值 + 1，复用已删除用户的ID时也不会命中旧会话的缓存"""
+    from models import User
+
+    return (db.session.query(db.func.max(User.permissions_version)).scalar() or 0) + 1
@@ -0,0 +1,46 @@
+"""
+产品库存汇总表维护命令
+用法：
+  python scripts/inventory_summary_tool.py verify [商户ID]   对比汇总表与库存实时聚合结果，有漂移时以非零状态退出
+  python scripts/inventory_summary_tool.py rebuild [商户ID]  全量重建汇总表
+  python scripts/inventory_summary_tool.py repair [商户ID]   校验后仅重建存在漂移的商户
+"""
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+os.environ.setdefault("JOB_EXECUTOR", "off")
+from app import app
+from inventory_summary import rebuild_summaries, verify_summaries
+
+
+def main():
+    print("使用数据库:", os.environ.get("DATABASE_URL", "sqlite (默认)"))
+    mode = sys.argv[1] if len(sys.argv) > 1 else "verify"
+    merchant_id = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    with app.app_context():
+        if mode == "rebuild":
+            count = rebuild_summaries(merchant_id)
+            print(f"重建完成，共写入 {count} 行汇总")
+            return 0
+
+        drift = verify_summaries(merchant_id)
+        for item in drift[:50]:
+            print(f"  商户 {item['merchant_id']} 产品 {item['product_id']} {item['field']}: "
+                  f"应为 {item['expected']}，实际 {item['actual']}")
+        if len(drift) > 50:
+            print(f"  ……其余 {len(drift) - 50} 处省略")
+        if not drift:
+            print("校验通过，汇总表与库存一致")
+            return 0
+        print(f"发现 {len(drift)} 处漂移")
+
+        if mode == "repair":
+            for drift_merchant_id in sorted({item['merchant_id'] for item in drift}):
+                count = rebuild_summaries(drift_merchant_id)
+                print(f"已重建商户 {drift_merchant_id} 的汇总，共 {count} 行")
+            return 0
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
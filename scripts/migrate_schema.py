@@ -0,0 +1,38 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from app import app
+from extensions import db
+from migrations import ensure_schema, mark_data_migration, backfill_record_columns, backfill_units_per_box, backfill_stock_site, compact_stock_rows
+from inventory_summary import ensure_inventory_summaries
+from stock_ledger import ensure_stock_ledger
+
+
+def main():
+    print("使用数据库:", os.environ.get("DATABASE_URL", "sqlite (默认)"))
+    batch_size = int(os.environ.get("BATCH_SIZE", "500"))
+    with app.app_context():
+        print("创建缺失的表，补齐新增列与索引……")
+        db.create_all()
+        ensure_schema()
+        print("回填出入库记录结构化字段……")
+        count = backfill_record_columns(batch_size=batch_size)
+        mark_data_migration("record_columns")
+        print("解析规格回填每箱单位数……")
+        backfill_units_per_box(batch_size=batch_size)
+        mark_data_migration("units_per_box")
+        print("按库位回填库存站点……")
+        backfill_stock_site(batch_size=batch_size)
+        mark_data_migration("stock_site")
+        print("合并重复库存行并建立库存唯一索引……")
+        compact_stock_rows(batch_size=batch_size)
+        mark_data_migration("stock_compaction")
+        print("检查产品库存汇总表……")
+        ensure_inventory_summaries()
+        print("检查库存流水期初结存……")
+        ensure_stock_ledger()
+        print(f"完成迁移，共回填 {count} 条记录")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,32 @@
+"""
+将本地 SQLite 数据导入 Neon（或任意 DATABASE_URL 指向的数据库）
+用法：
+  python scripts/migrate_sqlite_to_neon.py               逐行检查并导入，最后一次性提交（适合少量数据）
+  python scripts/migrate_sqlite_to_neon.py bulk          批量导入：按主键分块读取、冲突跳过、每块提交并记录断点，中断后重跑即从断点继续
+  python scripts/migrate_sqlite_to_neon.py bulk-restart  清除断点后从头批量导入（已存在的行仍会跳过）
+环境变量：SQLITE_PATH 源库路径（默认 warehouse.db），BATCH_SIZE 每块行数（默认 1000）
+"""
 import os
 import sys
 import sqlite3
+import time
 from datetime import datetime, date
 
+import sqlalchemy as sa
+
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+# 命令行进程不启动应用内线程池
+os.environ.setdefault("JOB_EXECUTOR", "off")
 from app import app
 from extensions import db
+from inventory_summary import ensure_inventory_summaries
+from stock_ledger import ensure_stock_ledger
+from migrations import ensure_schema, drop_stock_identity_index, compact_stock_rows
 from models import (
     Merchant, Product, Stock, Record, User, Location,
-    Permission, UserPermission, ShenzhenRecord
+    Permission, UserPermission, ShenzhenRecord, StockMovement, StockSnapshot, StockSnapshotLine
 )
+from utils import parse_record_info, parse_units_per_box
 
 
 def parse_datetime(val):
@@ -43,6 +60,9 @@ def migrate(sqlite_path: str):
     cur = conn.cursor()
 
     with app.app_context():
+        # 源库可能有重复库存行，导入完成后再合并并建立库存唯一索引
+        drop_stock_identity_index()
+
         # Merchants
         for row in cur.execute("SELECT * FROM merchant"):
             if not Merchant.query.get(row["id"]):
@@ -132,6 +152,11 @@ def migrate(sqlite_path: str):
         # Records
         for row in cur.execute("SELECT * FROM record"):
             if not Record.query.get(row["id"]):
+                # 旧库没有结构化列时，从 additional_info 解析
+                fields = parse_record_info(row["additional_info"])
+                for key in fields:
+                    if key in row.keys() and row[key] is not None:
+                        fields[key] = parse_date(row[key]) if key == "expiry_date" else row[key]
                 db.session.add(Record(
                     id=row["id"],
                     product_id=row["product_id"],
@@ -140,7 +165,8 @@ def migrate(sqlite_path: str):
                     date=parse_datetime(row["date"]),
                     additional_info=row["additional_info"],
                     merchant_id=row["merchant_id"],
-                    operator_id=row["operator_id"]
+                    operator_id=row["operator_id"],
+                    **fields
                 ))
 
         # Shenzhen Records
@@ -160,11 +186,192 @@ def migrate(sqlite_path: str):
                 ))
 
         db.session.commit()
+        reset_sequences()
+        compact_stock_rows()
+        # 逐行模式不导入流水，按导入后的库存写入期初结存
+        ensure_stock_ledger()
         print("迁移完成：已将 SQLite 数据导入到 Neon")
 
 
+# 批量模式按外键依赖顺序导入的表
+BULK_MODELS = (Merchant, User, Permission, UserPermission, Product, Location, Stock, Record, ShenzhenRecord,
+               StockMovement, StockSnapshot, StockSnapshotLine)
+
+# 断点表只由本脚本使用，不放入应用模型
+checkpoint_table = sa.Table(
+    "migration_checkpoint", sa.MetaData(),
+    sa.Column("table_name", sa.String(50), primary_key=True),
+    sa.Column("last_key", sa.String(100)),
+    sa.Column("copied", sa.Integer, nullable=False, default=0),
+    sa.Column("done", sa.Boolean, nullable=False, default=False),
+    sa.Column("updated_at", sa.DateTime),
+)
+
+
+def dialect_insert(table):
+    """返回目标库方言的 insert 构造（支持 ON CONFLICT）"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise SystemExit(f"批量模式不支持的目标数据库: {dialect}")
+    return insert(table)
+
+
+def convert_row(model, row):
+    """把 SQLite 源行转换为目标表的列值：按列类型解析日期，补齐结构化字段与每箱单位数"""
+    columns = model.__table__.columns
+    values = {}
+    for key in row.keys():
+        if key not in columns:
+            continue
+        value = row[key]
+        column_type = columns[key].type
+        if isinstance(column_type, sa.DateTime):
+            value = parse_datetime(value)
+        elif isinstance(column_type, sa.Date):
+            value = parse_date(value)
+        elif isinstance(column_type, sa.Boolean) and value is not None:
+            value = bool(value)
+        values[key] = value
+    if model is Record:
+        # 旧库没有结构化列时，从 additional_info 解析
+        for key, value in parse_record_info(values.get("additional_info")).items():
+            if values.get(key) is None:
+                values[key] = value
+    if "units_per_box" in columns and values.get("units_per_box") is None:
+        values["units_per_box"] = parse_units_per_box(values.get("box_spec"))
+    return values
+
+
+def load_checkpoint(table_name):
+    return db.session.execute(
+        sa.select(checkpoint_table).where(checkpoint_table.c.table_name == table_name)
+    ).first()
+
+
+def save_checkpoint(table_name, last_key, copied, done=False):
+    """写入断点（不提交，与本块数据在同一事务内提交）"""
+    stmt = dialect_insert(checkpoint_table).values(
+        table_name=table_name,
+        last_key=None if last_key is None else str(last_key),
+        copied=copied,
+        done=done,
+        updated_at=datetime.now()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["table_name"],
+        set_={column: stmt.excluded[column] for column in ("last_key", "copied", "done", "updated_at")}
+    )
+    db.session.execute(stmt)
+
+
+def copy_table(conn, model, batch_size):
+    """按主键顺序分块复制一张表：每块一次 executemany（冲突跳过），与断点一起提交，返回本次处理行数"""
+    table = model.__table__
+    pk = list(table.primary_key.columns)[0]
+    source_tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if table.name not in source_tables:
+        print(f"{table.name}: 源库中不存在，跳过")
+        return 0
+
+    state = load_checkpoint(table.name)
+    if state is not None and state.done:
+        print(f"{table.name}: 已完成（共 {state.copied} 行），跳过")
+        return 0
+    last_key = state.last_key if state is not None else None
+    if last_key is not None and isinstance(pk.type, sa.Integer):
+        last_key = int(last_key)
+    copied = state.copied if state is not None else 0
+    if last_key is not None:
+        print(f"{table.name}: 从断点 {last_key} 继续（此前已处理 {copied} 行）")
+
+    stmt = dialect_insert(table).on_conflict_do_nothing()
+    started = time.time()
+    processed = 0
+    while True:
+        if last_key is None:
+            rows = conn.execute(
+                f'SELECT * FROM "{table.name}" ORDER BY "{pk.name}" LIMIT ?', (batch_size,)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                f'SELECT * FROM "{table.name}" WHERE "{pk.name}" > ? ORDER BY "{pk.name}" LIMIT ?',
+                (last_key, batch_size)
+            ).fetchall()
+        if not rows:
+            break
+        db.session.execute(stmt, [convert_row(model, row) for row in rows])
+        last_key = rows[-1][pk.name]
+        copied += len(rows)
+        processed += len(rows)
+        save_checkpoint(table.name, last_key, copied)
+        db.session.commit()
+        elapsed = max(time.time() - started, 1e-6)
+        print(f"{table.name}: 已处理 {copied} 行（{processed / elapsed:,.0f} 行/秒）")
+
+    save_checkpoint(table.name, last_key, copied, done=True)
+    db.session.commit()
+    return processed
+
+
+def reset_sequences():
+    """PostgreSQL 下把整数主键的序列推进到当前最大值，避免显式写入 id 后新增数据主键冲突"""
+    if db.session.get_bind().dialect.name != "postgresql":
+        return
+    preparer = db.session.get_bind().dialect.identifier_preparer
+    for model in BULK_MODELS:
+        table = model.__table__
+        pk = list(table.primary_key.columns)[0]
+        if not isinstance(pk.type, sa.Integer):
+            continue
+        quoted = preparer.quote(table.name)
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{quoted}', '{pk.name}'), "
+            f"COALESCE((SELECT MAX({pk.name}) FROM {quoted}), 1), "
+            f"(SELECT MAX({pk.name}) FROM {quoted}) IS NOT NULL)"
+        ))
+    db.session.commit()
+    print("已重置主键序列")
+
+
+def migrate_bulk(sqlite_path: str, batch_size=1000, restart=False):
+    conn = sqlite3.connect(sqlite_path)
+    conn.row_factory = sqlite3.Row
+
+    with app.app_context():
+        print("确保目标表与断点表存在……")
+        db.create_all()
+        ensure_schema()
+        # 源库可能有重复库存行（冲突跳过会丢失数量），导入完成后再合并并建立库存唯一索引
+        drop_stock_identity_index()
+        checkpoint_table.create(bind=db.engine, checkfirst=True)
+        if restart:
+            db.session.execute(checkpoint_table.delete())
+            db.session.commit()
+            print("已清除断点")
+
+        started = time.time()
+        total = 0
+        for model in BULK_MODELS:
+            total += copy_table(conn, model, batch_size)
+        reset_sequences()
+        compact_stock_rows(batch_size=batch_size)
+        ensure_inventory_summaries()
+        ensure_stock_ledger()
+        elapsed = max(time.time() - started, 1e-6)
+        print(f"批量迁移完成：本次处理 {total} 行，用时 {elapsed:.1f} 秒（{total / elapsed:,.0f} 行/秒）")
+    conn.close()
+
+
 if __name__ == "__main__":
     sqlite_path = os.environ.get("SQLITE_PATH", os.path.join(os.path.dirname(__file__), "..", "warehouse.db"))
     sqlite_path = os.path.abspath(sqlite_path)
+    mode = sys.argv[1] if len(sys.argv) > 1 else "once"
     print("从 SQLite 导入:", sqlite_path)
-    migrate(sqlite_path)
\ No newline at end of file
+    if mode in ("bulk", "bulk-restart"):
+        migrate_bulk(sqlite_path, batch_size=int(os.environ.get("BATCH_SIZE", "1000")), restart=mode == "bulk-restart")
+    else:
+        migrate(sqlite_path)
@@ -0,0 +1,46 @@
+"""
+后台任务命令行执行器
+用法：
+  python scripts/run_jobs.py                执行当前所有待执行任务后退出
+  python scripts/run_jobs.py loop           持续轮询执行（间隔由 JOB_POLL_INTERVAL 秒指定，默认 10）
+  python scripts/run_jobs.py enqueue-daily  为所有商户加入当日归档与库存快照任务并执行
+"""
+import os
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+# 命令行进程自行执行任务，不启动应用内线程池
+os.environ.setdefault("JOB_EXECUTOR", "off")
+from app import app, enqueue_archive_export, enqueue_stock_snapshot
+from extensions import db
+from jobs import run_pending_jobs
+from models import Merchant
+
+
+def main():
+    print("使用数据库:", os.environ.get("DATABASE_URL", "sqlite (默认)"))
+    mode = sys.argv[1] if len(sys.argv) > 1 else "once"
+    with app.app_context():
+        if mode == "enqueue-daily":
+            merchant_ids = [merchant_id for (merchant_id,) in db.session.query(Merchant.id).order_by(Merchant.id)]
+            queued = [job for job in (enqueue_archive_export(merchant_id) for merchant_id in merchant_ids) if job]
+            print(f"已加入 {len(queued)} 个商户的当日归档任务")
+            snapshots = [job for job in (enqueue_stock_snapshot(merchant_id) for merchant_id in merchant_ids) if job]
+            print(f"已加入 {len(snapshots)} 个商户的当日库存快照任务")
+
+        if mode == "loop":
+            interval = float(os.environ.get("JOB_POLL_INTERVAL", "10"))
+            print(f"开始轮询后台任务，间隔 {interval} 秒（Ctrl+C 退出）")
+            while True:
+                count = run_pending_jobs()
+                if count:
+                    print(f"已执行 {count} 个任务")
+                db.session.remove()
+                time.sleep(interval)
+        else:
+            count = run_pending_jobs()
+            print(f"完成，共执行 {count} 个任务")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+库存流水对账与快照命令
+用法：
+  python scripts/stock_ledger_tool.py reconcile [商户ID]  对比库存表与流水合计，有差异时以非零状态退出
+  python scripts/stock_ledger_tool.py repair [商户ID]     对账后追加校正流水，使流水合计与库存一致
+  python scripts/stock_ledger_tool.py snapshot [商户ID]   立即为商户生成库存快照（默认全部商户）
+"""
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+os.environ.setdefault("JOB_EXECUTOR", "off")
+from app import app
+from extensions import db
+from models import Merchant
+from stock_ledger import reconcile_stock, repair_ledger, take_snapshot
+
+
+def main():
+    print("使用数据库:", os.environ.get("DATABASE_URL", "sqlite (默认)"))
+    mode = sys.argv[1] if len(sys.argv) > 1 else "reconcile"
+    merchant_id = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    with app.app_context():
+        if mode == "snapshot":
+            merchant_ids = [merchant_id] if merchant_id is not None else [
+                row_id for (row_id,) in db.session.query(Merchant.id).order_by(Merchant.id)
+            ]
+            for current_id in merchant_ids:
+                snapshot = take_snapshot(current_id)
+                if snapshot is None:
+                    print(f"商户 {current_id} 没有新的流水，跳过")
+                else:
+                    print(f"商户 {current_id} 已生成快照 {snapshot.id}（截至流水 {snapshot.last_movement_id}，"
+                          f"{snapshot.line_count} 行）")
+            return 0
+
+        drift = reconcile_stock(merchant_id)
+        for item in drift[:50]:
+            print(f"  商户 {item['merchant_id']} 产品 {item['product_id']} 规格 {item['box_spec']} "
+                  f"批次 {item['batch_number']} 过期 {item['expiry_date']} 库位 {item['location']}: "
+                  f"库存 {item['stock']}，流水合计 {item['ledger']}")
+        if len(drift) > 50:
+            print(f"  ……其余 {len(drift) - 50} 处省略")
+        if not drift:
+            print("对账通过，库存与流水合计一致")
+            return 0
+        print(f"发现 {len(drift)} 处差异")
+
+        if mode == "repair":
+            count = repair_ledger(merchant_id)
+            print(f"已追加 {count} 条校正流水")
+            return 0
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,7 @@
 // Incoming operations (table UI): manage list and confirm incoming
 let incomingList = [];
+// 当前入库单的幂等键：收到服务端响应前重试沿用同一个键
+let incomingSubmitKey = null;
 
 function loadIncomingListFromStorage() {
     apiRequest('/api/merchants/current')
@@ -89,8 +91,19 @@ function removeFromIncomingList(index) {
 
 function recordIncoming() {
     if (incomingList.length === 0) { alert('待入库列表为空'); return; }
-    const incomingRequests = incomingList.map(item => apiRequest('/api/incoming', 'POST', { product_id: item.product_id, box_spec: item.box_spec, quantity: item.quantity, batch_number: item.batch_number, incoming_reason: item.incoming_reason, expiry_date: item.expiry_date, location: item.location }));
-    Promise.all(incomingRequests)
+    const items = incomingList.map(item => ({ product_id: item.product_id, box_spec: item.box_spec, quantity: item.quantity, batch_number: item.batch_number, incoming_reason: item.incoming_reason, expiry_date: item.expiry_date, location: item.location }));
+    // 整单一次提交，服务端单事务写入；任一行失败则整单不入库
+    incomingSubmitKey = incomingSubmitKey || newIdempotencyKey();
+    fetch('/api/incoming/batch', { method: 'POST', headers: { 'Content-Type': 'application/json', 'Idempotency-Key': incomingSubmitKey }, credentials: 'same-origin', body: JSON.stringify({ items }) })
+        .then(response => {
+            incomingSubmitKey = null;
+            if (response.status === 401) { if (typeof silentLogout === 'function') silentLogout(); throw new Error('会话已过期'); }
+            return response.json().then(body => {
+                if (response.ok && body.success) return body;
+                const failed = (body.results || []).filter(r => !r.success).map(r => `第${r.index + 1}行 ${incomingList[r.index] ? incomingList[r.index].product_name : ''}: ${r.message}`);
+                throw new Error([body.message || response.statusText, ...failed].join('\n'));
+            });
+        })
         .then(() => {
             const grouped = incomingList.reduce((acc, item) => { (acc[item.product_id] ||= { product_name: item.product_name, total_quantity: 0, specs: [] }); acc[item.product_id].total_quantity += item.quantity; acc[item.product_id].specs.push({ box_spec: item.box_spec, quantity: item.quantity, location: item.location }); return acc; }, {});
             let msg = '入库成功！\n\n';
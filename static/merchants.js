@@ -26,22 +26,5 @@ function legacyDeleteMerchant(merchantId) {
 }
 
 function exportStockToExcel() {
-    apiRequest('/api/stock')
-        .then(stocks => {
-            const headers = ['品名', '规格', '批次号', '库位', '数量', '总数', '过期日期'];
-            const wsData = [ headers, ...stocks.map(s => [
-                s.product_name,
-                s.box_spec,
-                s.batch_number || '-',
-                s.location || '-',
-                s.quantity,
-                s.total !== null ? s.total : '-',
-                s.expiry_date ? new Date(s.expiry_date).toLocaleDateString() : '-'
-            ]) ];
-            const wb = XLSX.utils.book_new();
-            const ws = XLSX.utils.aoa_to_sheet(wsData);
-            XLSX.utils.book_append_sheet(wb, ws, '库存');
-            XLSX.writeFile(wb, `库存_${new Date().toISOString().slice(0, 10)}.xlsx`);
-        })
-        .catch(error => { console.error('导出库存失败:', error); alert('导出库存失败'); });
-}
\ No newline at end of file
+    downloadFile('/api/export/stock');
+}
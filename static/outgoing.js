@@ -2,6 +2,8 @@
 
 // 出库列表状态
 let outgoingList = [];
+// 当前拣货单的幂等键：收到服务端响应前重试沿用同一个键
+let outgoingSubmitKey = null;
 
 // 从localStorage加载待出库列表
 function loadOutgoingListFromStorage() {
@@ -151,7 +153,7 @@ function showProductSpecs() {
     boxSpecSelect.innerHTML = '<option value="">请选择规格</option>';
 
     if (productId) {
-        fetch('/api/stock')
+        fetch(`/api/stock?product_id=${encodeURIComponent(productId)}`)
         .then(response => response.json())
         .then(stock => {
             const filteredStock = stock
@@ -244,7 +246,7 @@ function addToOutgoingList() {
         return;
     }
 
-    fetch('/api/stock')
+    fetch(`/api/stock?product_id=${encodeURIComponent(productId)}`)
         .then(response => response.json())
         .then(stock => {
             const selectedExpiryDate = boxSpecSelect.selectedIndex >= 0 ? boxSpecSelect.options[boxSpecSelect.selectedIndex].dataset.expiryDate : '';
@@ -302,6 +304,66 @@ function addToOutgoingList() {
         });
 }
 
+// 按效期自动分配：只提交产品、规格和数量，由服务端按 FEFO 选取批次（可拆分到多个批次），结果加入待出库列表
+function autoAllocateOutgoing() {
+    const productSelect = document.getElementById('outgoing-product-select');
+    const boxSpecSelect = document.getElementById('outgoing-box-spec');
+    const quantityInput = document.getElementById('outgoing-quantity');
+    const outgoingReasonElement = document.getElementById('outgoing-reason');
+
+    if (!productSelect || !boxSpecSelect || !quantityInput || !outgoingReasonElement) {
+        console.error('出库操作：找不到必需的DOM元素');
+        return;
+    }
+
+    const productId = productSelect.getProductId ? productSelect.getProductId() : productSelect.value;
+    const productName = productSelect.value || '未知产品';
+    const boxSpec = boxSpecSelect.value;
+    const quantity = parseInt(quantityInput.value);
+    const outgoingReason = outgoingReasonElement.value;
+
+    if (!productId || !boxSpec || !quantity || !outgoingReason) {
+        alert('请填写完整信息');
+        return;
+    }
+
+    apiRequest('/api/outgoing/allocate', 'POST', { product_id: productId, box_spec: boxSpec, quantity, strategy: 'fefo', preview: true })
+        .then(response => {
+            const allocations = (response.results && response.results[0] && response.results[0].allocations) || [];
+            const duplicated = allocations.some(a => outgoingList.some(item =>
+                item.product_id === productId && item.box_spec === a.box_spec &&
+                item.location === a.location && item.batch_number === a.batch_number
+            ));
+            if (duplicated) {
+                alert('分配到的批次已在待出库列表中');
+                return;
+            }
+            allocations.forEach(a => {
+                outgoingList.push({
+                    product_id: productId,
+                    product_name: productName,
+                    box_spec: a.box_spec,
+                    quantity: a.quantity,
+                    outgoing_reason: outgoingReason,
+                    batch_number: a.batch_number,
+                    expiry_date: a.expiry_date,
+                    location: a.location
+                });
+            });
+            updateOutgoingListDisplay();
+            saveOutgoingListToStorage();
+
+            quantityInput.value = '';
+            boxSpecSelect.value = '';
+            productSelect.value = '';
+            outgoingReasonElement.value = '生产';
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            alert('自动分配失败: ' + error.message);
+        });
+}
+
 // 确认出库
 function confirmOutgoing() {
     if (outgoingList.length === 0) {
@@ -309,29 +371,37 @@ function confirmOutgoing() {
         return;
     }
 
-    const promises = outgoingList.map(item => {
-        return fetch('/api/outgoing', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                product_id: item.product_id,
-                box_spec: item.box_spec,
-                quantity: item.quantity,
-                outgoing_reason: item.outgoing_reason,
-                location: item.location,
-                batch_number: item.batch_number,
-                expiry_date: item.expiry_date
-            })
-        }).then(response => response.json());
-    });
-
-    Promise.all(promises)
-        .then(results => {
-            const hasError = results.some(result => result.error);
-            if (hasError) {
-                alert('部分出库操作失败');
+    // 整张拣货单一次提交，服务端单事务扣减库存；任一行失败则整单不出库
+    const items = outgoingList.map(item => ({
+        product_id: item.product_id,
+        box_spec: item.box_spec,
+        quantity: item.quantity,
+        outgoing_reason: item.outgoing_reason,
+        location: item.location,
+        batch_number: item.batch_number,
+        expiry_date: item.expiry_date
+    }));
+
+    outgoingSubmitKey = outgoingSubmitKey || newIdempotencyKey();
+    fetch('/api/outgoing/batch', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Idempotency-Key': outgoingSubmitKey
+        },
+        credentials: 'same-origin',
+        body: JSON.stringify({ items })
+    })
+        .then(response => {
+            outgoingSubmitKey = null;
+            return response.json();
+        })
+        .then(result => {
+            if (result.error) {
+                const failed = (result.results || [])
+                    .filter(line => !line.success)
+                    .map(line => `${outgoingList[line.index] ? outgoingList[line.index].product_name : ''}: ${line.message}`);
+                alert([result.message || '出库操作失败', ...failed].join('\n'));
             } else {
                 alert('出库操作成功');
                 outgoingList = [];
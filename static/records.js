@@ -40,107 +40,135 @@ function populateRecordFilters() {
     }
 
     const operatorFilter = document.getElementById('record-operator-filter');
-    if (operatorFilter) {
-        operatorFilter.innerHTML = '<option value="">全部操作人</option>';
-        apiRequest('/api/records')
-            .then(records => {
-                if (!Array.isArray(records)) { console.error('返回的records不是数组:', records); return; }
-                const operators = [...new Set(records.map(record => record.operator).filter(Boolean))];
-                operators.forEach(operator => {
-                    const option = document.createElement('option');
-                    option.value = operator;
-                    option.textContent = operator;
-                    operatorFilter.appendChild(option);
-                });
-            })
-            .catch(error => { console.error('加载操作人列表失败:', error); });
-    }
-
     const reasonFilter = document.getElementById('record-reason-filter');
-    if (reasonFilter) {
-        reasonFilter.innerHTML = '<option value="">全部原因</option>';
-        apiRequest('/api/records')
-            .then(records => {
-                if (!Array.isArray(records)) { console.error('返回的records不是数组:', records); return; }
-                const reasons = [...new Set(records.map(record => record.reason).filter(Boolean))];
-                reasons.forEach(reason => {
-                    const option = document.createElement('option');
-                    option.value = reason;
-                    option.textContent = reason;
-                    reasonFilter.appendChild(option);
-                });
+    if (operatorFilter) operatorFilter.innerHTML = '<option value="">全部操作人</option>';
+    if (reasonFilter) reasonFilter.innerHTML = '<option value="">全部原因</option>';
+    if (operatorFilter || reasonFilter) {
+        apiRequest('/api/records/filters')
+            .then(options => {
+                const fill = (select, values) => {
+                    if (!select) return;
+                    (values || []).forEach(value => {
+                        const option = document.createElement('option');
+                        option.value = value;
+                        option.textContent = value;
+                        select.appendChild(option);
+                    });
+                };
+                fill(operatorFilter, options.operators);
+                fill(reasonFilter, options.reasons);
             })
-            .catch(error => { console.error('加载操作原因列表失败:', error); });
+            .catch(error => { console.error('加载操作人/原因列表失败:', error); });
     }
 }
 
-function displayRecords() {
-    const productFilterEl = document.getElementById('record-product-filter');
-    const operationFilterEl = document.getElementById('record-operation-filter');
-    const locationFilterEl = document.getElementById('record-location-filter');
-    const startDateFilterEl = document.getElementById('record-start-date-filter');
-    const endDateFilterEl = document.getElementById('record-end-date-filter');
-    const reasonFilterEl = document.getElementById('record-reason-filter');
-    const operatorFilterEl = document.getElementById('record-operator-filter');
-    if (!productFilterEl || !operationFilterEl || !locationFilterEl || !startDateFilterEl || !endDateFilterEl || !reasonFilterEl || !operatorFilterEl) {
-        console.debug('记录筛选元素不存在');
-        return;
-    }
+// 记录列表当前已加载的数据（编辑弹窗从这里取值，避免再次拉取全部记录）
+let currentRecords = [];
+// 记录列表每页条数
+const RECORD_PAGE_SIZE = 100;
 
-    const productFilter = productFilterEl.value;
-    const operationFilter = operationFilterEl.value;
-    const locationFilter = locationFilterEl.value;
-    const startDateFilter = startDateFilterEl.value;
-    const endDateFilter = endDateFilterEl.value;
-    const reasonFilter = reasonFilterEl.value;
-    const operatorFilter = operatorFilterEl.value;
+// 从筛选控件生成 /api/records 查询参数，筛选在服务端完成
+function getRecordQueryParams() {
+    const ids = ['record-product-filter', 'record-operation-filter', 'record-location-filter', 'record-start-date-filter', 'record-end-date-filter', 'record-reason-filter', 'record-operator-filter'];
+    const els = ids.map(id => document.getElementById(id));
+    if (els.some(el => !el)) return null;
+    const [product, operation, location, startDate, endDate, reason, operator] = els.map(el => el.value);
 
-    let defaultStartDate = null;
-    if (!startDateFilter && !endDateFilter) {
-        defaultStartDate = new Date();
+    const params = { limit: RECORD_PAGE_SIZE };
+    if (product) params.product_id = product;
+    if (operation) params.operation_type = operation;
+    if (location) params.location = location;
+    if (reason) params.reason = reason;
+    if (operator) params.operator = operator;
+    if (startDate) params.start_date = startDate;
+    if (endDate) params.end_date = endDate;
+    if (!startDate && !endDate) {
+        // 默认只查最近30天
+        const defaultStartDate = new Date();
         defaultStartDate.setDate(defaultStartDate.getDate() - 30);
-        defaultStartDate.setHours(0, 0, 0, 0);
+        const pad = n => String(n).padStart(2, '0');
+        params.start_date = `${defaultStartDate.getFullYear()}-${pad(defaultStartDate.getMonth() + 1)}-${pad(defaultStartDate.getDate())}`;
     }
+    return params;
+}
 
-    apiRequest('/api/records')
-        .then(records => {
-            const filteredRecords = records.filter(record => {
-                const matchProduct = !productFilter || record.product_id === productFilter;
-                const matchOperation = !operationFilter || record.operation_type === operationFilter;
-                const matchLocation = !locationFilter || record.location === locationFilter;
-                const recordDate = new Date(record.date); recordDate.setHours(0, 0, 0, 0);
-                let matchDate = true;
-                if (startDateFilter) { const startDate = new Date(startDateFilter); startDate.setHours(0, 0, 0, 0); matchDate = matchDate && recordDate >= startDate; }
-                else if (defaultStartDate) { matchDate = matchDate && recordDate >= defaultStartDate; }
-                if (endDateFilter) { const endDate = new Date(endDateFilter); endDate.setHours(0, 0, 0, 0); matchDate = matchDate && recordDate <= endDate; }
-                const matchReason = !reasonFilter || record.reason === reasonFilter;
-                const matchOperator = !operatorFilter || record.operator === operatorFilter;
-                return matchProduct && matchOperation && matchLocation && matchDate && matchReason && matchOperator;
-            });
+// 每次重新查询时递增，丢弃筛选变更之前发出的翻页请求的结果
+let recordQueryGeneration = 0;
 
-            const recordListBody = document.getElementById('record-list-body');
-            if (!recordListBody) return;
-            recordListBody.innerHTML = '';
-            filteredRecords.forEach(record => {
-                const row = document.createElement('tr');
-                row.innerHTML = `
-                    <td>${convertToBeijingTime(record.date)}</td>
-                    <td>${record.product_name}</td>
-                    <td>${record.operation_type}</td>
-                    <td>${record.location || '-'}</td>
-                    <td>${record.quantity}</td>
-                    <td>${record.box_spec || '-'}</td>
-                    <td>${record.total || 0}</td>
-                    <td>${record.batch_number || '-'}</td>
-                    <td>${record.expiry_date ? new Date(record.expiry_date).toLocaleDateString() : '-'}</td>
-                    <td>${record.reason || '-'}</td>
-                    <td>${record.operator || '未知'}</td>
-                    <td><button class="small-button" onclick="openEditRecordModal('${record.id}')">修改</button></td>
-                `;
-                recordListBody.appendChild(row);
-            });
-        })
+function renderRecordRow(record) {
+    const row = document.createElement('tr');
+    row.innerHTML = `
+        <td>${convertToBeijingTime(record.date)}</td>
+        <td>${record.product_name}</td>
+        <td>${record.operation_type}</td>
+        <td>${record.location || '-'}</td>
+        <td>${record.quantity}</td>
+        <td>${record.box_spec || '-'}</td>
+        <td>${record.total || 0}</td>
+        <td>${record.batch_number || '-'}</td>
+        <td>${record.expiry_date ? new Date(record.expiry_date).toLocaleDateString() : '-'}</td>
+        <td>${record.reason || '-'}</td>
+        <td>${record.operator || '未知'}</td>
+        <td><button class="small-button" onclick="openEditRecordModal('${record.id}')">修改</button></td>
+    `;
+    return row;
+}
+
+// 在表格末尾放置“加载更多”行，点击后按游标拉取下一页
+function appendLoadMoreRow(tbody, colSpan, loadedCount, onLoadMore) {
+    const tr = document.createElement('tr');
+    tr.className = 'load-more-row';
+    const td = document.createElement('td');
+    td.colSpan = colSpan;
+    td.style.textAlign = 'center';
+    const button = document.createElement('button');
+    button.className = 'small-button';
+    button.textContent = `加载更多（已显示 ${loadedCount} 条）`;
+    button.onclick = () => {
+        button.disabled = true;
+        button.textContent = '加载中...';
+        onLoadMore().catch(error => {
+            console.error('加载更多记录失败:', error);
+            alert('加载更多记录失败');
+            button.disabled = false;
+            button.textContent = `加载更多（已显示 ${loadedCount} 条）`;
+        });
+    };
+    td.appendChild(button);
+    tr.appendChild(td);
+    tbody.appendChild(tr);
+}
+
+// 只加载一页，下一页在点击“加载更多”时拉取，页面开销由每页条数决定，与历史记录总量无关
+function loadRecordPage(params, cursor, generation) {
+    return apiRequestPage('/api/records', params, cursor).then(({ items, nextCursor }) => {
+        if (generation !== recordQueryGeneration) return;
+        const recordListBody = document.getElementById('record-list-body');
+        if (!recordListBody) return;
+        const loadMoreRow = recordListBody.querySelector('.load-more-row');
+        if (loadMoreRow) loadMoreRow.remove();
+        currentRecords.push(...items);
+        items.forEach(record => recordListBody.appendChild(renderRecordRow(record)));
+        if (nextCursor) {
+            appendLoadMoreRow(recordListBody, 12, currentRecords.length, () => loadRecordPage(params, nextCursor, generation));
+        }
+    });
+}
+
+function displayRecords() {
+    const params = getRecordQueryParams();
+    if (!params) {
+        console.debug('记录筛选元素不存在');
+        return;
+    }
+
+    const generation = ++recordQueryGeneration;
+    currentRecords = [];
+    const recordListBody = document.getElementById('record-list-body');
+    if (recordListBody) recordListBody.innerHTML = '';
+    loadRecordPage(params, null, generation)
         .catch(error => {
+            if (generation !== recordQueryGeneration) return;
             console.error('加载记录失败:', error);
             const recordListBody = document.getElementById('record-list-body');
             if (recordListBody) {
@@ -153,9 +181,9 @@ function displayRecords() {
 }
 
 function showProductRecords(productId, productName) {
-    apiRequest(`/api/records?product_id=${productId}`)
-        .then(records => {
-            records = records.filter(record => record.product_id === productId);
+    const params = { product_id: productId, limit: RECORD_PAGE_SIZE };
+    apiRequestPage('/api/records', params)
+        .then(({ items: records, nextCursor }) => {
             const modal = document.createElement('div');
             modal.style.position = 'fixed'; modal.style.top = '0'; modal.style.left = '0';
             modal.style.width = '100%'; modal.style.height = '100%';
@@ -169,18 +197,29 @@ function showProductRecords(productId, productName) {
             const thead = document.createElement('thead'); thead.innerHTML = `
                 <tr><th>日期</th><th>操作类型</th><th>数量</th><th>规格</th><th>批次号</th><th>库位</th><th>原因</th></tr>`;
             const tbody = document.createElement('tbody');
-            records.forEach(record => {
-                const tr = document.createElement('tr');
-                tr.innerHTML = `
-                    <td>${new Date(record.date).toLocaleDateString()}</td>
-                    <td>${record.operation_type === 'incoming' ? '入库' : (record.operation_type === 'outgoing' ? '出库' : record.operation_type || '未知')}</td>
-                    <td>${record.quantity}</td>
-                    <td>${record.box_spec}</td>
-                    <td>${record.batch_number}</td>
-                    <td>${record.location}</td>
-                    <td>${record.reason}</td>`;
-                tbody.appendChild(tr);
-            });
+            let loadedCount = 0;
+            const appendPage = (pageRecords, cursor) => {
+                const loadMoreRow = tbody.querySelector('.load-more-row');
+                if (loadMoreRow) loadMoreRow.remove();
+                pageRecords.forEach(record => {
+                    const tr = document.createElement('tr');
+                    tr.innerHTML = `
+                        <td>${new Date(record.date).toLocaleDateString()}</td>
+                        <td>${record.operation_type === 'incoming' ? '入库' : (record.operation_type === 'outgoing' ? '出库' : record.operation_type || '未知')}</td>
+                        <td>${record.quantity}</td>
+                        <td>${record.box_spec}</td>
+                        <td>${record.batch_number}</td>
+                        <td>${record.location}</td>
+                        <td>${record.reason}</td>`;
+                    tbody.appendChild(tr);
+                });
+                loadedCount += pageRecords.length;
+                if (cursor) {
+                    appendLoadMoreRow(tbody, 7, loadedCount, () => apiRequestPage('/api/records', params, cursor)
+                        .then(page => appendPage(page.items, page.nextCursor)));
+                }
+            };
+            appendPage(records, nextCursor);
             table.appendChild(thead); table.appendChild(tbody); modalContent.appendChild(table); modalContent.appendChild(closeBtn);
             modal.appendChild(modalContent); document.body.appendChild(modal);
         })
@@ -188,67 +227,15 @@ function showProductRecords(productId, productName) {
 }
 
 function exportRecordsToExcel() {
-    const productFilterEl = document.getElementById('record-product-filter');
-    const operationFilterEl = document.getElementById('record-operation-filter');
-    const locationFilterEl = document.getElementById('record-location-filter');
-    const startDateFilterEl = document.getElementById('record-start-date-filter');
-    const endDateFilterEl = document.getElementById('record-end-date-filter');
-    const reasonFilterEl = document.getElementById('record-reason-filter');
-    const operatorFilterEl = document.getElementById('record-operator-filter');
-    if (!productFilterEl || !operationFilterEl || !locationFilterEl || !startDateFilterEl || !endDateFilterEl || !reasonFilterEl || !operatorFilterEl) {
+    const params = getRecordQueryParams();
+    if (!params) {
         console.error('记录筛选元素不存在，无法导出');
         return;
     }
-    const productFilter = productFilterEl.value;
-    const operationFilter = operationFilterEl.value;
-    const locationFilter = locationFilterEl.value;
-    const startDateFilter = startDateFilterEl.value;
-    const endDateFilter = endDateFilterEl.value;
-    const reasonFilter = reasonFilterEl.value;
-    const operatorFilter = operatorFilterEl.value;
-
-    let defaultStartDate = null;
-    if (!startDateFilter && !endDateFilter) {
-        defaultStartDate = new Date(); defaultStartDate.setDate(defaultStartDate.getDate() - 30); defaultStartDate.setHours(0, 0, 0, 0);
-    }
-
-    apiRequest('/api/records')
-        .then(records => {
-            const filteredRecords = records.filter(record => {
-                const matchProduct = !productFilter || record.product_id === productFilter;
-                const matchOperation = !operationFilter || record.operation_type === operationFilter;
-                const matchLocation = !locationFilter || record.location === locationFilter;
-                const recordDate = new Date(record.date); recordDate.setHours(0, 0, 0, 0);
-                let matchDate = true;
-                if (startDateFilter) { const startDate = new Date(startDateFilter); startDate.setHours(0, 0, 0, 0); matchDate = matchDate && recordDate >= startDate; }
-                else if (defaultStartDate) { matchDate = matchDate && recordDate >= defaultStartDate; }
-                if (endDateFilter) { const endDate = new Date(endDateFilter); endDate.setHours(0, 0, 0, 0); matchDate = matchDate && recordDate <= endDate; }
-                const matchReason = !reasonFilter || record.reason === reasonFilter;
-                const matchOperator = !operatorFilter || record.operator === operatorFilter;
-                return matchProduct && matchOperation && matchLocation && matchDate && matchReason && matchOperator;
-            });
 
-            const headers = ['日期', '品名', '操作类型', '库位', '数量', '规格', '总数', '批次号', '过期日期', '操作原因', '操作人'];
-            const wsData = [ headers, ...filteredRecords.map(record => [
-                record.date,
-                record.product_name,
-                record.operation_type,
-                record.location,
-                record.quantity,
-                record.box_spec,
-                record.total || 0,
-                record.batch_number || '-',
-                record.expiry_date ? new Date(record.expiry_date).toLocaleDateString() : '-',
-                record.reason || '-',
-                record.operator || '未知'
-            ]) ];
-
-            const wb = XLSX.utils.book_new();
-            const ws = XLSX.utils.aoa_to_sheet(wsData);
-            XLSX.utils.book_append_sheet(wb, ws, '出入库记录');
-            XLSX.writeFile(wb, `出入库记录_${new Date().toISOString().slice(0, 10)}.xlsx`);
-        })
-        .catch(error => { console.error('导出记录失败:', error); alert('导出记录失败'); });
+    // 导出不分页，由后端按当前筛选条件流式生成Excel
+    delete params.limit;
+    downloadFile('/api/export/records', params);
 }
 
 function resetRecordFilters() {
@@ -272,37 +259,33 @@ function resetRecordFilters() {
 function openEditRecordModal(recordId) {
     getCurrentUser().then(user => {
         if (!user || !user.is_admin) { alert('只有管理员可以修改记录'); return; }
-        apiRequest('/api/records')
-            .then(records => {
-                const record = records.find(r => String(r.id) === String(recordId));
-                if (record) {
-                    const editRecordId = document.getElementById('edit-record-id');
-                    const editRecordProduct = document.getElementById('edit-record-product');
-                    const editRecordOperation = document.getElementById('edit-record-operation');
-                    const editRecordQuantity = document.getElementById('edit-record-quantity');
-                    const editRecordBoxSpec = document.getElementById('edit-record-box-spec');
-                    const editRecordReason = document.getElementById('edit-record-reason');
-                    const editRecordBatchNumber = document.getElementById('edit-record-batch-number');
-                    const editRecordExpiryDate = document.getElementById('edit-record-expiry-date');
-                    const editRecordModal = document.getElementById('edit-record-modal');
-                    if (editRecordId) editRecordId.value = record.id;
-                    if (editRecordProduct) editRecordProduct.value = record.product_name;
-                    if (editRecordOperation) editRecordOperation.value = record.operation_type;
-                    if (editRecordQuantity) editRecordQuantity.value = record.quantity;
-                    if (editRecordBoxSpec) editRecordBoxSpec.value = record.box_spec || '';
-                    if (editRecordReason) editRecordReason.value = record.reason || '';
-                    if (editRecordBatchNumber) editRecordBatchNumber.value = record.batch_number || '';
-                    if (editRecordExpiryDate) {
-                        if (record.expiry_date) {
-                            const expiryDate = new Date(record.expiry_date);
-                            const formattedDate = expiryDate.toISOString().split('T')[0];
-                            editRecordExpiryDate.value = formattedDate;
-                        } else { editRecordExpiryDate.value = ''; }
-                    }
-                    if (editRecordModal) editRecordModal.style.display = 'block';
-                } else { alert('找不到记录'); }
-            })
-            .catch(error => { console.error('获取记录失败:', error); alert('获取记录失败: ' + error); });
+        const record = currentRecords.find(r => String(r.id) === String(recordId));
+        if (record) {
+            const editRecordId = document.getElementById('edit-record-id');
+            const editRecordProduct = document.getElementById('edit-record-product');
+            const editRecordOperation = document.getElementById('edit-record-operation');
+            const editRecordQuantity = document.getElementById('edit-record-quantity');
+            const editRecordBoxSpec = document.getElementById('edit-record-box-spec');
+            const editRecordReason = document.getElementById('edit-record-reason');
+            const editRecordBatchNumber = document.getElementById('edit-record-batch-number');
+            const editRecordExpiryDate = document.getElementById('edit-record-expiry-date');
+            const editRecordModal = document.getElementById('edit-record-modal');
+            if (editRecordId) editRecordId.value = record.id;
+            if (editRecordProduct) editRecordProduct.value = record.product_name;
+            if (editRecordOperation) editRecordOperation.value = record.operation_type;
+            if (editRecordQuantity) editRecordQuantity.value = record.quantity;
+            if (editRecordBoxSpec) editRecordBoxSpec.value = record.box_spec || '';
+            if (editRecordReason) editRecordReason.value = record.reason || '';
+            if (editRecordBatchNumber) editRecordBatchNumber.value = record.batch_number || '';
+            if (editRecordExpiryDate) {
+                if (record.expiry_date) {
+                    const expiryDate = new Date(record.expiry_date);
+                    const formattedDate = expiryDate.toISOString().split('T')[0];
+                    editRecordExpiryDate.value = formattedDate;
+                } else { editRecordExpiryDate.value = ''; }
+            }
+            if (editRecordModal) editRecordModal.style.display = 'block';
+        } else { alert('找不到记录'); }
     });
 }
 
@@ -477,43 +477,15 @@ function deleteMerchant(merchantId) {
 
 // Excel导出函数，将当前库存数据导出为Excel文件，支持数据过滤
 function exportStockToExcel() {
-    apiRequest('/api/stock')
-        .then(stockItems => {
-            const headers = ['产品编号', '品名', '产品类别', '供应商', '香港库存', '深圳库存', '在途数量', '每日消耗', '规格', '库位', '批次号', '过期日期'];
-            const filteredStockItems = stockItems.filter(item => item.quantity > 0);
-
-            const wsData = [
-                headers,
-                ...filteredStockItems.map(item => [
-                    item.product_id,
-                    item.name,
-                    item.category,
-                    item.supplier,
-                    item.quantity,
-                    item.shenzhen_stock || 0,
-                    item.in_transit || 0,
-                    item.daily_consumption || 0,
-                    item.box_spec,
-                    item.location,
-                    item.batch_number || '',
-                    item.expiry_date || ''
-                ])
-            ];
-
-            const wb = XLSX.utils.book_new();
-            const ws = XLSX.utils.aoa_to_sheet(wsData);
-            XLSX.utils.book_append_sheet(wb, ws, '库存');
-            XLSX.writeFile(wb, '库存盘点.xlsx');
-        })
-        .catch(error => alert('导出库存失败: ' + error.message));
+    // 由后端流式生成Excel并直接下载
+    downloadFile('/api/export/stock');
 }
 
 // 批量上传Excel修改每日消耗
 function uploadDailyConsumptionExcel() {
-    // 创建一个隐藏的文件输入元素
     const fileInput = document.createElement('input');
     fileInput.type = 'file';
-    fileInput.accept = '.xlsx, .xls';
+    fileInput.accept = '.xlsx';
     fileInput.style.display = 'none';
     document.body.appendChild(fileInput);
     
@@ -523,87 +495,41 @@ function uploadDailyConsumptionExcel() {
     // 监听文件选择事件
     fileInput.addEventListener('change', function(e) {
         const file = e.target.files[0];
+        document.body.removeChild(fileInput);
         if (!file) {
-            document.body.removeChild(fileInput);
             return;
         }
         
-        const reader = new FileReader();
-        reader.onload = function(e) {
-            try {
-                const data = new Uint8Array(e.target.result);
-                const workbook = XLSX.read(data, {type: 'array'});
-                
-                // 获取第一个工作表
-                const worksheet = workbook.Sheets[workbook.SheetNames[0]];
-                
-                // 将工作表转换为JSON
-                const jsonData = XLSX.utils.sheet_to_json(worksheet);
-                
-                if (jsonData.length === 0) {
-                    alert('Excel文件为空');
-                    document.body.removeChild(fileInput);
+        // 整个文件一次上传，由后端解析并批量更新
+        const formData = new FormData();
+        formData.append('file', file);
+        
+        fetch('/api/stock/bulk-update', {
+            method: 'POST',
+            body: formData
+        })
+            .then(response => response.json())
+            .then(result => {
+                if (!result.success) {
+                    const invalid = (result.invalid || []).map(item => `第${item.row}行: ${item.message}`).join('\n');
+                    alert('批量更新失败: ' + result.message + (invalid ? '\n' + invalid : ''));
                     return;
                 }
-                
-                // 检查Excel文件是否包含必要的列
-                const firstRow = jsonData[0];
-                if (!('产品编号' in firstRow) || !('每日消耗' in firstRow)) {
-                    alert('Excel文件格式不正确，必须包含"产品编号"和"每日消耗"列');
-                    document.body.removeChild(fileInput);
-                    return;
+                let message = result.message;
+                if (result.not_found && result.not_found.length) {
+                    message += `\n未找到库存的产品编号: ${result.not_found.join(', ')}`;
                 }
-                
-                // 准备更新数据
-                const updatePromises = [];
-                
-                jsonData.forEach(row => {
-                    const productId = row['产品编号'];
-                    const dailyConsumption = parseFloat(row['每日消耗']) || 0;
-                    
-                    if (productId) {
-                        // 创建更新请求，只发送每日消耗数据
-                        const updatePromise = fetch('/api/stock/update', {
-                            method: 'POST',
-                            headers: {
-                                'Content-Type': 'application/json'
-                            },
-                            body: JSON.stringify({
-                                product_id: productId,
-                                daily_consumption: dailyConsumption
-                            })
-                        }).then(response => response.json());
-                        
-                        updatePromises.push(updatePromise);
-                    }
-                });
-                
-                // 处理所有更新请求
-                Promise.all(updatePromises)
-                    .then(results => {
-                        const successCount = results.filter(result => result.success).length;
-                        alert(`批量更新成功，共更新${successCount}条记录`);
-                        // 更新库存列表显示
-                        displayStockList();
-                    })
-                    .catch(error => {
-                        console.error('批量更新失败:', error);
-                        alert('批量更新失败: ' + error.message);
-                    });
-            } catch (error) {
-                console.error('处理Excel文件失败:', error);
-                alert('处理Excel文件失败: ' + error.message);
-            } finally {
-                document.body.removeChild(fileInput);
-            }
-        };
-        
-        reader.onerror = function() {
-            alert('读取文件失败');
-            document.body.removeChild(fileInput);
-        };
-        
-        reader.readAsArrayBuffer(file);
+                if (result.invalid && result.invalid.length) {
+                    message += `\n已跳过${result.invalid.length}行无效数据`;
+                }
+                alert(message);
+                // 更新库存列表显示
+                displayStockList();
+            })
+            .catch(error => {
+                console.error('批量更新失败:', error);
+                alert('批量更新失败: ' + error.message);
+            });
     });
 }
 
@@ -8,7 +8,7 @@ function toggleStockoutCalculation() {
     if (button) {
         button.textContent = `切换断货风险计算（当前：${includeShenzhenStock ? '深圳+香港' : '仅香港'}）`;
     }
-    displayStockList();
+    renderStockList();
 }
 
 let currentSortField = 'product_id';
@@ -22,7 +22,7 @@ function sortStockList(field) {
         currentSortDirection = 'asc';
     }
     updateSortIndicators();
-    displayStockList();
+    renderStockList();
 }
 
 function updateSortIndicators() {
@@ -36,219 +36,290 @@ function updateSortIndicators() {
     }
 }
 
-function displayStockList() {
-    const categoryFilter = document.getElementById('stock-category-filter');
-    const selectedCategory = categoryFilter ? categoryFilter.value : '';
+// 库存列表本地副本：首次全量加载，之后按变更流（/api/changes）只重新拉取有变化的产品
+let stockState = null;
+let stockSyncQueue = Promise.resolve();
+let stockChangeSource = null;
+// 一次变更涉及的产品过多时直接全量重新加载
+const STOCK_DELTA_MAX_PRODUCTS = 100;
 
-    Promise.all([
+function loadStockState() {
+    // 先取游标再加载列表：期间发生的变更会在下次同步时再应用一次，不会遗漏
+    return fetchChanges().then(feed => Promise.all([
         apiRequest('/api/stock'),
         apiRequest('/api/shenzhen/stock')
-    ])
-    .then(([stock, szStock]) => {
-        const categories = new Set();
-        stock.forEach(item => categories.add(item.category));
-        szStock.forEach(item => categories.add(item.category));
-
-        if (categoryFilter) {
-            categoryFilter.innerHTML = '<option value="">所有类别</option>' +
-                Array.from(categories).map(cat =>
-                    `<option value="${cat}" ${selectedCategory === cat ? 'selected' : ''}>${cat}</option>`
-                ).join('');
-        }
+    ]).then(([stock, szStock]) => {
+        stockState = { merchantId: feed.merchant_id, cursor: feed.cursor, hk: stock, sz: szStock };
+    }));
+}
 
-        updateSortIndicators();
-
-        const groupedStock = {};
-
-        // 常规库存（不包含深圳）
-        stock.forEach(item => {
-            if (selectedCategory && item.category !== selectedCategory) return;
-            if (!groupedStock[item.product_id]) {
-                groupedStock[item.product_id] = {
-                    product_id: item.product_id,
-                    name: item.name,
-                    category: item.category,
-                    supplier: item.supplier,
-                    unit: item.unit,
-                    total_stock: 0,
-                    in_transit: item.in_transit || 0,
-                    daily_consumption: item.daily_consumption || 0,
-                    shenzhen_stock: 0,
-                    specs: []
-                };
-            }
+function applyStockChanges(feed) {
+    if (!stockState || feed.reset || feed.merchant_id !== stockState.merchantId) return loadStockState();
+    if (feed.cursor <= stockState.cursor && !(feed.changes || []).length) return Promise.resolve();
+    const productIds = new Set();
+    (feed.changes || []).forEach(change => {
+        if (change.entity === 'stock' || change.entity === 'product') productIds.add(String(change.id));
+    });
+    if (!productIds.size) {
+        stockState.cursor = Math.max(stockState.cursor, feed.cursor);
+        return Promise.resolve();
+    }
+    if (productIds.size > STOCK_DELTA_MAX_PRODUCTS) return loadStockState();
+
+    const query = `product_ids=${encodeURIComponent(Array.from(productIds).join(','))}`;
+    return Promise.all([
+        apiRequest(`/api/stock?${query}`),
+        apiRequest(`/api/shenzhen/stock?${query}`)
+    ]).then(([stock, szStock]) => {
+        const unchanged = item => !productIds.has(String(item.product_id));
+        stockState = {
+            merchantId: stockState.merchantId,
+            cursor: Math.max(stockState.cursor, feed.cursor),
+            hk: stockState.hk.filter(unchanged).concat(stock),
+            sz: stockState.sz.filter(unchanged).concat(szStock)
+        };
+    });
+}
 
-            let boxQuantity = 0;
-            if (item.box_spec) {
-                const match = item.box_spec.match(/^(\d+)/);
-                if (match && match[1]) boxQuantity = parseInt(match[1]);
-            }
+function syncStockState() {
+    if (!stockState) return loadStockState();
+    return fetchChanges(stockState.cursor).then(feed =>
+        applyStockChanges(feed).then(() => (feed.has_more && !feed.reset ? syncStockState() : null))
+    );
+}
 
-            if (item.quantity > 0) {
-                groupedStock[item.product_id].specs.push({
-                    box_spec: item.box_spec,
-                    quantity: item.quantity,
-                    expiry_date: item.expiry_date,
-                    batch_number: item.batch_number,
-                    location: item.location,
-                    unit_price: item.unit_price
-                });
+// 同步任务串行执行，避免写操作后的刷新与推送同时修改本地副本
+function queueStockSync(task) {
+    stockSyncQueue = stockSyncQueue.catch(() => null).then(task);
+    return stockSyncQueue;
+}
 
-                const boxCount = parseInt(item.quantity || 0);
-                const totalItems = boxQuantity * boxCount;
-                groupedStock[item.product_id].total_stock += totalItems;
-            }
+// 订阅库存变更推送（仅库存页面调用），其他用户的修改也会实时反映到列表
+function watchStockChanges() {
+    queueStockSync(syncStockState).then(() => {
+        if (stockChangeSource) stockChangeSource.close();
+        stockChangeSource = subscribeChanges(stockState.cursor, feed => {
+            queueStockSync(() => applyStockChanges(feed)).then(renderStockList).catch(error => {
+                console.error('应用库存变更失败:', error);
+            });
         });
+    }).catch(error => console.error('订阅库存变更失败:', error));
+}
 
-        // 深圳库存累计（不暴露规格或库位）
-        szStock.forEach(item => {
-            if (selectedCategory && item.category !== selectedCategory) return;
-            if (!groupedStock[item.product_id]) {
-                groupedStock[item.product_id] = {
-                    product_id: item.product_id,
-                    name: item.name,
-                    category: item.category,
-                    supplier: item.supplier,
-                    unit: item.unit,
-                    total_stock: 0,
-                    in_transit: item.in_transit || 0,
-                    daily_consumption: item.daily_consumption || 0,
-                    shenzhen_stock: 0,
-                    specs: []
-                };
-            }
-
-            let boxQuantity = 0;
-            if (item.box_spec) {
-                const match = item.box_spec.match(/^(\d+)/);
-                if (match && match[1]) boxQuantity = parseInt(match[1]);
-            }
-            if (item.quantity > 0) {
-                const boxCount = parseInt(item.quantity || 0);
-                const totalItems = boxQuantity * boxCount;
-                groupedStock[item.product_id].shenzhen_stock += totalItems;
+function displayStockList() {
+    queueStockSync(syncStockState)
+        .then(renderStockList)
+        .catch(error => {
+            console.error('加载库存失败:', error);
+            const stockListBody = document.getElementById('stock-list-body');
+            if (stockListBody) {
+                stockListBody.innerHTML = '<tr><td colspan="11">加载库存失败</td></tr>';
             }
         });
+}
 
-        const stockListBody = document.getElementById('stock-list-body');
-        stockListBody.innerHTML = '';
-
-        let productsArray = Object.values(groupedStock);
-        productsArray.sort((a, b) => {
-            let valueA, valueB;
-            if (currentSortField === 'product_id') {
-                valueA = a.product_id; valueB = b.product_id;
-            } else if (currentSortField === 'stockout_date') {
-                const stockToUseA = includeShenzhenStock ? a.total_stock + a.shenzhen_stock : a.total_stock;
-                const stockToUseB = includeShenzhenStock ? b.total_stock + b.shenzhen_stock : b.total_stock;
-                valueA = a.daily_consumption > 0 ? Math.floor(stockToUseA / a.daily_consumption) : Infinity;
-                valueB = b.daily_consumption > 0 ? Math.floor(stockToUseB / b.daily_consumption) : Infinity;
-            } else if (currentSortField === 'expiry_risk') {
-                valueA = Infinity; valueB = Infinity;
-                const today = new Date(); today.setHours(0,0,0,0);
-                if (a.specs.length > 0) {
-                    a.specs.forEach(spec => {
-                        if (spec.expiry_date) {
-                            const expiryDate = new Date(spec.expiry_date); expiryDate.setHours(0,0,0,0);
-                            const daysDiff = Math.ceil((expiryDate.getTime() - today.getTime()) / (1000*3600*24));
-                            if (daysDiff < valueA) valueA = daysDiff;
-                        }
-                    });
-                }
-                if (b.specs.length > 0) {
-                    b.specs.forEach(spec => {
-                        if (spec.expiry_date) {
-                            const expiryDate = new Date(spec.expiry_date); expiryDate.setHours(0,0,0,0);
-                            const daysDiff = Math.ceil((expiryDate.getTime() - today.getTime()) / (1000*3600*24));
-                            if (daysDiff < valueB) valueB = daysDiff;
-                        }
-                    });
-                }
-            }
-            if (currentSortDirection === 'asc') {
-                return valueA > valueB ? 1 : -1;
-            } else {
-                return valueA < valueB ? 1 : -1;
-            }
-        });
+function renderStockList() {
+    if (!stockState) return;
+    const categoryFilter = document.getElementById('stock-category-filter');
+    const selectedCategory = categoryFilter ? categoryFilter.value : '';
+    const stock = stockState.hk;
+    const szStock = stockState.sz;
+    const categories = new Set();
+    stock.forEach(item => categories.add(item.category));
+    szStock.forEach(item => categories.add(item.category));
+
+    if (categoryFilter) {
+        categoryFilter.innerHTML = '<option value="">所有类别</option>' +
+            Array.from(categories).map(cat =>
+                `<option value="${cat}" ${selectedCategory === cat ? 'selected' : ''}>${cat}</option>`
+            ).join('');
+    }
 
-        productsArray.forEach(product => {
-            let stockoutDate = '无风险';
-            let stockoutRisk = '无风险';
-            let riskClass = 'no-risk';
-
-            if (product.daily_consumption > 0) {
-                const stockToUse = includeShenzhenStock ? product.total_stock + product.shenzhen_stock : product.total_stock;
-                const daysToStockout = Math.floor(stockToUse / product.daily_consumption);
-                const stockoutDateObj = new Date();
-                stockoutDateObj.setDate(stockoutDateObj.getDate() + daysToStockout);
-                stockoutDate = stockoutDateObj.toLocaleDateString();
-                if (daysToStockout < 45) {
-                    stockoutRisk = `${daysToStockout}天${includeShenzhenStock ? '' : '(仅香港)'}`;
-                    riskClass = 'high-risk';
-                }
-            }
+    updateSortIndicators();
 
-            const mainRow = document.createElement('tr');
-            mainRow.classList.add('product-main-row');
-            mainRow.setAttribute('data-product-id', product.product_id);
+    const groupedStock = {};
+
+    // 常规库存（不包含深圳）
+    stock.forEach(item => {
+        if (selectedCategory && item.category !== selectedCategory) return;
+        if (!groupedStock[item.product_id]) {
+            groupedStock[item.product_id] = {
+                product_id: item.product_id,
+                name: item.name,
+                category: item.category,
+                supplier: item.supplier,
+                unit: item.unit,
+                total_stock: 0,
+                in_transit: item.in_transit || 0,
+                daily_consumption: item.daily_consumption || 0,
+                shenzhen_stock: 0,
+                specs: []
+            };
+        }
+
+        let boxQuantity = 0;
+        if (item.box_spec) {
+            const match = item.box_spec.match(/^(\d+)/);
+            if (match && match[1]) boxQuantity = parseInt(match[1]);
+        }
+
+        if (item.quantity > 0) {
+            groupedStock[item.product_id].specs.push({
+                box_spec: item.box_spec,
+                quantity: item.quantity,
+                expiry_date: item.expiry_date,
+                batch_number: item.batch_number,
+                location: item.location,
+                unit_price: item.unit_price
+            });
 
-            let expiryRisk = '无风险';
-            let expiryRiskClass = 'no-risk';
-            if (product.specs.length > 0) {
-                let daysToExpiry = Infinity;
-                const today = new Date(); today.setHours(0,0,0,0);
-                product.specs.forEach(spec => {
+            const boxCount = parseInt(item.quantity || 0);
+            const totalItems = boxQuantity * boxCount;
+            groupedStock[item.product_id].total_stock += totalItems;
+        }
+    });
+
+    // 深圳库存累计（不暴露规格或库位）
+    szStock.forEach(item => {
+        if (selectedCategory && item.category !== selectedCategory) return;
+        if (!groupedStock[item.product_id]) {
+            groupedStock[item.product_id] = {
+                product_id: item.product_id,
+                name: item.name,
+                category: item.category,
+                supplier: item.supplier,
+                unit: item.unit,
+                total_stock: 0,
+                in_transit: item.in_transit || 0,
+                daily_consumption: item.daily_consumption || 0,
+                shenzhen_stock: 0,
+                specs: []
+            };
+        }
+
+        let boxQuantity = 0;
+        if (item.box_spec) {
+            const match = item.box_spec.match(/^(\d+)/);
+            if (match && match[1]) boxQuantity = parseInt(match[1]);
+        }
+        if (item.quantity > 0) {
+            const boxCount = parseInt(item.quantity || 0);
+            const totalItems = boxQuantity * boxCount;
+            groupedStock[item.product_id].shenzhen_stock += totalItems;
+        }
+    });
+
+    const stockListBody = document.getElementById('stock-list-body');
+    stockListBody.innerHTML = '';
+
+    let productsArray = Object.values(groupedStock);
+    productsArray.sort((a, b) => {
+        let valueA, valueB;
+        if (currentSortField === 'product_id') {
+            valueA = a.product_id; valueB = b.product_id;
+        } else if (currentSortField === 'stockout_date') {
+            const stockToUseA = includeShenzhenStock ? a.total_stock + a.shenzhen_stock : a.total_stock;
+            const stockToUseB = includeShenzhenStock ? b.total_stock + b.shenzhen_stock : b.total_stock;
+            valueA = a.daily_consumption > 0 ? Math.floor(stockToUseA / a.daily_consumption) : Infinity;
+            valueB = b.daily_consumption > 0 ? Math.floor(stockToUseB / b.daily_consumption) : Infinity;
+        } else if (currentSortField === 'expiry_risk') {
+            valueA = Infinity; valueB = Infinity;
+            const today = new Date(); today.setHours(0,0,0,0);
+            if (a.specs.length > 0) {
+                a.specs.forEach(spec => {
                     if (spec.expiry_date) {
                         const expiryDate = new Date(spec.expiry_date); expiryDate.setHours(0,0,0,0);
-                        const diff = Math.ceil((expiryDate.getTime() - today.getTime()) / (1000*3600*24));
-                        if (diff < daysToExpiry) daysToExpiry = diff;
+                        const daysDiff = Math.ceil((expiryDate.getTime() - today.getTime()) / (1000*3600*24));
+                        if (daysDiff < valueA) valueA = daysDiff;
                     }
                 });
-                if (daysToExpiry < 365) {
-                    expiryRisk = `${daysToExpiry}天`;
-                    expiryRiskClass = daysToExpiry < 90 ? 'high-risk' : 'medium-risk';
-                }
             }
+            if (b.specs.length > 0) {
+                b.specs.forEach(spec => {
+                    if (spec.expiry_date) {
+                        const expiryDate = new Date(spec.expiry_date); expiryDate.setHours(0,0,0,0);
+                        const daysDiff = Math.ceil((expiryDate.getTime() - today.getTime()) / (1000*3600*24));
+                        if (daysDiff < valueB) valueB = daysDiff;
+                    }
+                });
+            }
+        }
+        if (currentSortDirection === 'asc') {
+            return valueA > valueB ? 1 : -1;
+        } else {
+            return valueA < valueB ? 1 : -1;
+        }
+    });
 
-            mainRow.innerHTML = `
-                <td>${product.product_id}</td>
-                <td onclick="showProductRecords('${product.product_id}')" style="cursor: pointer; text-decoration: underline; color: #0066cc;">${product.name}</td>
-                <td onclick="makeEditable(this)" data-field="in_transit">${product.in_transit}</td>
-                <td onclick="openShenzhenModal('${product.product_id}', '${product.name}')" style="cursor: pointer; text-decoration: underline; color: #0066cc;">${product.shenzhen_stock || 0}</td>
-                <td>${product.total_stock}</td>
-                <td onclick="makeEditable(this)" data-field="daily_consumption">${product.daily_consumption}</td>
-                <td>${stockoutDate}</td>
-                <td class="${riskClass}">${stockoutRisk}</td>
-                <td class="${expiryRiskClass}">${expiryRisk}</td>
-                <td>
-                    <button onclick="toggleSpecRows('${product.product_id}')">查看规格</button>
-                </td>
-            `;
-            stockListBody.appendChild(mainRow);
+    productsArray.forEach(product => {
+        let stockoutDate = '无风险';
+        let stockoutRisk = '无风险';
+        let riskClass = 'no-risk';
+
+        if (product.daily_consumption > 0) {
+            const stockToUse = includeShenzhenStock ? product.total_stock + product.shenzhen_stock : product.total_stock;
+            const daysToStockout = Math.floor(stockToUse / product.daily_consumption);
+            const stockoutDateObj = new Date();
+            stockoutDateObj.setDate(stockoutDateObj.getDate() + daysToStockout);
+            stockoutDate = stockoutDateObj.toLocaleDateString();
+            if (daysToStockout < 45) {
+                stockoutRisk = `${daysToStockout}天${includeShenzhenStock ? '' : '(仅香港)'}`;
+                riskClass = 'high-risk';
+            }
+        }
+
+        const mainRow = document.createElement('tr');
+        mainRow.classList.add('product-main-row');
+        mainRow.setAttribute('data-product-id', product.product_id);
 
+        let expiryRisk = '无风险';
+        let expiryRiskClass = 'no-risk';
+        if (product.specs.length > 0) {
+            let daysToExpiry = Infinity;
+            const today = new Date(); today.setHours(0,0,0,0);
             product.specs.forEach(spec => {
-                const specRow = document.createElement('tr');
-                specRow.classList.add('product-spec-row');
-                specRow.classList.add(`spec-${product.product_id}`);
-                specRow.style.display = 'none';
-                specRow.innerHTML = `
-                    <td colspan="2">规格: ${spec.box_spec} </td>
-                    <td colspan="2">箱数: ${spec.quantity}箱</td>
-                    <td colspan="2">批次号: ${spec.batch_number}</td>
-                    <td colspan="2">过期日期: ${spec.expiry_date ? new Date(spec.expiry_date).toLocaleDateString() : '无'}</td>
-                    <td colspan="2">库位: ${spec.location || '未指定'} ${spec.location ? `<button class=\"small-button\" onclick=\"openRelocateModal('${product.product_id}', '${product.name}', '${spec.box_spec}', '${spec.batch_number || ''}', '${spec.expiry_date || ''}', '${spec.location}', ${spec.quantity})\">移位</button>` : ''}</td>
-                `;
-                stockListBody.appendChild(specRow);
+                if (spec.expiry_date) {
+                    const expiryDate = new Date(spec.expiry_date); expiryDate.setHours(0,0,0,0);
+                    const diff = Math.ceil((expiryDate.getTime() - today.getTime()) / (1000*3600*24));
+                    if (diff < daysToExpiry) daysToExpiry = diff;
+                }
             });
-        });
-    })
-    .catch(error => {
-        console.error('加载库存失败:', error);
-        const stockListBody = document.getElementById('stock-list-body');
-        if (stockListBody) {
-            stockListBody.innerHTML = '<tr><td colspan="11">加载库存失败</td></tr>';
+            if (daysToExpiry < 365) {
+                expiryRisk = `${daysToExpiry}天`;
+                expiryRiskClass = daysToExpiry < 90 ? 'high-risk' : 'medium-risk';
+            }
         }
+
+        mainRow.innerHTML = `
+            <td>${product.product_id}</td>
+            <td onclick="showProductRecords('${product.product_id}')" style="cursor: pointer; text-decoration: underline; color: #0066cc;">${product.name}</td>
+            <td onclick="makeEditable(this)" data-field="in_transit">${product.in_transit}</td>
+            <td onclick="openShenzhenModal('${product.product_id}', '${product.name}')" style="cursor: pointer; text-decoration: underline; color: #0066cc;">${product.shenzhen_stock || 0}</td>
+            <td>${product.total_stock}</td>
+            <td onclick="makeEditable(this)" data-field="daily_consumption">${product.daily_consumption}</td>
+            <td>${stockoutDate}</td>
+            <td class="${riskClass}">${stockoutRisk}</td>
+            <td class="${expiryRiskClass}">${expiryRisk}</td>
+            <td>
+                <button onclick="toggleSpecRows('${product.product_id}')">查看规格</button>
+            </td>
+        `;
+        stockListBody.appendChild(mainRow);
+
+        product.specs.forEach(spec => {
+            const specRow = document.createElement('tr');
+            specRow.classList.add('product-spec-row');
+            specRow.classList.add(`spec-${product.product_id}`);
+            specRow.style.display = 'none';
+            specRow.innerHTML = `
+                <td colspan="2">规格: ${spec.box_spec} </td>
+                <td colspan="2">箱数: ${spec.quantity}箱</td>
+                <td colspan="2">批次号: ${spec.batch_number}</td>
+                <td colspan="2">过期日期: ${spec.expiry_date ? new Date(spec.expiry_date).toLocaleDateString() : '无'}</td>
+                <td colspan="2">库位: ${spec.location || '未指定'} ${spec.location ? `<button class=\"small-button\" onclick=\"openRelocateModal('${product.product_id}', '${product.name}', '${spec.box_spec}', '${spec.batch_number || ''}', '${spec.expiry_date || ''}', '${spec.location}', ${spec.quantity})\">移位</button>` : ''}</td>
+            `;
+            stockListBody.appendChild(specRow);
+        });
     });
 }
 
@@ -413,112 +484,40 @@ function makeEditable(cell) {
 }
 
 function exportStockToExcel() {
-    apiRequest('/api/stock')
-        .then(stockItems => {
-            const headers = ['产品编号', '品名', '产品类别', '供应商', '香港库存', '深圳库存', '在途数量', '每日消耗', '规格', '库位', '批次号', '过期日期'];
-            const filteredStockItems = stockItems.filter(item => item.quantity > 0);
-            const wsData = [
-                headers,
-                ...filteredStockItems.map(item => [
-                    item.product_id,
-                    item.name,
-                    item.category,
-                    item.supplier,
-                    item.quantity,
-                    item.shenzhen_stock || 0,
-                    item.in_transit || 0,
-                    item.daily_consumption || 0,
-                    item.box_spec,
-                    item.location,
-                    item.batch_number || '',
-                    item.expiry_date || ''
-                ])
-            ];
-            const wb = XLSX.utils.book_new();
-            const ws = XLSX.utils.aoa_to_sheet(wsData);
-            XLSX.utils.book_append_sheet(wb, ws, '库存');
-            XLSX.writeFile(wb, '库存盘点.xlsx');
-        })
-        .catch(error => alert('导出库存失败: ' + error.message));
+    downloadFile('/api/export/stock');
 }
 
 function uploadDailyConsumptionExcel() {
     const fileInput = document.createElement('input');
     fileInput.type = 'file';
-    fileInput.accept = '.xlsx, .xls';
+    fileInput.accept = '.xlsx';
     fileInput.style.display = 'none';
     document.body.appendChild(fileInput);
     fileInput.click();
     fileInput.addEventListener('change', function(e) {
         const file = e.target.files[0];
-        if (!file) { document.body.removeChild(fileInput); return; }
-        const reader = new FileReader();
-        reader.onload = function(e) {
-            try {
-                const data = new Uint8Array(e.target.result);
-                const workbook = XLSX.read(data, {type: 'array'});
-                const worksheet = workbook.Sheets[workbook.SheetNames[0]];
-                const jsonData = XLSX.utils.sheet_to_json(worksheet);
-                if (jsonData.length === 0) { alert('Excel文件为空'); document.body.removeChild(fileInput); return; }
-                const firstRow = jsonData[0];
-                if (!('产品编号' in firstRow) || !('每日消耗' in firstRow)) { alert('Excel文件格式不正确，必须包含"产品编号"和"每日消耗"列'); document.body.removeChild(fileInput); return; }
-                const updatePromises = [];
-                jsonData.forEach(row => {
-                    const productId = row['产品编号'];
-                    const dailyConsumption = parseFloat(row['每日消耗']) || 0;
-                    if (productId) {
-                        const updatePromise = fetch('/api/stock/update', {
-                            method: 'POST',
-                            headers: { 'Content-Type': 'application/json' },
-                            body: JSON.stringify({ product_id: productId, daily_consumption: dailyConsumption })
-                        }).then(response => response.json());
-                        updatePromises.push(updatePromise);
-                    }
-                });
-                Promise.all(updatePromises)
-                    .then(results => {
-                        const successCount = results.filter(result => result.success).length;
-                        alert(`批量更新成功，共更新${successCount}条记录`);
-                        displayStockList();
-                    })
-                    .catch(error => { console.error('批量更新失败:', error); alert('批量更新失败: ' + error.message); });
-            } catch (error) {
-                console.error('处理Excel文件失败:', error);
-                alert('处理Excel文件失败: ' + error.message);
-            } finally {
-                document.body.removeChild(fileInput);
-            }
-        };
-        reader.onerror = function() { alert('读取文件失败'); document.body.removeChild(fileInput); };
-        reader.readAsArrayBuffer(file);
+        document.body.removeChild(fileInput);
+        if (!file) return;
+        const formData = new FormData();
+        formData.append('file', file);
+        fetch('/api/stock/bulk-update', { method: 'POST', body: formData })
+            .then(response => response.json())
+            .then(result => {
+                if (!result.success) {
+                    const invalid = (result.invalid || []).map(item => `第${item.row}行: ${item.message}`).join('\n');
+                    alert('批量更新失败: ' + result.message + (invalid ? '\n' + invalid : ''));
+                    return;
+                }
+                let message = result.message;
+                if (result.not_found && result.not_found.length) message += `\n未找到库存的产品编号: ${result.not_found.join(', ')}`;
+                if (result.invalid && result.invalid.length) message += `\n已跳过${result.invalid.length}行无效数据`;
+                alert(message);
+                displayStockList();
+            })
+            .catch(error => { console.error('批量更新失败:', error); alert('批量更新失败: ' + error.message); });
     });
 }
 
 function exportAllMerchantsStockToExcel() {
-    apiRequest('/api/all-merchants-stock')
-        .then(stockItems => {
-            const headers = ['商户名称', '产品编号', '品名', '产品类别', '供应商', '香港库存', '深圳库存', '规格', '库位', '批次号', '过期日期'];
-            const filteredStockItems = stockItems.filter(item => item.quantity > 0);
-            const wsData = [
-                headers,
-                ...filteredStockItems.map(item => [
-                    item.merchant_name,
-                    item.product_id,
-                    item.name,
-                    item.category,
-                    item.supplier,
-                    item.quantity,
-                    item.shenzhen_stock || 0,
-                    item.box_spec,
-                    item.location,
-                    item.batch_number || '',
-                    item.expiry_date || ''
-                ])
-            ];
-            const wb = XLSX.utils.book_new();
-            const ws = XLSX.utils.aoa_to_sheet(wsData);
-            XLSX.utils.book_append_sheet(wb, ws, '所有商户库存');
-            XLSX.writeFile(wb, '所有商户库存盘点.xlsx');
-        })
-        .catch(error => alert('导出所有商户库存失败: ' + error.message));
-}
\ No newline at end of file
+    downloadFile('/api/export/stock', { all_merchants: 1 });
+}
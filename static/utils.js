@@ -9,6 +9,24 @@ function handleApiError(error, operation) {
     alert(`${operation}失败: ${error.message || '未知错误'}`);
 }
 
+// GET 响应缓存（按 URL 保存 ETag 与响应体），服务端返回 304 时直接复用
+const apiResponseCache = new Map();
+const API_RESPONSE_CACHE_LIMIT = 50;
+
+function rememberApiResponse(url, etag, text, nextCursor = null) {
+    apiResponseCache.delete(url);
+    apiResponseCache.set(url, { etag, text, nextCursor });
+    if (apiResponseCache.size > API_RESPONSE_CACHE_LIMIT) {
+        apiResponseCache.delete(apiResponseCache.keys().next().value);
+    }
+}
+
+// 写操作幂等键：每次提交生成一个，网络失败重试时复用，服务端据此保证同一提交只执行一次
+function newIdempotencyKey() {
+    if (window.crypto && typeof window.crypto.randomUUID === 'function') return window.crypto.randomUUID();
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random().toString(36).slice(2)}`;
+}
+
 // API request wrapper
 function apiRequest(url, method = 'GET', data = null) {
     const options = {
@@ -17,10 +35,23 @@ function apiRequest(url, method = 'GET', data = null) {
         credentials: 'same-origin'
     };
     if (data) options.body = JSON.stringify(data);
+    const cached = method === 'GET' ? apiResponseCache.get(url) : null;
+    if (cached) {
+        options.headers['If-None-Match'] = cached.etag;
+        options.cache = 'no-store';
+    }
 
     return fetch(url, options)
         .then(response => {
-            if (response.ok) return response.json();
+            if (response.status === 304 && cached) return JSON.parse(cached.text);
+            if (response.ok) {
+                const etag = method === 'GET' ? response.headers.get('ETag') : null;
+                if (!etag) return response.json();
+                return response.text().then(text => {
+                    rememberApiResponse(url, etag, text);
+                    return JSON.parse(text);
+                });
+            }
 
             if (response.status === 401) {
                 return response.json().then(errorData => {
@@ -52,6 +83,62 @@ function apiRequest(url, method = 'GET', data = null) {
         });
 }
 
+// 商户变更流：不带 since 时只返回当前游标；带 since 时返回之后的变更（reset 为 true 表示需全量重新加载）
+function fetchChanges(since = null) {
+    return apiRequest(since === null ? '/api/changes' : `/api/changes?since=${encodeURIComponent(since)}`);
+}
+
+// 订阅变更推送（SSE），断线后浏览器自动携带最后的游标重连；不支持 EventSource 时返回 null
+function subscribeChanges(since, onChanges) {
+    if (typeof EventSource !== 'function') return null;
+    const source = new EventSource(`/api/changes/stream?since=${encodeURIComponent(since)}`);
+    ['change', 'reset'].forEach(type => {
+        source.addEventListener(type, event => onChanges(JSON.parse(event.data)));
+    });
+    return source;
+}
+
+// 拉取游标分页接口的一页：返回 { items, nextCursor }（nextCursor 来自 X-Next-Cursor，为 null 表示没有下一页）
+function apiRequestPage(url, params = {}, cursor = null) {
+    const query = new URLSearchParams(params);
+    if (cursor) query.set('cursor', cursor);
+    const pageUrl = `${url}?${query.toString()}`;
+    const cached = apiResponseCache.get(pageUrl);
+    const options = { credentials: 'same-origin' };
+    if (cached) {
+        options.headers = { 'If-None-Match': cached.etag };
+        options.cache = 'no-store';
+    }
+    return fetch(pageUrl, options)
+        .then(response => {
+            if (response.status === 401) {
+                if (typeof silentLogout === 'function') silentLogout();
+                throw new Error('会话已过期');
+            }
+            if (response.status === 304 && cached) {
+                return { items: JSON.parse(cached.text), nextCursor: cached.nextCursor };
+            }
+            if (!response.ok) throw new Error('网络请求失败: ' + response.statusText);
+            const nextCursor = response.headers.get('X-Next-Cursor');
+            const etag = response.headers.get('ETag');
+            return response.text().then(text => {
+                if (etag) rememberApiResponse(pageUrl, etag, text, nextCursor);
+                return { items: JSON.parse(text), nextCursor };
+            });
+        });
+}
+
+// 通过隐藏链接下载后端生成的文件，由浏览器直接流式保存，不在页面内存中拼装
+function downloadFile(url, params = {}) {
+    const query = new URLSearchParams(params).toString();
+    const link = document.createElement('a');
+    link.href = query ? `${url}?${query}` : url;
+    link.style.display = 'none';
+    document.body.appendChild(link);
+    link.click();
+    document.body.removeChild(link);
+}
+
 function convertToBeijingTime(dateString) {
     return new Date(dateString).toLocaleString();
 }
\ No newline at end of file
@@ -0,0 +1,258 @@
+"""
+库存流水与快照模块
+库存数量不再只做原地修改：每次增减都在同一事务内向 stock_movement 追加一行流水（只追加、不修改），
+维度与库存唯一键一致（商户、产品、规格、批次、过期日期、库位），Stock.quantity 等于对应维度的流水之和。
+  - record_movements：写操作在库存变更之后、提交之前调用
+  - take_snapshot：按商户把截至某条流水的结存写入 stock_snapshot / stock_snapshot_line（每日后台任务）
+  - stock_as_of：某一时刻的库存 = 不晚于该时刻的最近快照 + 其后的流水，无需从头重放
+  - reconcile_stock / repair_ledger：校验库存表与流水合计是否一致，并追加校正流水（scripts/stock_ledger_tool.py）
+流水从上线时的期初结存（ensure_stock_ledger）开始，早于期初的时刻无法查询。
+"""
+from datetime import datetime, timedelta
+
+from flask import has_request_context
+from flask_login import current_user
+
+from extensions import db
+from models import Stock, StockMovement, StockSnapshot, StockSnapshotLine
+
+MOVEMENT_INBOUND = '入库'
+MOVEMENT_OUTBOUND = '出库'
+MOVEMENT_RELOCATE = '移位'
+MOVEMENT_RECORD_UPDATE = '修改记录'
+MOVEMENT_RECORD_DELETE = '删除记录'
+MOVEMENT_PRODUCT_DELETE = '删除产品'
+MOVEMENT_PRODUCT_RENAME = '产品改号'
+MOVEMENT_OPENING = '期初'
+MOVEMENT_CORRECTION = '校正'
+
+IDENTITY_FIELDS = ('product_id', 'box_spec', 'batch_number', 'expiry_date', 'location')
+# 快照只收录早于该时长的流水：未提交事务中的流水可能取得了更小的ID，留出提交时间避免被快照漏掉
+SNAPSHOT_SETTLE_SECONDS = 300
+
+
+def movement_row(source, delta, movement_type, source_id=None):
+    """按库存行或字段字典的维度构造一条流水（交给 record_movements 写入）"""
+    get = source.get if isinstance(source, dict) else lambda name: getattr(source, name)
+    row = {field: get(field) for field in IDENTITY_FIELDS}
+    row.update(quantity_delta=int(delta or 0), movement_type=movement_type, source_id=source_id)
+    return row
+
+
+def record_movements(merchant_id, rows):
+    """在当前事务中追加流水（忽略数量为 0 的行），需在库存变更之后、提交之前调用"""
+    rows = [row for row in rows if row['quantity_delta']]
+    if not merchant_id or not rows:
+        return
+    operator_id = None
+    if has_request_context() and current_user and current_user.is_authenticated:
+        operator_id = current_user.id
+    now = datetime.now()
+    db.session.execute(db.insert(StockMovement), [
+        dict(row, merchant_id=merchant_id, operator_id=operator_id, created_at=now) for row in rows
+    ])
+
+
+def record_stock_identity(record):
+    """返回出入库记录当前对应的库存维度：优先取该记录最近一条流水（修改记录后会移到新维度），
+    流水上线前的历史记录退回到记录自身的结构化字段"""
+    # 入库记录对应增加库存的流水，出库记录对应扣减库存的流水
+    direction = StockMovement.quantity_delta > 0 if record.operation_type == '入库' else StockMovement.quantity_delta < 0
+    movement = StockMovement.query.filter(
+        StockMovement.source_id == record.id,
+        StockMovement.merchant_id == record.merchant_id,
+        direction
+    ).order_by(StockMovement.id.desc()).first()
+    source = movement if movement is not None else record
+    identity = {field: getattr(source, field) for field in IDENTITY_FIELDS}
+    identity['merchant_id'] = record.merchant_id
+    return identity
+
+
+def _normalize(key):
+    """维度键归一：空串与 NULL 视为相同（与库存唯一键一致）"""
+    product_id, box_spec, batch_number, expiry_date, location = key
+    return (product_id, box_spec or None, batch_number or None, expiry_date, location or None)
+
+
+def _line_dict(key, quantity):
+    product_id, box_spec, batch_number, expiry_date, location = key
+    return {
+        'product_id': product_id,
+        'box_spec': box_spec,
+        'batch_number': batch_number,
+        'expiry_date': expiry_date,
+        'location': location,
+        'quantity': quantity
+    }
+
+
+def _movement_sums(merchant_id, *conditions):
+    """按维度汇总流水数量：{维度键: 合计}"""
+    columns = [getattr(StockMovement, field) for field in IDENTITY_FIELDS]
+    rows = db.session.query(*columns, db.func.sum(StockMovement.quantity_delta)).filter(
+        StockMovement.merchant_id == merchant_id, *conditions
+    ).group_by(*columns).all()
+    sums = {}
+    for row in rows:
+        key = _normalize(tuple(row[:-1]))
+        sums[key] = sums.get(key, 0) + (row[-1] or 0)
+    return sums
+
+
+def ensure_stock_ledger():
+    """流水表为空而库存不为空时（首次部署）按当前库存写入期初流水并提交，返回写入行数"""
+    has_movement = db.session.query(StockMovement.id).limit(1).first() is not None
+    if has_movement:
+        return 0
+    stocks = Stock.query.filter(Stock.quantity != 0, Stock.product_id.isnot(None)).order_by(Stock.id).all()
+    by_merchant = {}
+    for stock in stocks:
+        by_merchant.setdefault(stock.merchant_id, []).append(
+            movement_row(stock, stock.quantity, MOVEMENT_OPENING)
+        )
+    for merchant_id, rows in by_merchant.items():
+        record_movements(merchant_id, rows)
+    db.session.commit()
+    if stocks:
+        print(f'已写入期初库存流水 {len(stocks)} 行')
+    return len(stocks)
+
+
+def latest_snapshot(merchant_id, at=None):
+    query = StockSnapshot.query.filter(StockSnapshot.merchant_id == merchant_id)
+    if at is not None:
+        query = query.filter(StockSnapshot.taken_at <= at)
+    return query.order_by(StockSnapshot.taken_at.desc(), StockSnapshot.id.desc()).first()
+
+
+def _snapshot_balances(snapshot, product_ids=None, location=None):
+    if snapshot is None:
+        return {}
+    query = StockSnapshotLine.query.filter(StockSnapshotLine.snapshot_id == snapshot.id)
+    if product_ids:
+        query = query.filter(StockSnapshotLine.product_id.in_(product_ids))
+    if location:
+        query = query.filter(StockSnapshotLine.location == location)
+    return {
+        _normalize(tuple(getattr(line, field) for field in IDENTITY_FIELDS)): line.quantity
+        for line in query
+    }
+
+
+def take_snapshot(merchant_id, settle_seconds=SNAPSHOT_SETTLE_SECONDS):
+    """在上一快照基础上累加其后的流水生成新快照并提交；没有新流水时返回 None"""
+    previous = latest_snapshot(merchant_id)
+    after_id = previous.last_movement_id if previous else 0
+    settled = datetime.now() - timedelta(seconds=settle_seconds)
+    last_movement_id = db.session.query(db.func.max(StockMovement.id)).filter(
+        StockMovement.merchant_id == merchant_id,
+        StockMovement.id > after_id,
+        StockMovement.created_at <= settled
+    ).scalar()
+    if last_movement_id is None:
+        return None
+    window = (StockMovement.id > after_id, StockMovement.id <= last_movement_id)
+    taken_at = db.session.query(db.func.max(StockMovement.created_at)).filter(
+        StockMovement.merchant_id == merchant_id, *window
+    ).scalar()
+    if previous is not None:
+        taken_at = max(taken_at, previous.taken_at)
+
+    balances = _snapshot_balances(previous)
+    for key, delta in _movement_sums(merchant_id, *window).items():
+        balances[key] = balances.get(key, 0) + delta
+    lines = [_line_dict(key, quantity) for key, quantity in balances.items() if quantity]
+
+    snapshot = StockSnapshot(
+        merchant_id=merchant_id,
+        last_movement_id=last_movement_id,
+        taken_at=taken_at,
+        line_count=len(lines)
+    )
+    db.session.add(snapshot)
+    db.session.flush()
+    if lines:
+        db.session.execute(db.insert(StockSnapshotLine), [dict(line, snapshot_id=snapshot.id) for line in lines])
+    db.session.commit()
+    return snapshot
+
+
+def stock_as_of(merchant_id, at, product_ids=None, location=None):
+    """返回 at 时刻的库存结存：最近快照 + 其后且不晚于 at 的流水（只扫描快照之后的一段流水）"""
+    snapshot = latest_snapshot(merchant_id, at)
+    after_id = snapshot.last_movement_id if snapshot else 0
+    balances = _snapshot_balances(snapshot, product_ids, location)
+    conditions = [StockMovement.id > after_id, StockMovement.created_at <= at]
+    if product_ids:
+        conditions.append(StockMovement.product_id.in_(product_ids))
+    if location:
+        conditions.append(StockMovement.location == location)
+    deltas = _movement_sums(merchant_id, *conditions)
+    for key, delta in deltas.items():
+        balances[key] = balances.get(key, 0) + delta
+
+    ledger_start = db.session.query(db.func.min(StockMovement.created_at)).filter(
+        StockMovement.merchant_id == merchant_id
+    ).scalar()
+    items = sorted(
+        (_line_dict(key, quantity) for key, quantity in balances.items() if quantity),
+        key=lambda line: (line['product_id'], line['location'] or '', line['expiry_date'] or datetime.min.date(),
+                          line['batch_number'] or '', line['box_spec'] or '')
+    )
+    return {
+        'snapshot': {'id': snapshot.id, 'taken_at': snapshot.taken_at} if snapshot else None,
+        'ledger_start': ledger_start,
+        'delta_groups': len(deltas),
+        'items': items
+    }
+
+
+def reconcile_stock(merchant_id=None):
+    """对比库存表与流水合计，返回差异列表 [{merchant_id, 维度字段..., stock, ledger}]"""
+    if merchant_id is None:
+        merchant_ids = sorted(
+            {row[0] for row in db.session.query(Stock.merchant_id).distinct()} |
+            {row[0] for row in db.session.query(StockMovement.merchant_id).distinct()}
+        )
+    else:
+        merchant_ids = [merchant_id]
+
+    drift = []
+    for current_id in merchant_ids:
+        columns = [getattr(Stock, field) for field in IDENTITY_FIELDS]
+        stock_sums = {}
+        for row in db.session.query(*columns, db.func.sum(Stock.quantity)).filter(
+            Stock.merchant_id == current_id, Stock.product_id.isnot(None)
+        ).group_by(*columns):
+            key = _normalize(tuple(row[:-1]))
+            stock_sums[key] = stock_sums.get(key, 0) + (row[-1] or 0)
+        ledger_sums = _movement_sums(current_id)
+        for key in sorted(set(stock_sums) | set(ledger_sums), key=lambda item: tuple(str(value) for value in item)):
+            expected = stock_sums.get(key, 0)
+            actual = ledger_sums.get(key, 0)
+            if expected != actual:
+                drift.append(dict(zip(IDENTITY_FIELDS, key), merchant_id=current_id, stock=expected, ledger=actual))
+    return drift
+
+
+def repair_ledger(merchant_id=None):
+    """按库存表追加校正流水使流水合计与库存一致（不修改已有流水）并提交，返回追加行数"""
+    drift = reconcile_stock(merchant_id)
+    by_merchant = {}
+    for item in drift:
+        by_merchant.setdefault(item['merchant_id'], []).append(
+            movement_row(item, item['stock'] - item['ledger'], MOVEMENT_CORRECTION)
+        )
+    for current_id, rows in by_merchant.items():
+        record_movements(current_id, rows)
+    db.session.commit()
+    return len(drift)
+
+
+def delete_merchant_ledger(merchant_id):
+    """删除商户时清除其流水与快照（不提交）"""
+    snapshot_ids = db.session.query(StockSnapshot.id).filter(StockSnapshot.merchant_id == merchant_id)
+    StockSnapshotLine.query.filter(StockSnapshotLine.snapshot_id.in_(snapshot_ids)).delete(synchronize_session=False)
+    StockSnapshot.query.filter(StockSnapshot.merchant_id == merchant_id).delete(synchronize_session=False)
+    StockMovement.query.filter(StockMovement.merchant_id == merchant_id).delete(synchronize_session=False)
@@ -0,0 +1,107 @@
+"""
+测试公共夹具：使用内存 SQLite 数据库导入应用，关闭后台任务线程与响应缓存（每次请求都执行视图）。
+"""
+import os
+import sys
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+os.environ['SECRET_KEY'] = 'test'
+os.environ['JOB_EXECUTOR'] = 'off'
+os.environ['CACHE_TYPE'] = 'null'
+os.environ.pop('VERCEL', None)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+from sqlalchemy import event
+
+from app import app as flask_app
+from extensions import db
+from inventory_summary import rebuild_summaries
+from models import Merchant, Product, Record, ShenzhenRecord, Stock, User
+from utils import generate_unique_id, site_for_location
+
+
+@pytest.fixture
+def app():
+    # 请求之间不保留应用上下文，否则 g 会跨请求共享（如同一请求内缓存的商户数据版本号）
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+        merchant = Merchant(name='测试商户')
+        db.session.add(merchant)
+        db.session.flush()
+        user = User(username='tester', is_admin=True, current_merchant_id=merchant.id)
+        user.set_password('pw')
+        db.session.add(user)
+        db.session.commit()
+    yield flask_app
+    with flask_app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def merchant_id(app):
+    with app.app_context():
+        return Merchant.query.filter_by(name='测试商户').one().id
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    response = client.post('/login', json={'username': 'tester', 'password': 'pw'})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return client
+
+
+@pytest.fixture
+def seed_products(app):
+    """为产品 start..start+count-1 各写入两个香港批次、一行深圳库存及出入库记录：seed_products(商户ID, start, count)"""
+    def seed(merchant_id, start, count):
+        with app.app_context():
+            _seed_products(merchant_id, start, count)
+    return seed
+
+
+def _seed_products(merchant_id, start, count):
+    today = date.today()
+    now = datetime.now()
+    for index in range(start, start + count):
+        product_id = f'P{index:04d}'
+        db.session.add(Product(id=product_id, name=f'产品{index}', category='类别', merchant_id=merchant_id))
+        for batch, location in (('B1', 'A1'), ('B2', 'A2'), ('SZ', 'Shenzhen')):
+            db.session.add(Stock(
+                product_id=product_id, box_spec='24', units_per_box=24, quantity=5, batch_number=batch,
+                expiry_date=today + timedelta(days=10 + index), location=location,
+                site=site_for_location(location), daily_consumption=2, merchant_id=merchant_id
+            ))
+        for operation_type in ('入库', '出库'):
+            db.session.add(Record(
+                id=generate_unique_id(), product_id=product_id, operation_type=operation_type, quantity=1,
+                date=now, box_spec='24', units_per_box=24, merchant_id=merchant_id
+            ))
+        db.session.add(ShenzhenRecord(
+            id=generate_unique_id(), product_id=product_id, operation_type='入库', quantity=1,
+            date=now, box_spec='24', merchant_id=merchant_id
+        ))
+    db.session.commit()
+    rebuild_summaries(merchant_id)
+
+
+@contextmanager
+def count_statements():
+    """统计代码块内执行的 SQL 语句，产出语句文本列表"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with flask_app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
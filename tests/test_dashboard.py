@@ -0,0 +1,31 @@
+"""
+仪表盘测试：深圳库存行按规格/批次/过期日期匹配最近一次深圳入库，空值也能匹配。
+"""
+from datetime import datetime, timedelta
+
+from extensions import db
+from inventory_summary import rebuild_summaries
+from models import Product, ShenzhenRecord, Stock
+from utils import generate_unique_id
+
+
+def test_shenzhen_retention_matches_null_batch_and_expiry(app, client, merchant_id):
+    with app.app_context():
+        db.session.add(Product(id='S001', name='无批次', merchant_id=merchant_id))
+        db.session.add(Stock(
+            product_id='S001', box_spec='24', quantity=4, batch_number=None, expiry_date=None,
+            location='Shenzhen', merchant_id=merchant_id
+        ))
+        db.session.add(ShenzhenRecord(
+            id=generate_unique_id(), product_id='S001', operation_type='入库', quantity=4,
+            date=datetime.now() - timedelta(days=5), box_spec='24', batch_number=None, expiry_date=None,
+            merchant_id=merchant_id
+        ))
+        db.session.commit()
+        rebuild_summaries(merchant_id)
+
+    response = client.get('/api/dashboard')
+    assert response.status_code == 200, response.get_data(as_text=True)
+    shenzhen = response.get_json()['shenzhen']
+    assert [item['days_since_inbound'] for item in shenzhen['items']] == [5]
+    assert shenzhen['avg_retention_days'] == 5
@@ -0,0 +1,70 @@
+"""
+Excel 导出测试：工作簿边查询边流式发送，内容可被 openpyxl 正常读取。
+"""
+import io
+from datetime import date, datetime
+from decimal import Decimal
+
+from openpyxl import load_workbook
+
+from xlsx_stream import iter_xlsx_chunks
+
+
+def test_stock_export_is_streamed_and_readable(client, merchant_id, seed_products):
+    seed_products(merchant_id, 1, 3)
+    response = client.get('/api/export/stock')
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert "filename*=UTF-8''" in response.headers['Content-Disposition']
+
+    sheet = load_workbook(io.BytesIO(response.get_data()), read_only=True).active
+    rows = list(sheet.iter_rows(values_only=True))
+    assert sheet.title == '库存'
+    # 只导出香港库存行，每个产品两个批次
+    assert len(rows) == 1 + 6
+    assert {row[0] for row in rows[1:]} == {'P0001', 'P0002', 'P0003'}
+
+
+def test_chunks_are_sent_before_workbook_is_finished():
+    produced = []
+
+    def rows():
+        for index in range(50):
+            produced.append(index)
+            yield [index, f'<行{index}>\x01', None]
+
+    chunks = iter_xlsx_chunks('a/b', ['编号', '名称', '空'], rows(), flush_rows=10)
+    first = next(chunks)
+    # 第一块在所有行生成之前就已交付
+    assert len(produced) < 50
+    data = first + b''.join(chunks)
+    sheet = load_workbook(io.BytesIO(data), read_only=True).active
+    rows = list(sheet.iter_rows(values_only=True))
+    assert len(rows) == 51
+    assert rows[1] == (0, '<行0>', None)
+
+
+def read_rows(chunks):
+    sheet = load_workbook(io.BytesIO(b''.join(chunks)), read_only=True).active
+    return sheet.title, list(sheet.iter_rows(values_only=True))
+
+
+def test_cell_types_round_trip():
+    row = ['产品 ①「测试」&<>', 12, 2.5, Decimal('3.75'), True,
+           date(2026, 1, 2), datetime(2026, 1, 2, 3, 4, 5), None, '含\x07控制字符']
+    title, rows = read_rows(iter_xlsx_chunks('深圳/库存:明细', ['名称'] * len(row), [row]))
+    assert title == '深圳_库存_明细'
+    assert rows[1] == ('产品 ①「测试」&<>', 12, 2.5, 3.75, True,
+                       datetime(2026, 1, 2), datetime(2026, 1, 2, 3, 4, 5), None, '含控制字符')
+
+
+def test_empty_export_has_header_only():
+    title, rows = read_rows(iter_xlsx_chunks('库存', ['产品编号', '数量'], []))
+    assert rows == [('产品编号', '数量')]
+
+
+def test_empty_records_export(client):
+    response = client.get('/api/export/records')
+    assert response.status_code == 200
+    title, rows = read_rows([response.get_data()])
+    assert (title, len(rows)) == ('出入库记录', 1)
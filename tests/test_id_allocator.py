@@ -0,0 +1,80 @@
+"""
+主键分配器测试：多进程并发分配无重复、节点号租约互斥与过期接管。
+压力规模可用环境变量调整，如 ID_STRESS_PROCESSES=8 ID_STRESS_PER_PROCESS=250000（共 200 万个 ID）。
+"""
+import multiprocessing
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+
+from models import IdNodeLease
+from node_lease import NodeLease
+from utils import IdAllocator
+
+STRESS_PROCESSES = int(os.environ.get('ID_STRESS_PROCESSES', '4'))
+STRESS_PER_PROCESS = int(os.environ.get('ID_STRESS_PER_PROCESS', '50000'))
+
+
+@pytest.fixture
+def lease_url(tmp_path, monkeypatch):
+    monkeypatch.delenv('ID_NODE_ID', raising=False)
+    url = f'sqlite:///{tmp_path / "lease.db"}'
+    IdNodeLease.__table__.create(create_engine(url))
+    return url
+
+
+def generate_pinned(url, preferred_node, count, barrier, results):
+    # 各进程首选同一个节点号，由租约保证最终使用的节点号不同
+    lease = NodeLease(engine=create_engine(url), preferred_node=preferred_node)
+    allocator = IdAllocator(node_provider=lease.current_node)
+    node = lease.current_node()
+    barrier.wait()
+    ids = [allocator.next_id() for _ in range(count)]
+    results.put((node, all(a < b for a, b in zip(ids, ids[1:])), ids))
+
+
+def test_processes_pinned_to_same_node_never_collide(lease_url):
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(STRESS_PROCESSES)
+    results = context.Queue()
+    workers = [
+        context.Process(target=generate_pinned, args=(lease_url, 7, STRESS_PER_PROCESS, barrier, results))
+        for _ in range(STRESS_PROCESSES)
+    ]
+    for worker in workers:
+        worker.start()
+    batches = [results.get(timeout=300) for _ in workers]
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    nodes = [node for node, _, _ in batches]
+    assert len(set(nodes)) == STRESS_PROCESSES
+    assert all(ordered for _, ordered, _ in batches)
+    ids = [value for _, _, values in batches for value in values]
+    assert all(len(value) == 20 for value in ids)
+    assert len(set(ids)) == len(ids) == STRESS_PROCESSES * STRESS_PER_PROCESS
+
+
+def test_held_lease_is_skipped_and_expired_lease_taken_over(lease_url):
+    engine = create_engine(lease_url)
+    first = NodeLease(engine=engine, preferred_node=3)
+    second = NodeLease(engine=engine, preferred_node=3)
+    assert first.current_node() == 3
+    assert second.current_node() == 4
+
+    # 模拟 first 所在进程长时间冻结：租约过期后被 third 接管
+    table = IdNodeLease.__table__
+    with engine.begin() as conn:
+        conn.execute(table.update().where(table.c.node_id == 3).values(
+            expires_at=datetime.now() - timedelta(seconds=1)
+        ))
+    third = NodeLease(engine=engine, preferred_node=3)
+    assert third.current_node() == 3
+
+    # first 恢复后续租失败，改租其他节点号，不再使用 3
+    first._renew_at = 0
+    assert first.current_node() not in (3, 4)
+    assert second.current_node() == 4
@@ -0,0 +1,60 @@
+"""
+幂等键测试：完成状态与响应随业务写入一起提交，处理中的键在保留期内不会被重新执行。
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import idempotency
+from extensions import db
+from models import IdempotencyKey, Product, Record
+
+
+@pytest.fixture
+def product(app, merchant_id):
+    with app.app_context():
+        db.session.add(Product(id='I001', name='幂等测试', merchant_id=merchant_id))
+        db.session.commit()
+    return 'I001'
+
+
+def inbound(client, product, key):
+    return client.post('/api/incoming', headers={'Idempotency-Key': key}, json={
+        'product_id': product, 'box_spec': '24', 'quantity': 2, 'batch_number': 'B1',
+        'incoming_reason': '采购', 'expiry_date': '2030-01-01', 'location': 'A1'
+    })
+
+
+def record_count(app):
+    with app.app_context():
+        return Record.query.count()
+
+
+def test_completion_is_committed_with_the_write(app, client, product, monkeypatch):
+    # 模拟视图提交后、收尾前进程退出：收尾不再执行
+    monkeypatch.setattr(idempotency, '_finish', lambda entry_id, response: None)
+    first = inbound(client, product, 'k1')
+    assert first.status_code == 200
+    with app.app_context():
+        entry = IdempotencyKey.query.filter_by(key='k1').one()
+        assert entry.status == 'done'
+
+    retry = inbound(client, product, 'k1')
+    assert retry.status_code == 200
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json() == first.get_json()
+    assert record_count(app) == 1
+
+
+def test_pending_key_is_never_reclaimed(app, client, product):
+    assert inbound(client, product, 'k2').status_code == 200
+    # 模拟长时间处理中（或执行进程已退出）的键
+    with app.app_context():
+        IdempotencyKey.query.filter_by(key='k2').update({
+            'status': 'pending',
+            'created_at': datetime.now() - timedelta(minutes=30)
+        })
+        db.session.commit()
+
+    assert inbound(client, product, 'k2').status_code == 409
+    assert record_count(app) == 1
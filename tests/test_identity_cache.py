@@ -0,0 +1,58 @@
+"""
+登录身份缓存测试：其他实例上未失效的旧身份不会让请求落到切换前的商户。
+"""
+import pytest
+from cachelib import SimpleCache
+
+import app as app_module
+from extensions import db
+from models import Merchant, Product, User
+
+
+@pytest.fixture
+def identity_cache(monkeypatch):
+    cache = app_module.identity_cache
+    monkeypatch.setattr(cache, 'cache', SimpleCache())
+    monkeypatch.setattr(cache, 'ttl', 30)
+    return cache
+
+
+@pytest.fixture
+def merchants(app, merchant_id):
+    with app.app_context():
+        other = Merchant(name='第二商户')
+        db.session.add(other)
+        db.session.commit()
+        return merchant_id, other.id
+
+
+def user_id(app):
+    with app.app_context():
+        return User.query.filter_by(username='tester').one().id
+
+
+def test_switch_ignores_stale_identity_cached_by_another_instance(app, client, identity_cache, merchants):
+    first, second = merchants
+    assert client.get('/api/merchants/current').get_json()['merchant']['id'] == first
+    key = identity_cache.make_key(user_id(app))
+    stale = identity_cache.cache.get(key)
+    assert stale['current_merchant_id'] == first
+
+    assert client.post('/api/merchants/switch', json={'merchant_id': second}).status_code == 200
+    # 另一实例的进程内缓存没有收到失效
+    identity_cache.cache.set(key, stale)
+    assert client.get('/api/merchants/current').get_json()['merchant']['id'] == second
+
+
+def test_writes_use_database_merchant_not_cached_identity(app, client, identity_cache, merchants):
+    first, second = merchants
+    client.get('/api/merchants/current')
+    # 当前商户在其他设备上被切换：本会话与缓存中仍是旧商户
+    with app.app_context():
+        User.query.filter_by(username='tester').update({User.current_merchant_id: second})
+        db.session.commit()
+
+    response = client.post('/api/products', json={'id': 'W001', 'name': '写入测试'})
+    assert response.status_code == 201
+    with app.app_context():
+        assert db.session.get(Product, 'W001').merchant_id == second
@@ -0,0 +1,30 @@
+"""
+商户响应缓存测试：随日期变化的接口跨过零点后不再命中前一天的缓存。
+"""
+from datetime import datetime, timedelta
+
+from cachelib import SimpleCache
+
+import app as app_module
+import performance_optimization
+
+
+class Tomorrow(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return datetime.now(tz) + timedelta(days=1)
+
+
+def test_dashboard_cache_key_changes_with_date(client, monkeypatch):
+    merchant_cache = app_module.merchant_cache
+    monkeypatch.setattr(merchant_cache, 'cache', SimpleCache())
+    merchant_cache.reset_stats()
+
+    assert client.get('/api/dashboard').status_code == 200
+    assert client.get('/api/dashboard').status_code == 200
+    assert merchant_cache.stats()['endpoints']['dashboard_data']['hits'] == 1
+
+    monkeypatch.setattr(performance_optimization, 'datetime', Tomorrow)
+    assert client.get('/api/dashboard').status_code == 200
+    stats = merchant_cache.stats()['endpoints']['dashboard_data']
+    assert (stats['hits'], stats['misses']) == (1, 2)
@@ -0,0 +1,64 @@
+"""
+删除商户测试：在启用外键约束的数据库上，删除有库存的商户会一并清除引用该商户的行。
+"""
+from datetime import date
+
+import pytest
+
+from extensions import db
+from inventory_summary import rebuild_summaries
+from models import BackgroundJob, Merchant, Product, ProductInventorySummary, Stock
+
+
+@pytest.fixture
+def foreign_keys(app):
+    # SQLite 默认不检查外键；按 PostgreSQL 的行为开启（内存库只有一个连接）
+    with app.app_context():
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA foreign_keys=ON')
+            assert conn.exec_driver_sql('PRAGMA foreign_keys').scalar() == 1
+    yield
+    with app.app_context():
+        db.session.remove()
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA foreign_keys=OFF')
+
+
+@pytest.fixture
+def other_merchant(app):
+    with app.app_context():
+        merchant = Merchant(name='待删除商户')
+        db.session.add(merchant)
+        db.session.flush()
+        db.session.add(Product(id='D001', name='删除测试', merchant_id=merchant.id))
+        db.session.add(Stock(
+            product_id='D001', box_spec='24', units_per_box=24, quantity=3, batch_number='B1',
+            expiry_date=date(2030, 1, 1), location='A1', site='hk', merchant_id=merchant.id
+        ))
+        db.session.commit()
+        rebuild_summaries(merchant.id)
+        return merchant.id
+
+
+def test_delete_merchant_with_stock(app, client, other_merchant, foreign_keys):
+    with app.app_context():
+        assert ProductInventorySummary.query.filter_by(merchant_id=other_merchant).count() == 1
+
+    response = client.delete(f'/api/merchants/{other_merchant}')
+    assert response.status_code == 200, response.get_data(as_text=True)
+    with app.app_context():
+        assert db.session.get(Merchant, other_merchant) is None
+        assert ProductInventorySummary.query.filter_by(merchant_id=other_merchant).count() == 0
+
+
+def test_delete_merchant_after_daily_jobs(app, client, merchant_id, other_merchant, foreign_keys):
+    # 切换到该商户会为其加入当日后台任务
+    assert client.post('/api/merchants/switch', json={'merchant_id': other_merchant}).status_code == 200
+    assert client.post('/api/merchants/switch', json={'merchant_id': merchant_id}).status_code == 200
+    with app.app_context():
+        assert BackgroundJob.query.filter_by(merchant_id=other_merchant).count() > 0
+
+    response = client.delete(f'/api/merchants/{other_merchant}')
+    assert response.status_code == 200, response.get_data(as_text=True)
+    with app.app_context():
+        assert BackgroundJob.query.filter_by(merchant_id=other_merchant).count() == 0
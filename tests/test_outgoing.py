@@ -0,0 +1,61 @@
+"""
+出库测试：单条出库与批量出库一样按条件扣减，库存被并发修改时不会扣成负数。
+"""
+from datetime import date
+
+import pytest
+
+import app as app_module
+from extensions import db
+from inventory_summary import rebuild_summaries
+from models import Product, Record, Stock
+
+
+@pytest.fixture
+def stock_id(app, merchant_id):
+    with app.app_context():
+        db.session.add(Product(id='O001', name='出库测试', merchant_id=merchant_id))
+        stock = Stock(
+            product_id='O001', box_spec='24', quantity=5, batch_number='B1',
+            expiry_date=date(2030, 1, 1), location='A1', merchant_id=merchant_id
+        )
+        db.session.add(stock)
+        db.session.commit()
+        rebuild_summaries(merchant_id)
+        return stock.id
+
+
+def outbound(client, quantity):
+    return client.post('/api/outgoing', json={
+        'product_id': 'O001', 'box_spec': '24', 'quantity': quantity, 'outgoing_reason': '销售',
+        'batch_number': 'B1', 'location': 'A1', 'expiry_date': '2030-01-01'
+    })
+
+
+def stock_state(app, stock_id):
+    with app.app_context():
+        return db.session.get(Stock, stock_id).quantity, Record.query.filter_by(operation_type='出库').count()
+
+
+def test_single_outbound(app, client, stock_id):
+    response = outbound(client, 2)
+    body = response.get_json()
+    assert response.status_code == 200, body
+    assert body['stock']['quantity'] == 3
+    assert stock_state(app, stock_id) == (3, 1)
+    with app.app_context():
+        assert db.session.get(Record, body['record']['id']).batch_number == 'B1'
+
+
+def test_single_outbound_rejects_concurrent_change(app, client, stock_id, monkeypatch):
+    write_outgoing_picks = app_module.write_outgoing_picks
+
+    def concurrent_outbound(merchant_id, picks, **kwargs):
+        # 读取库存之后、扣减之前，另一请求已出库 4 箱
+        db.session.execute(db.update(Stock).where(Stock.id == stock_id).values(quantity=1))
+        return write_outgoing_picks(merchant_id, picks, **kwargs)
+
+    monkeypatch.setattr(app_module, 'write_outgoing_picks', concurrent_outbound)
+    response = outbound(client, 2)
+    assert response.status_code == 409
+    assert stock_state(app, stock_id) == (5, 0)
@@ -0,0 +1,47 @@
+"""
+读接口 SQL 次数回归测试：仪表盘与库存列表的语句数不随产品、批次数量增长。
+"""
+import pytest
+
+from conftest import count_statements
+from extensions import db
+from models import Merchant
+
+
+def statements_for(client, url):
+    # 先请求一次，使按会话缓存的权限集合就绪，只统计稳定状态下的语句
+    client.get(url)
+    with count_statements() as statements:
+        response = client.get(url)
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return statements
+
+
+def test_dashboard_query_count_is_constant(app, client, merchant_id, seed_products):
+    seed_products(merchant_id, 0, 1)
+    small = statements_for(client, '/api/dashboard')
+    seed_products(merchant_id, 1, 30)
+    large = statements_for(client, '/api/dashboard')
+    assert len(large) == len(small)
+
+
+def stock_statements(statements):
+    return [statement for statement in statements if 'FROM stock' in statement]
+
+
+@pytest.mark.parametrize('url', ['/api/stock', '/api/shenzhen/stock', '/api/all-merchants-stock'])
+def test_stock_listing_is_one_query(app, client, merchant_id, seed_products, url):
+    seed_products(merchant_id, 0, 1)
+    small = statements_for(client, url)
+    # 增加产品与批次，并加入第二个商户（全部商户库存也应只查询一次）
+    with app.app_context():
+        other = Merchant(name='第二商户')
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+    seed_products(merchant_id, 1, 30)
+    seed_products(other_id, 100, 10)
+    large = statements_for(client, url)
+    assert len(stock_statements(small)) == 1
+    assert len(stock_statements(large)) == 1
+    assert len(large) == len(small)
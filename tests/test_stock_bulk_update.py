@@ -0,0 +1,35 @@
+"""
+库存批量更新测试：按产品更新全部库存行的指定列，未给出的列保持原值。
+"""
+from extensions import db
+from models import Stock, User
+
+
+def stock_values(app, product_id):
+    with app.app_context():
+        return sorted(
+            (row.daily_consumption, row.in_transit, row.shenzhen_stock)
+            for row in Stock.query.filter_by(product_id=product_id)
+        )
+
+
+def test_bulk_update_sets_given_columns_only(app, client, merchant_id, seed_products):
+    seed_products(merchant_id, 0, 2)
+    response = client.post('/api/stock/bulk-update', json={'items': [
+        {'product_id': 'P0000', 'in_transit': 7},
+        {'product_id': 'P0001', 'daily_consumption': 3.5, 'shenzhen_stock': 4},
+        {'product_id': 'NOPE', 'in_transit': 1},
+    ]})
+    body = response.get_json()
+    assert response.status_code == 200, body
+    assert (body['updated_products'], body['updated_rows'], body['not_found']) == (2, 6, ['NOPE'])
+    assert stock_values(app, 'P0000') == [(2, 7, 0)] * 3
+    assert stock_values(app, 'P0001') == [(3.5, None, 4)] * 3
+
+
+def test_bulk_update_requires_current_merchant(app, client):
+    with app.app_context():
+        User.query.filter_by(username='tester').update({User.current_merchant_id: None})
+        db.session.commit()
+    response = client.post('/api/stock/bulk-update', json={'items': [{'product_id': 'P0000', 'in_transit': 1}]})
+    assert response.status_code == 400
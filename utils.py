@@ -1,4 +1,8 @@
+import os
+import random
 import re
+import threading
+import time
 from datetime import datetime
 
 
@@ -9,6 +13,171 @@ def sanitize_filename(text: str) -> str:
     return safe.strip() or 'unknown'
 
 
+# 主键格式（20 位）：本地时间 YYYYmmddHHMMSS（14 位，与旧的时间戳 ID 前缀一致，按 id 排序仍按时间）
+# + 6 位 36 进制尾部，编码 毫秒(0-999) × 2^21 + 节点号(10 位) × 2^11 + 毫秒内序号(11 位)。
+# 尾部只用 0-9A-Z，任何排序规则下字符串顺序都与数值顺序一致。
+ID_TIME_FORMAT = '%Y%m%d%H%M%S'
+ID_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+ID_SUFFIX_LENGTH = 6
+ID_NODE_BITS = 10
+ID_SEQUENCE_BITS = 11
+ID_MAX_NODE = (1 << ID_NODE_BITS) - 1
+ID_MAX_SEQUENCE = (1 << ID_SEQUENCE_BITS) - 1
+
+
+def _encode_id_suffix(value):
+    chars = []
+    for _ in range(ID_SUFFIX_LENGTH):
+        value, digit = divmod(value, len(ID_ALPHABET))
+        chars.append(ID_ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+
+class IdAllocator:
+    """单调递增、按时间可排序、多进程安全的主键分配器
+
+    节点号（0-1023）按以下顺序确定：构造参数 node_id、环境变量 ID_NODE_ID（由部署方保证各实例不同）、
+    节点号提供者（应用中为 node_lease.NodeLease，从数据库租用各进程互不相同的节点号），
+    以上都没有时（不连接数据库的独立脚本）取随机节点号，只能降低而不能排除与其他进程撞号。
+    每毫秒从随机起点开始递增序号，序号用尽时顺延到下一毫秒；时钟回拨时沿用上次的毫秒继续递增。
+    """
+
+    def __init__(self, node_id=None, node_provider=None):
+        self._lock = threading.Lock()
+        self._configured_node = node_id
+        self.node_provider = node_provider
+        self._pid = None
+        self._node = 0
+        self._random = None
+        self._last_ms = -1
+        self._sequence = 0
+
+    def _reset_for_process(self, pid):
+        # fork 出的子进程继承父进程状态，需重新确定节点号并重新播种随机数
+        node = self._configured_node
+        if node is None and os.environ.get('ID_NODE_ID'):
+            node = int(os.environ['ID_NODE_ID'])
+        if node is None:
+            node = int.from_bytes(os.urandom(2), 'big')
+        self._node = node & ID_MAX_NODE
+        self._random = random.Random(os.urandom(16))
+        self._pid = pid
+        self._last_ms = -1
+
+    def _uses_provider(self):
+        return self.node_provider is not None and self._configured_node is None and not os.environ.get('ID_NODE_ID')
+
+    @property
+    def node(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                self._reset_for_process(os.getpid())
+        if self._uses_provider():
+            return self.node_provider() & ID_MAX_NODE
+        return self._node
+
+    def next_id(self):
+        with self._lock:
+            pid = os.getpid()
+            if pid != self._pid:
+                self._reset_for_process(pid)
+            if self._uses_provider():
+                # 租约在使用前校验并按需续租，取到的节点号在本次调用时一定由当前进程持有
+                self._node = self.node_provider() & ID_MAX_NODE
+            now_ms = time.time_ns() // 1_000_000
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                # 随机起点降低节点号相同的两个进程在同一毫秒撞号的概率，并保留一半序号空间
+                self._sequence = self._random.randrange((ID_MAX_SEQUENCE + 1) // 2)
+            else:
+                self._sequence += 1
+                if self._sequence > ID_MAX_SEQUENCE:
+                    self._last_ms += 1
+                    self._sequence = 0
+            current_ms, sequence, node = self._last_ms, self._sequence, self._node
+
+        seconds, millis = divmod(current_ms, 1000)
+        suffix = (millis << (ID_NODE_BITS + ID_SEQUENCE_BITS)) | (node << ID_SEQUENCE_BITS) | sequence
+        return time.strftime(ID_TIME_FORMAT, time.localtime(seconds)) + _encode_id_suffix(suffix)
+
+
+_id_allocator = IdAllocator()
+
+
+def set_id_node_provider(provider):
+    """设置 generate_unique_id 的节点号提供者（返回当前进程节点号的函数），None 表示不使用"""
+    _id_allocator.node_provider = provider
+
+
 def generate_unique_id():
-    now = datetime.now()
-    return now.strftime('%Y%m%d%H%M%S%f')[:20]
\ No newline at end of file
+    """生成 20 位记录主键（出入库记录、深圳记录共用），见 IdAllocator"""
+    return _id_allocator.next_id()
+
+
+# additional_info 中的中文键与 Record 结构化字段的对应关系
+RECORD_INFO_KEYS = {
+    '入库原因': 'reason',
+    '出库原因': 'reason',
+    '箱规格': 'box_spec',
+    '批次号': 'batch_number',
+    '保质期': 'expiry_date',
+    '过期日期': 'expiry_date',
+    '库位': 'location',
+}
+
+
+def parse_record_info(info):
+    """解析旧版 additional_info 文本，返回结构化字段字典（缺失值为 None）。"""
+    fields = {'reason': None, 'box_spec': None, 'batch_number': None, 'expiry_date': None, 'location': None}
+    if not info:
+        return fields
+    for part in str(info).split(','):
+        key, sep, value = part.strip().partition(': ')
+        name = RECORD_INFO_KEYS.get(key)
+        if not sep or not name or fields[name] is not None:
+            continue
+        value = value.strip()
+        if value in ('', '无', 'None', '-'):
+            continue
+        if name == 'expiry_date':
+            try:
+                value = datetime.strptime(value, '%Y-%m-%d').date()
+            except ValueError:
+                continue
+        fields[name] = value
+    return fields
+
+
+def format_record_info(operation_type, reason, box_spec, batch_number, expiry_date, location):
+    """生成便于人工查看的 additional_info 文本（与历史格式保持一致）。"""
+    expiry_str = expiry_date.strftime('%Y-%m-%d') if expiry_date else '无'
+    if operation_type == '入库':
+        return f"入库原因: {reason}, 箱规格: {box_spec}, 批次号: {batch_number}, 保质期: {expiry_str}, 库位: {location}"
+    return f"出库原因: {reason}, 箱规格: {box_spec}, 批次号: {batch_number}, 过期日期: {expiry_str}, 库位: {location}"
+
+
+# 库存站点：由库位归一化得到，香港/深圳库存的筛选只比较该列
+SITE_HK = 'hk'
+SITE_SHENZHEN = 'shenzhen'
+
+
+def site_for_location(location):
+    """库位 -> 站点：库位为 Shenzhen（不区分大小写、忽略首尾空格）时为深圳，其余（含空库位）为香港"""
+    if location is not None and str(location).strip().lower() == SITE_SHENZHEN:
+        return SITE_SHENZHEN
+    return SITE_HK
+
+
+# 规格中解析不出数字时，统计件数按每箱 1 个单位计
+DEFAULT_UNITS_PER_BOX = 1
+
+
+def parse_units_per_box(spec):
+    """解析规格中的每箱单位数（取第一个数字，如 "24"、"24/箱"、"0.5"），无法解析时返回 None。
+
+    写入库存/记录时用于填充 units_per_box 列，统计件数统一按 数量 × COALESCE(units_per_box, 1) 计算。
+    """
+    if spec is None:
+        return None
+    match = re.search(r"(\d+(?:\.\d+)?)", str(spec))
+    return float(match.group(1)) if match else None